@@ -0,0 +1,241 @@
+# Classification service. Keeps an ATOL model (written by
+# `myATOL.py -m train -o FILE`) in memory and categorizes pages sent
+# to it, so a crawler can classify pages as they come in without
+# starting a new process per batch.
+#
+# Usage: python3 atol_server.py -o parameters/atol.model [-p port | -u socket_path]
+#
+# POST /classify with a JSON body, either the page text or its word
+# group lines (Word,Count,NumPages,Ratio):
+#   {"text": "<page text>"}
+#   {"wordgrp": "<word group lines>"}
+# returns the category probabilities, most probable first:
+#   {"category": "DRUGS", "probs": [["DRUGS", 0.8], ["BLOGS", 0.2], ...]}
+#
+# POST /reload reloads the model file. The file is also reloaded when
+# its modification time changes, so `myATOL.py -m train` (which
+# replaces the file atomically) is enough to roll out a new model.
+# Requests already being scored finish with the model they started
+# with.
+#
+# Requests that arrive while a batch is being scored are scored
+# together in the next batch (see Batcher).
+
+import getopt
+import json
+import math
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import myATOL
+from wordgrp import generate_wordgrp
+
+kMaxBatchSize = 256  # Max pages scored together.
+kReloadCheckInterval = 1.0  # Seconds between checks of the model mtime.
+
+
+class Model(object):
+    def __init__(self, model_file):
+        self.model_file = model_file
+        self.mtime = os.stat(model_file).st_mtime_ns
+        (self.keywords, self.categories, self.constants) = myATOL.LoadModel(model_file)
+        # Only the keywords' entries of a page count in its scores, as
+        # with `myATOL.py --stream`.
+        self.keyword_ids = myATOL.KeywordVocabulary(self.keywords).ids
+
+
+# Scores pages in batches on one thread. Handler threads queue a page
+# and wait; the batcher takes everything queued (up to max_batch_size)
+# and scores it with one myATOL.ScoreOnions call, the same scoring as
+# `myATOL.py -m predict`.
+class Batcher(object):
+    def __init__(self, model_file, max_batch_size=kMaxBatchSize):
+        self.model = Model(model_file)
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.last_check = time.time()
+        thread = threading.Thread(target=self.Run)
+        thread.daemon = True
+        thread.start()
+
+    # rows: (word, count, pages) list. Returns the (category,
+    # probability) list of the page, most probable first.
+    def Classify(self, rows):
+        request = {'rows': rows, 'done': threading.Event()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['probs']
+
+    # Load the model file again. The new model is only swapped in once
+    # it has loaded; if loading fails the old one stays.
+    def Reload(self):
+        model = Model(self.model.model_file)
+        with self.lock:
+            self.model = model
+        print('Loaded model ' + model.model_file)
+
+    def ReloadIfChanged(self):
+        now = time.time()
+        if now - self.last_check < kReloadCheckInterval:
+            return
+        self.last_check = now
+        try:
+            if os.stat(self.model.model_file).st_mtime_ns != self.model.mtime:
+                self.Reload()
+        except (OSError, ValueError) as error:
+            print('Model reload failed, keeping the current model: ' + str(error))
+
+    def Run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.ReloadIfChanged()
+            with self.lock:
+                model = self.model
+            try:
+                self.Score(model, batch)
+            except Exception as error:
+                for request in batch:
+                    request['error'] = error
+            for request in batch:
+                request['done'].set()
+
+    def Score(self, model, batch):
+        page_multiplier = model.constants['kPageMultiplier']
+        keyword_ids = model.keyword_ids
+        # A vocabulary of the batch's keywords only: ScoreOnions skips
+        # the keywords that are not in it without looking them up.
+        data = myATOL.SparseHashBuilder(myATOL.Vocabulary())
+        for (i, request) in enumerate(batch):
+            data.AddRow(i, [(word, count + page_multiplier * math.sqrt(pages))
+                            for (word, count, pages) in request['rows'] if word in keyword_ids])
+        data = data.Freeze()
+        (cats, probs) = myATOL.ScoreOnions(data, list(range(len(batch))), model.keywords, model.categories)
+        for (i, request) in enumerate(batch):
+            request['probs'] = myATOL.SortedProbs(cats, probs[i])
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Replies are small; do not let Nagle hold them back on keep-alive
+    # connections.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        if self.path == '/classify':
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                if 'wordgrp' in body:
+                    lines = body['wordgrp']
+                    if not isinstance(lines, list):
+                        lines = lines.split('\n')
+                else:
+                    lines = generate_wordgrp(body['text'])
+                rows = myATOL.ParseWordGrpLines(lines)
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as error:
+                self.Reply(400, {'error': 'bad request: ' + str(error)})
+                return
+            try:
+                probs = self.server.batcher.Classify(rows)
+            except Exception as error:
+                # Scoring failed for the whole batch (see Batcher.Run).
+                self.Reply(500, {'error': 'classification failed: ' + str(error)})
+                return
+            self.Reply(200, {'category': probs[0][0] if probs else None, 'probs': probs})
+        elif self.path == '/reload':
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                self.server.batcher.Reload()
+            except (OSError, ValueError) as error:
+                self.Reply(500, {'error': 'reload failed: ' + str(error)})
+                return
+            self.Reply(200, {'model': self.server.batcher.model.model_file})
+        else:
+            self.Reply(404, {'error': 'not found'})
+
+    def Reply(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # No per-request logging, it costs more than the classification.
+    def log_message(self, format, *args):
+        pass
+
+
+# TCP_NODELAY does not apply to Unix sockets.
+class UnixHandler(Handler):
+    disable_nagle_algorithm = False
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    # BaseHTTPRequestHandler expects an (address, port) client address.
+    def get_request(self):
+        (request, client_address) = socketserver.UnixStreamServer.get_request(self)
+        return (request, ('local', 0))
+
+
+def PrintUsage():
+    print('Usage: python3 atol_server.py -o model_file [-p port | -u socket_path]')
+
+
+if __name__ == '__main__':
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'ho:p:u:', ['help', 'model=', 'port=', 'unix='])
+    except getopt.GetoptError as error:
+        print(str(error))
+        PrintUsage()
+        sys.exit(2)
+    model_file = None
+    port = 8080
+    unix_socket = None
+    for opt, arg in options:
+        if opt in ('-h', '--help'):
+            PrintUsage()
+            sys.exit()
+        elif opt in ('-o', '--model'):
+            model_file = arg
+        elif opt in ('-p', '--port'):
+            port = int(arg)
+        elif opt in ('-u', '--unix'):
+            unix_socket = arg
+    if model_file == None:
+        print('Required option -o not given')
+        PrintUsage()
+        sys.exit(2)
+
+    batcher = Batcher(model_file)
+    if unix_socket != None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, UnixHandler)
+        print('Serving ' + model_file + ' on ' + unix_socket)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        print('Serving ' + model_file + ' on http://127.0.0.1:' + str(port))
+    server.batcher = batcher
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
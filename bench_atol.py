@@ -0,0 +1,334 @@
+# Benchmark of the myATOL.py pipeline stages on synthetic corpora.
+#
+# Generates a seeded corpus per size (word group directory, train and
+# test label files, title/index file, keywords, stopwords and baseline
+# labels, see MakeCorpus) and times CreateHashes (without and with the
+# word group cache), ComputeTFICF, FindDuplicates, DedupData and each
+# RunInference* mode. Every stage is timed (wall and CPU, the best of
+# -r runs) and then run once more under tracemalloc for its peak memory.
+# Output of the stages is discarded.
+#
+# Results go to a JSON file together with the git commit they were
+# measured at. Pass an earlier results file with -c to print the time
+# of each stage relative to it.
+#
+# Usage: python3 bench_atol.py [-s 1000,10000,100000] [-d bench_data]
+#            [-o bench.json] [-c old_bench.json] [-r repeats]
+#            [--seed N] [--no-memory]
+#
+# Corpora are kept in the -d directory and only generated again when
+# the size or seed changes.
+
+import contextlib
+import getopt
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import myATOL
+
+kCategories = ['DRUGS', 'HACKER', 'Weapons', 'MARKET', 'FORUM', 'BLOGS', 'FINANCE', 'PORN']
+kZipfExponent = 1.1  # Exponent of the word frequency distribution.
+kTopicShare = 0.3  # Share of an onion's words drawn from its category's topic words.
+kTopicWords = 2000  # Topic words per category.
+kSeedKeywords = 15  # Keywords per category in the keywords file.
+kStopwords = 50  # Most frequent words, listed as stopwords.
+kCloneShare = 0.01  # Share of onions that are near copies of another onion.
+kMedianWords = 400  # Median number of words (not distinct) of an onion page.
+
+
+# Vocabulary size for a corpus of num_onions onions; grows sublinearly
+# with the corpus, as real vocabularies do (Heaps' law).
+def VocabularySize(num_onions):
+    return 5000 + int(50 * num_onions ** 0.6)
+
+
+# Word of rank i. Frequent words are short ('w' and i in base 26), so
+# the most frequent 676 are at most kMinKeywordLength long.
+def Word(i):
+    letters = []
+    while True:
+        letters.append(chr(ord('a') + i % 26))
+        i //= 26
+        if i == 0:
+            break
+    return 'w' + ''.join(reversed(letters))
+
+
+# Cumulative Zipf distribution over n ranks.
+def ZipfCdf(n):
+    p = 1.0 / np.arange(1, n + 1) ** kZipfExponent
+    cdf = np.cumsum(p)
+    return cdf / cdf[-1]
+
+
+def Sample(rng, cdf, n):
+    return np.minimum(np.searchsorted(cdf, rng.random_sample(n)), len(cdf) - 1)
+
+
+# Writes a corpus of num_onions onions to directory:
+#   wg/<onion>.onion  word group files (Word,Count,NumPages,Ratio)
+#   train.txt, test.txt  labels (onion,category) of 60% and 20% of the onions
+#   title.txt  index file (onion,,title,...,baseline categories,,)
+#   keywords.txt  seed keywords of every category
+#   stopwords.txt, baseline.txt
+# Category sizes, word frequencies and page sizes are skewed; every
+# category prefers its own topic words, and about kCloneShare of the
+# onions are near copies of another one.
+def MakeCorpus(directory, num_onions, seed=0):
+    rng = np.random.RandomState(seed)
+    num_words = VocabularySize(num_onions)
+    words = [Word(i) for i in range(num_words)]
+    background = ZipfCdf(num_words)
+    topic_cdf = ZipfCdf(kTopicWords)
+    # Topic words are drawn from the less frequent words.
+    topics = [num_words // 10 + rng.permutation(num_words - num_words // 10)[:kTopicWords] for c in kCategories]
+    cat_weights = 1.0 / np.arange(1, len(kCategories) + 1)
+    onion_cats = rng.choice(len(kCategories), size=num_onions, p=cat_weights / cat_weights.sum())
+    page_sizes = np.clip(rng.lognormal(np.log(kMedianWords), 0.8, size=num_onions), 5, 20000).astype(np.int64)
+    clones = rng.random_sample(num_onions) < kCloneShare
+
+    wg_dir = os.path.join(directory, 'wg')
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(wg_dir)
+    entries = 0
+    pages = []
+    for onion in range(num_onions):
+        c = onion_cats[onion]
+        if clones[onion] and onion > 0:
+            # Copy of an earlier onion with some of its words missing.
+            source = rng.randint(onion)
+            (ids, counts) = pages[source]
+            keep = rng.random_sample(len(ids)) > 0.05
+            (ids, counts) = (ids[keep], counts[keep])
+            onion_cats[onion] = onion_cats[source]
+        else:
+            n = page_sizes[onion]
+            num_topic = rng.binomial(n, kTopicShare)
+            tokens = np.concatenate((Sample(rng, background, n - num_topic),
+                                     topics[c][Sample(rng, topic_cdf, num_topic)]))
+            (ids, counts) = np.unique(tokens, return_counts=True)
+            # Word group files list words in no particular order.
+            order = rng.permutation(len(ids))
+            (ids, counts) = (ids[order], counts[order])
+        pages.append((ids, counts))
+        entries += len(ids)
+        with open(os.path.join(wg_dir, '{}.onion'.format(onion)), 'w') as f:
+            f.write(''.join('{},{},0,0\n'.format(words[i], n) for (i, n) in zip(ids.tolist(), counts.tolist())))
+            f.write('\n')
+
+    split = rng.random_sample(num_onions)
+    with open(os.path.join(directory, 'train.txt'), 'w') as f:
+        for onion in np.flatnonzero(split < 0.6).tolist():
+            f.write('{},{}\n'.format(onion, kCategories[onion_cats[onion]]))
+    with open(os.path.join(directory, 'test.txt'), 'w') as f:
+        for onion in np.flatnonzero((split >= 0.6) & (split < 0.8)).tolist():
+            f.write('{},{}\n'.format(onion, kCategories[onion_cats[onion]]))
+
+    # Baseline categories are right most of the time and missing for
+    # some onions.
+    def BaselineCategory(onion):
+        r = rng.random_sample()
+        if r < 0.2:
+            return ''
+        if r < 0.9:
+            return kCategories[onion_cats[onion]]
+        return kCategories[rng.randint(len(kCategories))]
+
+    with open(os.path.join(directory, 'title.txt'), 'w') as f:
+        for onion in range(num_onions):
+            topic = topics[onion_cats[onion]]
+            title = [words[i] for i in topic[Sample(rng, topic_cdf, 3)].tolist()]
+            title.append(words[Sample(rng, background, 1)[0]])
+            cat = BaselineCategory(onion)
+            f.write('{},,{},,,,,,,,{},,\n'.format(onion, ' '.join(title), cat + '[1.0]' if cat else ''))
+    with open(os.path.join(directory, 'baseline.txt'), 'w') as f:
+        for onion in range(num_onions):
+            cat = BaselineCategory(onion)
+            if cat:
+                f.write('{}.onion; {}[1.0];\n'.format(onion, cat))
+    with open(os.path.join(directory, 'keywords.txt'), 'w') as f:
+        for (c, cat) in enumerate(kCategories):
+            f.write('{}, {}\n'.format(cat, ', '.join(words[i] for i in topics[c][:kSeedKeywords].tolist())))
+    with open(os.path.join(directory, 'stopwords.txt'), 'w') as f:
+        for i in range(kStopwords):
+            f.write('{}\n'.format(words[i]))
+
+    corpus = {'onions': num_onions, 'seed': seed, 'words': num_words, 'entries': entries,
+              'bytes': sum(os.path.getsize(os.path.join(wg_dir, name)) for name in os.listdir(wg_dir))}
+    with open(os.path.join(directory, 'corpus.json'), 'w') as f:
+        json.dump(corpus, f)
+    return corpus
+
+
+# The corpus in directory if it was made with these settings, else a
+# new one.
+def LoadCorpus(directory, num_onions, seed):
+    try:
+        with open(os.path.join(directory, 'corpus.json')) as f:
+            corpus = json.load(f)
+        if corpus['onions'] == num_onions and corpus['seed'] == seed:
+            return corpus
+    except (OSError, ValueError, KeyError):
+        pass
+    print('Generating corpus of {} onions in {}'.format(num_onions, directory))
+    return MakeCorpus(directory, num_onions, seed)
+
+
+# Runs fn (after setup, untimed) repeats times and once more under
+# tracemalloc. Returns (result of fn, {wall, cpu, peak_bytes}), with
+# the best wall and CPU time. Stage output is discarded.
+def Measure(fn, repeats, memory, setup=None):
+    stats = {'wall': None, 'cpu': None}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for r in range(repeats):
+            if setup != None:
+                setup()
+            (w, c) = (time.perf_counter(), time.process_time())
+            result = fn()
+            (w, c) = (time.perf_counter() - w, time.process_time() - c)
+            stats['wall'] = w if stats['wall'] is None else min(stats['wall'], w)
+            stats['cpu'] = c if stats['cpu'] is None else min(stats['cpu'], c)
+        if memory:
+            if setup != None:
+                setup()
+            tracemalloc.start()
+            try:
+                result = fn()
+                stats['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    return (result, stats)
+
+
+def BenchCorpus(directory, repeats, memory):
+    # myATOL reads its inputs relative to the working directory, and
+    # takes the onion name from the first '.' of the path.
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        return BenchInputs(repeats, memory)
+    finally:
+        os.chdir(cwd)
+
+
+def BenchInputs(repeats, memory):
+    args = ('train.txt', 'wg', 'keywords.txt', 'title.txt', 'test.txt', 'stopwords.txt', 'baseline.txt')
+    stages = {}
+
+    def RemoveCache():
+        if os.path.exists('wg/' + myATOL.kCacheFile):
+            os.remove('wg/' + myATOL.kCacheFile)
+
+    def Stage(name, fn, setup=None):
+        (result, stats) = Measure(fn, repeats, memory, setup)
+        stages[name] = stats
+        print('  {:<22} {:8.3f}s wall {:8.3f}s cpu{}'.format(
+            name, stats['wall'], stats['cpu'],
+            ' {:8.1f} MiB peak'.format(stats['peak_bytes'] / 2.0**20) if 'peak_bytes' in stats else ''))
+        return result
+
+    Stage('CreateHashes', lambda: myATOL.CreateHashes(*args), RemoveCache)
+    (L, K, T, M, Mt, data, test, H, B, lexicon) = Stage('CreateHashes (cached)', lambda: myATOL.CreateHashes(*args))
+    categories = sorted(set([item for sublist in list(L.values()) for item in sublist]))
+    keywords = Stage('ComputeTFICF', lambda: myATOL.ComputeTFICF(M, Mt, K, categories, lexicon))
+    clusters = Stage('FindDuplicates', lambda: myATOL.FindDuplicates(data, myATOL.kDedupThreshold))
+    Stage('DedupData', lambda: myATOL.DedupData(data, clusters, myATOL.DedupSurvivors(data, clusters, test)))
+    Stage('RunInference', lambda: myATOL.RunInference(data, test, keywords, categories, T, 'atol: '))
+    Stage('RunInferenceOnLabel', lambda: myATOL.RunInferenceOnLabel(data, H, keywords, categories, T, 'DRUGS'))
+    Stage('RunInferenceDiff', lambda: myATOL.RunInferenceDiff(data, B, keywords, categories, T, test, 'Weapons', 0.5))
+    Stage('RunPracticalDiff', lambda: myATOL.RunPracticalDiff(data, keywords, categories))
+    RemoveCache()
+    return {'clusters': len(clusters), 'stages': stages}
+
+
+# Commit of the working tree, and whether it has uncommitted changes.
+def GitCommit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        stderr=subprocess.DEVNULL).decode().strip() != ''
+        return (commit, dirty)
+    except (OSError, subprocess.CalledProcessError):
+        return (None, None)
+
+
+# Prints the wall time of every stage against the same stage and corpus
+# size in an earlier results file.
+def Compare(results, old_results):
+    old = dict((size['corpus']['onions'], size['stages']) for size in old_results['sizes'])
+    print('\nWall time compared with {} ({}), old -> new (speedup):'.format(old_results.get('commit'), old_results.get('time')))
+    for size in results['sizes']:
+        n = size['corpus']['onions']
+        if n not in old:
+            continue
+        print('  {} onions'.format(n))
+        for (name, stats) in size['stages'].items():
+            if name not in old[n]:
+                continue
+            print('    {:<22} {:8.3f}s -> {:8.3f}s ({:.2f}x)'.format(
+                name, old[n][name]['wall'], stats['wall'], old[n][name]['wall'] / max(stats['wall'], 1e-9)))
+
+
+def PrintUsage():
+    print('Usage: python3 bench_atol.py [-s sizes] [-d data_dir] [-o results.json] [-c old_results.json] [-r repeats] [--seed N] [--no-memory]')
+
+
+if __name__ == '__main__':
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'hs:d:o:c:r:', ['help', 'sizes=', 'data=', 'output=', 'compare=',
+                                                                  'repeats=', 'seed=', 'no-memory'])
+    except getopt.GetoptError as error:
+        print(str(error))
+        PrintUsage()
+        sys.exit(2)
+    sizes = [1000, 10000, 100000]
+    data_dir = 'bench_data'
+    output_file = 'bench.json'
+    compare_file = None
+    repeats = 1
+    seed = 0
+    memory = True
+    for opt, arg in options:
+        if opt in ('-h', '--help'):
+            PrintUsage()
+            sys.exit()
+        elif opt in ('-s', '--sizes'):
+            sizes = [int(x) for x in arg.split(',')]
+        elif opt in ('-d', '--data'):
+            data_dir = arg
+        elif opt in ('-o', '--output'):
+            output_file = arg
+        elif opt in ('-c', '--compare'):
+            compare_file = arg
+        elif opt in ('-r', '--repeats'):
+            repeats = int(arg)
+        elif opt == '--seed':
+            seed = int(arg)
+        elif opt == '--no-memory':
+            memory = False
+
+    (commit, dirty) = GitCommit()
+    results = {'commit': commit, 'dirty': dirty, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+               'cpus': os.cpu_count(), 'repeats': repeats, 'sizes': []}
+    for n in sizes:
+        directory = os.path.join(data_dir, str(n))
+        corpus = LoadCorpus(directory, n, seed)
+        print('{} onions, {} words, {} word entries, {:.1f} MiB:'.format(n, corpus['words'], corpus['entries'], corpus['bytes'] / 2.0**20))
+        result = BenchCorpus(directory, repeats, memory)
+        results['sizes'].append({'corpus': corpus, 'clusters': result['clusters'], 'stages': result['stages']})
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('\nResults written to ' + output_file)
+    if compare_file != None:
+        with open(compare_file) as f:
+            Compare(results, json.load(f))
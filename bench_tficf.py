@@ -0,0 +1,71 @@
+# Benchmark of the keyword selection in myATOL.ComputeTFICF.
+#
+# Builds a synthetic M (categories x words, Zipf-like counts, a share
+# of short words and many ties) and times myATOL.CategoryTFICF against
+# the old selection, which sorted every word of the category and then
+# dropped short words. Also checks that both pick the same keywords in
+# the same order.
+#
+# Usage: python3 bench_tficf.py [-w num_words] [-c num_categories]
+
+import getopt
+import sys
+from time import time
+
+import numpy as np
+
+import myATOL
+
+
+# The selection as it was: full sort, filter, slice.
+def SortedCategoryTFICF(M, cat, ICF):
+    kw_hash = M[cat]
+    ids = kw_hash.Ids()
+    tf  = kw_hash.Values()
+    tficf = np.sqrt(tf * ICF[ids])
+    lst = list(zip(kw_hash.keys(), tficf.tolist()))
+    sorted_lst = sorted(lst, key=lambda x: x[1], reverse=True)
+    pruned_lst = [x for x in sorted_lst if len(x[0]) > myATOL.kMinKeywordLength]
+    return pruned_lst[0:myATOL.kMaxVecSize]
+
+
+def MakeM(num_words, num_categories, seed=0):
+    rng = np.random.RandomState(seed)
+    vocab = myATOL.Vocabulary()
+    for i in range(num_words):
+        # About one word in eight is too short to be a keyword.
+        vocab.Id('x{}'.format(i % 100) if i % 8 == 0 else 'w{}'.format(i))
+    rows = []
+    for c in range(num_categories):
+        n = num_words // (c + 1)
+        ids = rng.permutation(len(vocab))[:n].astype(np.int32)
+        # Small integer counts, so many words tie.
+        vals = np.floor(rng.zipf(1.5, n).clip(max=1000)).astype(np.float64)
+        rows.append((ids, vals))
+    return myATOL.SparseHash.FromRows(vocab, ['CAT{}'.format(c) for c in range(num_categories)], rows)
+
+
+def Bench(M, select, ICF):
+    t = time()
+    result = [select(M, cat, ICF) for cat in M.keys()]
+    return (time() - t, result)
+
+
+if __name__ == '__main__':
+    options, args = getopt.getopt(sys.argv[1:], 'w:c:')
+    num_words = 1000000
+    num_categories = 10
+    for opt, arg in options:
+        if opt == '-w':
+            num_words = int(arg)
+        elif opt == '-c':
+            num_categories = int(arg)
+
+    M = MakeM(num_words, num_categories)
+    ICF = myATOL.ComputeICF(M)
+    print('M: {} categories, {} words, {} entries'.format(len(M), len(M.vocab), len(M.indices)))
+    (t_sorted, sorted_result) = Bench(M, SortedCategoryTFICF, ICF)
+    (t_topk, topk_result) = Bench(M, myATOL.CategoryTFICF, ICF)
+    print('full sort: {:.3f}s'.format(t_sorted))
+    print('top-k:     {:.3f}s ({:.1f}x)'.format(t_topk, t_sorted / t_topk))
+    print('same keywords: {}'.format(sorted_result == topk_result))
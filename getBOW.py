@@ -1,32 +1,183 @@
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+import asyncio
+import codecs
+import getopt
+import glob
+import hashlib
+import json
+import re
 import requests
 import os
 import pandas
 import time 
-import subprocess
+import shutil
 import sys
 
+from wordgrp import generate_wordgrp, write_wordgrp_file
+import metrics
 
-def getOnionText(url, proxies):
+MAX_PAGE_BYTES = 2 * 1024 * 1024  # bytes of a page read, the rest is dropped
+CHUNK_SIZE = 64 * 1024
+CHARSET_SCAN_BYTES = 4096  # where to look for <meta charset>
+
+
+# Page text, without script/style content and comments, in one pass of
+# the stdlib parser (html5lib builds a full tree and was run twice).
+class TextExtractor(HTMLParser):
+    skip_tags = ('script', 'style')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags and self.skip:
+            self.skip -= 1
+
+    def handle_startendtag(self, tag, attrs):
+        pass
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    parser = TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return ''.join(parser.parts)
+
+
+header_charset_re = re.compile(r'charset\s*=\s*["\']?([-\w.:]+)', re.I)
+meta_charset_re = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([-\w.:]+)', re.I)
+BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+
+
+# Decode a page without running charset detection over the whole body:
+# BOM, then the Content-Type charset, then <meta charset> near the top,
+# then utf-8 if the bytes are valid utf-8, else cp1252.
+def decode_html(body, content_type=None):
+    encoding = None
+    for bom, bom_encoding in BOMS:
+        if body.startswith(bom):
+            encoding = bom_encoding
+            break
+    if encoding is None and content_type:
+        m = header_charset_re.search(content_type)
+        if m:
+            encoding = m.group(1)
+    if encoding is None:
+        m = meta_charset_re.search(body[:CHARSET_SCAN_BYTES])
+        if m:
+            encoding = m.group(1).decode('ascii')
+    if encoding is None:
+        try:
+            # Incremental, so a character cut by MAX_PAGE_BYTES is fine.
+            codecs.getincrementaldecoder('utf-8')().decode(body)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = 'cp1252'
+    try:
+        return body.decode(encoding, errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+
+# Word group lines of a fetched page, or None if it has no text. Runs
+# in the parse pool (see make_parse_pool).
+def page_to_wordgrp(body, content_type):
+    text = html_to_text(decode_html(body, content_type))
+    if not text:
+        return None
+    return generate_wordgrp(text)
+
+
+# page_to_wordgrp and the seconds it took, for the parse_seconds
+# histogram (the parse may run in a pool process).
+def timed_page_to_wordgrp(body, content_type):
+    s = time.time()
+    wrdgrp = page_to_wordgrp(body, content_type)
+    return wrdgrp, time.time() - s
+
+
+# Processes that parse pages while the crawl keeps fetching. None (for
+# workers == 1) means no processes: the serial crawl parses in its
+# loop, the async one in a thread of the event loop's default executor.
+# 0 means one per core.
+def make_parse_pool(workers):
+    if workers == 1:
+        return None
+    return ProcessPoolExecutor(workers or None)
+
+# Pages fetched but not yet parsed are limited to this many, so they do
+# not pile up in memory when parsing falls behind.
+def max_pending(workers):
+    return 2 * (workers or os.cpu_count())
+
+
+# A fetched page. status 304 (with an empty body) means the page has
+# not changed since the validators sent from the crawl cache.
+class Page(object):
+    def __init__(self, body, content_type, status=200, etag=None, last_modified=None):
+        self.body = body
+        self.content_type = content_type
+        self.status = status
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = None
+
+
+def read_capped(chunks, max_bytes):
+    body = bytearray()
+    for chunk in chunks:
+        body += chunk[:max_bytes - len(body)]
+        if len(body) >= max_bytes:
+            break
+    return bytes(body)
+
+
+# Fetch a page, reading at most max_bytes of it. Returns a Page, or
+# None if the onion could not be reached. headers: extra request
+# headers, such as the validators of a conditional request.
+def getOnionPage(url, proxies, max_bytes=MAX_PAGE_BYTES, headers=None):
     print('Requesting onion from: {} .... '.format(url), end='')
+    s = time.time()
     try:
         # url = 'http://hss33mlbykbsxmug.onion'
-        html = requests.get(url, proxies=proxies).text
-        soup = BeautifulSoup(html, "html5lib")
-        # print(soup)
-        # remove CSS and JS
-        cleaned = (''.join(soup.findAll(text=lambda text: text.parent.name != "script" and text.parent.name != "style")))
-        soup = BeautifulSoup(cleaned, "html5lib")
-        # remove HTML comments
-        for element in soup(text=lambda text: isinstance(text, Comment)):
-            element.extract()
-        text = soup.text
+        with requests.get(url, proxies=proxies, stream=True, headers=headers) as resp:
+            body = read_capped(resp.iter_content(CHUNK_SIZE), max_bytes)
+            page = Page(body, resp.headers.get('Content-Type'), resp.status_code,
+                        resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
         print('Suceeded. Time elapsed: {}'.format(time.time()-s))
-    except:
+    except Exception:
         print('Connection timed out. Passing onion...')
-        text = ''
+        page = None
+
+    return page
+
+# Cheap check that an onion answers at all: a HEAD request with a short
+# timeout. Any HTTP answer counts.
+def probeOnion(url, proxies):
+    try:
+        requests.head(url, proxies=proxies, timeout=PROBE_TIMEOUT, allow_redirects=False).close()
+        return True
+    except Exception:
+        print('Requesting onion from: {} .... Still not answering. Passing onion...'.format(url))
+        return False
 
-    return text
+def getOnionText(url, proxies, max_bytes=MAX_PAGE_BYTES):
+    page = getOnionPage(url, proxies, max_bytes)
+    if page is None:
+        return ''
+    return html_to_text(decode_html(page.body, page.content_type))
 
 def crawl(csv_dir):
     d = os.listdir(csv_dir)
@@ -52,23 +203,6 @@ def crawl(csv_dir):
                     f.write('{} \n'.format(title))
                     f.write('{} \n'.format(text))
 
-def get_wordgrp(file, WORD_GRP):
-    # generate word groups
-    if os.path.exists(WORD_GRP):
-        process = subprocess.call(['rm', '-rm', WORD_GRP])
-    else:
-        os.makedirs(WORD_GRP)
-    for cat in dirs:
-        cat_path = 'data/'+cat
-        for d in [f for f in os.listdir(cat_path) if '.DS' not in f]:
-            process = subprocess.Popen(['java', 'GenerateWordGrp', '{}/{}'.format(cat_path, d)], stdout=subprocess.PIPE)
-            stdout = process.communicate()[0]
-            wrdgrp = stdout.decode('UTF-8').split('\n')
-            with open('{}/{}.{}'.format(WORD_GRP, d, 'onion'), 'w', encoding='utf-8') as ff:
-                for wrd in [w for w in wrdgrp if w != '']:
-                    ff.write('{}\n'.format(wrd))   
-
-
 def get_name(i):
     if i < 9:
         return '1000'+str(i)
@@ -77,45 +211,605 @@ def get_name(i):
     else:
         return '10'+str(i)
 
-def get_wordgrp(url_csv, wrdgrp_dir, proxies):
-    if os.path.exists(wrdgrp_dir):
-        process = subprocess.call(['rm', '-rf', wrdgrp_dir])
-    else:
-        os.makedirs(wrdgrp_dir)
+def read_urls(url_csv):
     with open(url_csv, 'r', encoding='utf-8') as f:
-        for i, url in enumerate(f):
-            try:
-                text = getOnionText(url, proxies=proxies)
-            except KeyboardInterrupt:
-                exit(-1)
+        return [url.strip() for url in f]
+
+def wordgrp_path(wrdgrp_dir, i):
+    return '{}/{}.{}'.format(wrdgrp_dir, get_name(i), 'onion')
+
+
+# Open a JSON lines file for writing records. When appending after a
+# line cut short by a crash, start on a new line.
+def open_jsonl(path, mode):
+    f = open(path, mode, encoding='utf-8')
+    if f.tell() > 0:
+        with open(path, 'rb') as g:
+            g.seek(-1, os.SEEK_END)
+            if g.read(1) != b'\n':
+                f.write('\n')
+    return f
+
+
+# Journal of a crawl, kept next to the word groups it writes (glob('*')
+# skips dot files). One JSON line per URL is appended as soon as the URL
+# is done:
+#   {"i": 3, "url": "...", "status": "ok", "bytes": 5120, "elapsed": 4.2}
+# status is "ok" (word group written), "empty" (page without text),
+# "failed" (no page) or "dead" (skipped, see DeadHosts). With --resume, URLs already ok or empty are
+# skipped and failed ones are fetched again.
+JOURNAL_FILE = '.crawl.journal'
+
+class CrawlJournal(object):
+    def __init__(self, wrdgrp_dir, resume=False):
+        self.wrdgrp_dir = wrdgrp_dir
+        self.path = os.path.join(wrdgrp_dir, JOURNAL_FILE)
+        self.done = {}
+        if resume and os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line of a crawl that was killed mid-write.
+                        continue
+                    self.done[record['i']] = record
+        self.f = open_jsonl(self.path, 'a' if resume else 'w')
+
+    def finished(self, i, url):
+        record = self.done.get(i)
+        if record is None or record['url'] != url:
+            return False
+        if record['status'] == 'ok':
+            return os.path.exists(wordgrp_path(self.wrdgrp_dir, i))
+        return record['status'] == 'empty'
+
+    def record(self, i, url, status, nbytes, elapsed):
+        record = {'i': i, 'url': url, 'status': status, 'bytes': nbytes, 'elapsed': round(elapsed, 3)}
+        self.done[i] = record
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
 
-            if text:
-                with open('tmp.csv', 'w') as f:
-                    f.write(text)
 
-                process = subprocess.Popen(['java', 'GenerateWordGrp', 'tmp.csv'], stdout=subprocess.PIPE)
-                stdout = process.communicate()[0]
-                wrdgrp = stdout.decode('UTF-8').split('\n')
-                with open('{}/{}.{}'.format(wrdgrp_dir, get_name(i), 'onion'), 'w', encoding='utf-8') as ff:
-                    for wrd in [w for w in wrdgrp if w != '']:
-                        ff.write('{}\n'.format(wrd)) 
-    process = subprocess.call(['rm', '-rf', 'tmp.csv'])
+# Cache of what earlier crawls got from each URL, for recrawls: the
+# page's validators (ETag, Last-Modified), a hash of its content and its
+# word group. Pages are requested conditionally, and when the server
+# answers 304 or sends the same content again, the cached word group is
+# copied instead of parsing the page. Kept in a directory of its own:
+#   index.jsonl: one JSON line per URL, the last one for a URL counts:
+#     {"url": "...", "etag": "...", "last_modified": "...",
+#      "digest": "...", "wordgrp": true}
+#   <digest>.onion: word group of the content with that digest
+#     (wordgrp false means the page had no text).
+CACHE_INDEX = 'index.jsonl'
+EXTRACT_VERSION = '1'  # bump when page_to_wordgrp changes its output
 
+class CrawlCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, CACHE_INDEX)
+        self.entries = {}
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry['url']] = entry
+                    lines += 1
+        if lines > 2 * len(self.entries):
+            self.compact()
+        self.f = open_jsonl(self.path, 'a')
 
- 
+    # Rewrite the index with one line per URL and drop word groups no
+    # URL refers to any more.
+    def compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, self.path)
+        used = set(entry['digest'] + '.onion' for entry in self.entries.values())
+        for path in glob.glob(os.path.join(self.cache_dir, '*.onion')):
+            if os.path.basename(path) not in used:
+                os.remove(path)
 
-                
+    def wordgrp_file(self, digest):
+        return os.path.join(self.cache_dir, digest + '.onion')
+
+    # Validators to send for url, if its last result is still cached.
+    def request_headers(self, url):
+        entry = self.entries.get(url)
+        if entry is None or (entry['wordgrp'] and not os.path.exists(self.wordgrp_file(entry['digest']))):
+            return None
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers or None
+
+    # Cached entry for a fetched page, or None if it has to be parsed.
+    def lookup(self, url, page):
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        if page.status != 304 and page.digest != entry['digest']:
+            return None
+        if entry['wordgrp'] and not os.path.exists(self.wordgrp_file(entry['digest'])):
+            return None
+        return entry
+
+    # Cache the word group (None if no text) of a parsed page.
+    def store(self, url, page, wrdgrp):
+        if wrdgrp:
+            write_wordgrp_file(self.wordgrp_file(page.digest), wrdgrp)
+        self.write({'url': url, 'etag': page.etag, 'last_modified': page.last_modified,
+                    'digest': page.digest, 'wordgrp': bool(wrdgrp)})
+
+    # Update the validators of a page found in the cache. A 304 keeps
+    # the ones we sent.
+    def refresh(self, url, page):
+        if page.status == 304:
+            return
+        entry = dict(self.entries[url])
+        if (entry['etag'], entry['last_modified']) != (page.etag, page.last_modified):
+            entry.update({'etag': page.etag, 'last_modified': page.last_modified})
+            self.write(entry)
+
+    def write(self, entry):
+        self.entries[entry['url']] = entry
+        self.f.write(json.dumps(entry) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def page_digest(page):
+    h = hashlib.sha1(EXTRACT_VERSION.encode('ascii'))
+    h.update((page.content_type or '').encode('utf-8', 'replace') + b'\0')
+    h.update(page.body)
+    return h.hexdigest()
+
+
+# Registry of onions that could not be reached, kept across crawls in a
+# JSON file: host -> {"failures": n, "retry_after": time, "cost": s}.
+# After its n-th failure in a row a host is skipped for
+# DEAD_FIRST_TTL * 2^(n-1) seconds (at most DEAD_MAX_TTL). Once that
+# has passed it is probed with a short HEAD request before the full
+# fetch. cost is the average time its failed fetches took, which is
+# what a skip, or a failed probe, saves. A host counts at most one
+# failure per crawl, however many of its urls fail.
+DEAD_FIRST_TTL = 12 * 3600
+DEAD_MAX_TTL = 64 * 24 * 3600
+PROBE_TIMEOUT = 15
+
+class DeadHosts(object):
+    def __init__(self, path):
+        self.path = path
+        self.hosts = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.hosts = json.load(f)
+        self.skipped = 0
+        self.probed = 0
+        self.probes_failed = 0
+        self.saved = 0.0
+        # Hosts that failed in this crawl.
+        self.failed_hosts = set()
+
+    # None for hosts not known to be dead, 'skip' while the TTL runs,
+    # 'probe' after it.
+    def check(self, host, now):
+        entry = self.hosts.get(host)
+        if entry is None:
+            return None
+        if now < entry['retry_after']:
+            self.skipped += 1
+            self.saved += entry['cost']
+            return 'skip'
+        self.probed += 1
+        return 'probe'
+
+    # A failed fetch of host that took elapsed seconds. probe_failed: it
+    # was only the HEAD probe that failed, which saved the cost of a
+    # full fetch; a full fetch that fails after a good probe is an
+    # ordinary failure.
+    def failed(self, host, elapsed, probe_failed=False):
+        entry = self.hosts.setdefault(host, {'failures': 0, 'retry_after': 0, 'cost': 0.0})
+        if probe_failed:
+            self.probes_failed += 1
+            self.saved += max(0.0, entry['cost'] - elapsed)
+        if host in self.failed_hosts:
+            return
+        self.failed_hosts.add(host)
+        if not probe_failed:
+            entry['cost'] = (entry['cost'] * entry['failures'] + elapsed) / (entry['failures'] + 1)
+        entry['failures'] += 1
+        entry['retry_after'] = time.time() + min(DEAD_FIRST_TTL * 2 ** (entry['failures'] - 1), DEAD_MAX_TTL)
+
+    def alive(self, host):
+        self.hosts.pop(host, None)
+        self.failed_hosts.discard(host)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.hosts, f, indent=0, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+# Registry key of a url: its host and port.
+def onion_host(url):
+    return urlsplit(url).netloc or url
+
+
+# Output side of a crawl: the word group directory, its journal, and
+# the optional crawl cache and dead host registry.
+#
+# A new crawl removes the word groups of the previous one; --resume
+# keeps them and the journal. todo holds the (i, url) still to fetch,
+# and probe the urls to probe first (see DeadHosts); onions known to be
+# dead are journaled as "dead" and left out.
+class Crawl(object):
+    def __init__(self, url_csv, wrdgrp_dir, resume=False, cache_dir=None, dead_hosts_file=None):
+        self.wrdgrp_dir = wrdgrp_dir
+        os.makedirs(wrdgrp_dir, exist_ok=True)
+        if not resume:
+            for path in glob.glob(os.path.join(wrdgrp_dir, '*.onion')):
+                os.remove(path)
+        self.journal = CrawlJournal(wrdgrp_dir, resume)
+        self.cache = CrawlCache(cache_dir) if cache_dir else None
+        self.dead = DeadHosts(dead_hosts_file) if dead_hosts_file else None
+        self.probe = set()
+        self.not_modified = 0
+        self.unchanged = 0
+        self.parsed = 0
+        urls = list(enumerate(read_urls(url_csv)))
+        done = self.journal.done
+        self.todo = [(i, url) for i, url in urls if not self.journal.finished(i, url)]
+        if resume:
+            failed = sum(1 for i, url in self.todo if done.get(i, {}).get('status') == 'failed')
+            print('Resuming: {} of {} onions done, {} failed ones retried.'.format(len(urls) - len(self.todo), len(urls), failed))
+        if self.dead is not None:
+            now = time.time()
+            todo = []
+            for i, url in self.todo:
+                state = self.dead.check(onion_host(url), now)
+                if state == 'skip':
+                    self.journal.record(i, url, 'dead', 0, 0)
+                    continue
+                if state == 'probe':
+                    self.probe.add(url)
+                todo.append((i, url))
+            self.todo = todo
+
+    def request_headers(self, url):
+        if self.cache is None:
+            return None
+        return self.cache.request_headers(url)
+
+    # Handle a fetched page (None if the fetch failed). probe_failed:
+    # the url was probed (see DeadHosts) and did not answer, so it was
+    # not fetched. Returns True if the page still has to be parsed and
+    # handed to page_parsed.
+    def page_fetched(self, i, url, page, elapsed, probe_failed=False):
+        metrics.observe('fetch_seconds', elapsed)
+        if page is None:
+            metrics.count('pages_failed')
+            if self.dead is not None:
+                self.dead.failed(onion_host(url), elapsed, probe_failed)
+            self.journal.record(i, url, 'failed', 0, elapsed)
+            return False
+        metrics.count('pages')
+        metrics.count('bytes', len(page.body))
+        if self.dead is not None:
+            self.dead.alive(onion_host(url))
+        if self.cache is None:
+            return True
+        page.digest = page_digest(page)
+        entry = self.cache.lookup(url, page)
+        if entry is None:
+            return True
+        if page.status == 304:
+            self.not_modified += 1
+        else:
+            self.unchanged += 1
+        if entry['wordgrp']:
+            # Copy through a temp file, as write_wordgrp_file does.
+            path = wordgrp_path(self.wrdgrp_dir, i)
+            tmp_path = os.path.join(self.wrdgrp_dir, '.{}.tmp'.format(os.path.basename(path)))
+            shutil.copyfile(self.cache.wordgrp_file(entry['digest']), tmp_path)
+            os.replace(tmp_path, path)
+        self.cache.refresh(url, page)
+        self.journal.record(i, url, 'ok' if entry['wordgrp'] else 'empty', len(page.body), elapsed)
+        return False
+
+    # Write the word group of a parsed page (if it has text) and journal
+    # it. parse_elapsed: seconds the parse took.
+    def page_parsed(self, i, url, page, elapsed, wrdgrp, parse_elapsed):
+        self.parsed += 1
+        metrics.observe('parse_seconds', parse_elapsed)
+        metrics.count('pages_parsed')
+        if self.cache is not None:
+            self.cache.store(url, page, wrdgrp)
+        if wrdgrp:
+            write_wordgrp_file(wordgrp_path(self.wrdgrp_dir, i), wrdgrp)
+            self.journal.record(i, url, 'ok', len(page.body), elapsed)
+        else:
+            self.journal.record(i, url, 'empty', len(page.body), elapsed)
+
+    def close(self):
+        self.journal.close()
+        if self.dead is not None:
+            self.dead.save()
+            print('Dead onions: {} skipped, {} probed ({} still dead), about {:.0f}s of crawl time saved.'.format(
+                self.dead.skipped, self.dead.probed, self.dead.probes_failed, self.dead.saved))
+        if self.cache is not None:
+            self.cache.close()
+            print('Crawl cache: {} pages not modified, {} unchanged, {} parsed.'.format(self.not_modified, self.unchanged, self.parsed))
+
+def get_wordgrp(url_csv, wrdgrp_dir, proxies, max_bytes=MAX_PAGE_BYTES, workers=1, resume=False, cache_dir=None, dead_hosts_file=None):
+    with metrics.phase('setup'):
+        crawl = Crawl(url_csv, wrdgrp_dir, resume, cache_dir, dead_hosts_file)
+    pool = make_parse_pool(workers)
+    pending = []
+    try:
+        with metrics.phase('crawl'):
+            for i, url in crawl.todo:
+                s = time.time()
+                probe_failed = url in crawl.probe and not probeOnion(url, proxies)
+                if probe_failed:
+                    page = None
+                else:
+                    page = getOnionPage(url, proxies=proxies, max_bytes=max_bytes, headers=crawl.request_headers(url))
+                elapsed = time.time() - s
+                if not crawl.page_fetched(i, url, page, elapsed, probe_failed):
+                    continue
+                job = (i, url, page, elapsed)
+                if pool is None:
+                    crawl.page_parsed(*job, *timed_page_to_wordgrp(page.body, page.content_type))
+                    continue
+                # Parse in the pool while the next onion is fetched.
+                pending.append((job, pool.submit(timed_page_to_wordgrp, page.body, page.content_type)))
+                while pending and (pending[0][1].done() or len(pending) > max_pending(workers)):
+                    job, future = pending.pop(0)
+                    crawl.page_parsed(*job, *future.result())
+            for job, future in pending:
+                crawl.page_parsed(*job, *future.result())
+    except KeyboardInterrupt:
+        print('Interrupted. Run again with --resume to continue.')
+        exit(-1)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        with metrics.phase('close'):
+            crawl.close()
+
+
+# Concurrent crawl. Each onion takes seconds to answer through Tor, so
+# instead of waiting on them one by one we keep up to `concurrency`
+# requests in flight (at most `per_host` to the same onion) over one
+# pooled SOCKS5 session, and hand each page to the word group stage as
+# soon as it arrives.
+def make_connector(proxy, concurrency, per_host):
+    import aiohttp
+    if proxy is None:
+        return aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    from aiohttp_socks import ProxyConnector
+    # socks5h means "resolve at the proxy", which .onion names need.
+    rdns = proxy.startswith('socks5h://')
+    if rdns:
+        proxy = 'socks5://' + proxy[len('socks5h://'):]
+    return ProxyConnector.from_url(proxy, rdns=rdns, limit=concurrency, limit_per_host=per_host)
+
+async def fetch_onion(session, url, host_locks, global_lock, per_host, timeout, retries, backoff, max_bytes=MAX_PAGE_BYTES, headers=None):
+    import aiohttp
+    host = urlsplit(url).hostname
+    if host not in host_locks:
+        host_locks[host] = asyncio.Semaphore(per_host)
+    s = time.time()
+    for attempt in range(retries + 1):
+        try:
+            # Take the host slot first so onions queued behind a busy
+            # host do not hold on to global slots.
+            async with host_locks[host], global_lock:
+                async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                    # Same as requests: error pages still have text, only
+                    # retry when the server says it is in trouble.
+                    if resp.status < 500 or attempt == retries:
+                        body = bytearray()
+                        while len(body) < max_bytes:
+                            chunk = await resp.content.read(min(CHUNK_SIZE, max_bytes - len(body)))
+                            if not chunk:
+                                break
+                            body += chunk
+                        print('Requesting onion from: {} .... Suceeded. Time elapsed: {}'.format(url, time.time()-s))
+                        return Page(bytes(body), resp.headers.get('Content-Type'), resp.status,
+                                    resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            if attempt == retries:
+                break
+        await asyncio.sleep(backoff * 2 ** attempt)
+    print('Requesting onion from: {} .... Connection timed out. Passing onion...'.format(url))
+    return None
+
+async def probe_onion(session, url, host_locks, global_lock, per_host):
+    import aiohttp
+    host = urlsplit(url).hostname
+    if host not in host_locks:
+        host_locks[host] = asyncio.Semaphore(per_host)
+    try:
+        async with host_locks[host], global_lock:
+            async with session.head(url, allow_redirects=False, timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)):
+                return True
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+        print('Requesting onion from: {} .... Still not answering. Passing onion...'.format(url))
+        return False
+
+# urls: (i, url) list. Yields (i, url, page, elapsed, probe_failed) as
+# pages arrive, page being None for onions that could not be fetched.
+# request_headers(url) gives extra headers for a request, if any. urls
+# in probe are fetched only if probe_onion finds them answering;
+# probe_failed is True for those it did not.
+async def crawl_onions(urls, proxy, concurrency=32, per_host=2, timeout=60, retries=2, backoff=1.0, max_bytes=MAX_PAGE_BYTES, request_headers=None, probe=()):
+    import aiohttp
+    host_locks = {}
+    global_lock = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession(connector=make_connector(proxy, concurrency, per_host)) as session:
+        async def fetch(i, url):
+            s = time.time()
+            if url in probe and not await probe_onion(session, url, host_locks, global_lock, per_host):
+                return i, url, None, time.time() - s, True
+            headers = request_headers(url) if request_headers else None
+            page = await fetch_onion(session, url, host_locks, global_lock, per_host, timeout, retries, backoff, max_bytes, headers)
+            return i, url, page, time.time() - s, False
+
+        tasks = [asyncio.ensure_future(fetch(i, url)) for i, url in urls]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+async def get_wordgrp_async(url_csv, wrdgrp_dir, proxy, workers=1, resume=False, cache_dir=None, dead_hosts_file=None, **crawl_opts):
+    with metrics.phase('setup'):
+        crawl = Crawl(url_csv, wrdgrp_dir, resume, cache_dir, dead_hosts_file)
+    pool = make_parse_pool(workers)
+    loop = asyncio.get_running_loop()
+    parse_slots = asyncio.Semaphore(max_pending(workers))
+    parsing = []
+
+    async def parse(job):
+        try:
+            page = job[2]
+            crawl.page_parsed(*job, *await loop.run_in_executor(pool, timed_page_to_wordgrp, page.body, page.content_type))
+        finally:
+            parse_slots.release()
+
+    try:
+        with metrics.phase('crawl'):
+            async for i, url, page, elapsed, probe_failed in crawl_onions(crawl.todo, proxy, request_headers=crawl.request_headers, probe=crawl.probe, **crawl_opts):
+                if not crawl.page_fetched(i, url, page, elapsed, probe_failed):
+                    continue
+                job = (i, url, page, elapsed)
+                # Never parse in the event loop itself: that would stall
+                # every fetch in flight, and their timeouts.
+                await parse_slots.acquire()
+                parsing.append(asyncio.ensure_future(parse(job)))
+            await asyncio.gather(*parsing)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        with metrics.phase('close'):
+            crawl.close()
+
+
+def print_usage():
+    print('Usage: python3 getBOW.py [options] url_csv wrdgrp_dir')
+    print('\t-a, --async            crawl concurrently instead of one onion at a time')
+    print('\t-c, --concurrency N    max requests in flight (async, default 32)')
+    print('\t--per-host N           max requests in flight per onion (async, default 2)')
+    print('\t--timeout S            seconds before a request is given up (async, default 60)')
+    print('\t--retries N            retries after a failed request (async, default 2)')
+    print('\t--backoff S            base delay between retries, doubled each time (async, default 1.0)')
+    print('\t--proxy URL            SOCKS5 proxy, "none" for direct (default socks5h://localhost:9050)')
+    print('\t--max-bytes N          bytes read per page, the rest is dropped (default {})'.format(MAX_PAGE_BYTES))
+    print('\t-w, --workers N        processes parsing pages while fetching goes on (0 = one per core, default 1 = none)')
+    print('\t-r, --resume           continue an interrupted crawl: skip onions already done, retry failed ones')
+    print('\t--cache DIR            crawl cache: request pages conditionally and reuse word groups of unchanged pages')
+    print('\t--dead-hosts FILE      registry of onions that did not answer: skip them for a while, then probe before fetching')
+    print('\t--metrics FILE         write time, memory, throughput and fetch/parse latency histograms (JSON, or Prometheus text for *.prom)')
+    print('\t--trace-memory         add the tracemalloc peak of each phase to the metrics (slow)')
+    print('\t--profile DIR          write cProfile stats of each phase to DIR/<phase>.prof')
 
 
 if __name__ == '__main__':
-    url_csv = sys.argv[1]
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'hac:w:r', ['help', 'async', 'concurrency=', 'per-host=', 'timeout=', 'retries=', 'backoff=', 'proxy=', 'max-bytes=', 'workers=', 'resume', 'cache=', 'dead-hosts=', 'metrics=', 'trace-memory', 'profile='])
+    except getopt.GetoptError as error:
+        print(str(error))
+        print_usage()
+        sys.exit(2)
+    if len(args) != 2:
+        print_usage()
+        sys.exit(2)
+
+    use_async = False
+    proxy = 'socks5h://localhost:9050'
+    crawl_opts = {}
+    max_bytes = MAX_PAGE_BYTES
+    workers = 1
+    resume = False
+    cache_dir = None
+    dead_hosts_file = None
+    metrics_file = None
+    trace_memory = False
+    profile_dir = None
+    for opt, arg in options:
+        if opt in ('-h', '--help'):
+            print_usage()
+            sys.exit()
+        elif opt in ('-a', '--async'):
+            use_async = True
+        elif opt in ('-c', '--concurrency'):
+            crawl_opts['concurrency'] = int(arg)
+        elif opt == '--per-host':
+            crawl_opts['per_host'] = int(arg)
+        elif opt == '--timeout':
+            crawl_opts['timeout'] = float(arg)
+        elif opt == '--retries':
+            crawl_opts['retries'] = int(arg)
+        elif opt == '--backoff':
+            crawl_opts['backoff'] = float(arg)
+        elif opt == '--proxy':
+            proxy = None if arg == 'none' else arg
+        elif opt == '--max-bytes':
+            max_bytes = int(arg)
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-r', '--resume'):
+            resume = True
+        elif opt == '--cache':
+            cache_dir = arg
+        elif opt == '--dead-hosts':
+            dead_hosts_file = arg
+        elif opt == '--metrics':
+            metrics_file = arg
+        elif opt == '--trace-memory':
+            trace_memory = True
+        elif opt == '--profile':
+            profile_dir = arg
+
+    url_csv = args[0]
 
     proxies = {
-    'http': 'socks5h://localhost:9050',
-    'https': 'socks5h://localhost:9050'
+    'http': proxy,
+    'https': proxy
     }
 
-    WORD_GRP = sys.argv[2]
+    WORD_GRP = args[1]
+    metrics.configure('getBOW', memory=trace_memory, profile_dir=profile_dir)
     
-    get_wordgrp(url_csv, WORD_GRP, proxies=proxies)
-
+    try:
+        if use_async:
+            try:
+                asyncio.run(get_wordgrp_async(url_csv, WORD_GRP, proxy, workers=workers, resume=resume, cache_dir=cache_dir, dead_hosts_file=dead_hosts_file, max_bytes=max_bytes, **crawl_opts))
+            except KeyboardInterrupt:
+                print('Interrupted. Run again with --resume to continue.')
+                exit(-1)
+        else:
+            get_wordgrp(url_csv, WORD_GRP, proxies=proxies, max_bytes=max_bytes, workers=workers, resume=resume, cache_dir=cache_dir, dead_hosts_file=dead_hosts_file)
+    finally:
+        # Also for interrupted crawls.
+        if metrics_file is not None:
+            metrics.write(metrics_file)
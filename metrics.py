@@ -0,0 +1,254 @@
+# Per-phase metrics of a run of myATOL.py or getBOW.py.
+#
+# A run is split into phases (`with metrics.phase('load'):`). Each
+# phase records its wall and CPU time, how often it ran, counts of what
+# it processed (metrics.count('files'), 'bytes', 'lines', ...) and, from
+# those, items per second. Latencies (crawl fetches, page parses) go to
+# histograms with metrics.observe(name, seconds).
+#
+# The process's max RSS at the end of each phase is always recorded.
+# configure(memory=True) adds the peak of the memory allocated during
+# every phase (tracemalloc; it makes allocation heavy code several times
+# slower), configure(profile_dir=...) writes a cProfile stats file per
+# phase (<phase>.prof, read with pstats), and write(path) saves
+# everything as JSON, or as Prometheus text format if path ends in
+# .prom.
+
+import cProfile
+import json
+import os
+import re
+import resource
+import sys
+import time
+import tracemalloc
+
+# Upper bounds (seconds) of the histogram buckets; the last is +Inf.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_memory = None
+        self.max_rss = 0
+        self.counts = {}
+        self.profile = None
+
+    def to_json(self):
+        result = {'calls': self.calls, 'wall_seconds': round(self.wall, 6), 'cpu_seconds': round(self.cpu, 6),
+                  'max_rss_bytes': self.max_rss}
+        if self.peak_memory is not None:
+            result['peak_memory_bytes'] = self.peak_memory
+        if self.counts:
+            result['counts'] = dict(self.counts)
+            result['per_second'] = dict((name, round(n / self.wall, 3) if self.wall > 0 else None)
+                                        for (name, n) in self.counts.items())
+        return result
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for (k, bound) in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[k] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    # Cumulative counts, as Prometheus has them.
+    def cumulative(self):
+        total = 0
+        result = []
+        for (bound, n) in zip(self.buckets, self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+    def to_json(self):
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'buckets': [['+Inf' if bound == float('inf') else bound, n] for (bound, n) in self.cumulative()]}
+
+
+class Metrics(object):
+    def __init__(self, program=None):
+        self.program = program or os.path.basename(sys.argv[0])
+        self.started = time.time()
+        self.phases = {}
+        self.histograms = {}
+        self.stack = []
+        self.memory = False
+        self.profile_dir = None
+        self.profiling = False
+
+    def configure(self, program=None, memory=False, profile_dir=None):
+        if program is not None:
+            self.program = program
+        self.memory = memory
+        self.profile_dir = profile_dir
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def phase(self, name):
+        return PhaseTimer(self, name)
+
+    # Adds n to counter 'name' of the innermost running phase.
+    def count(self, name, n=1):
+        if self.stack:
+            counts = self.stack[-1][0].counts
+            counts[name] = counts.get(name, 0) + n
+
+    def observe(self, name, value):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].observe(value)
+
+    def to_json(self):
+        return {'program': self.program,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall_seconds': round(time.time() - self.started, 6),
+                'max_rss_bytes': max_rss(),
+                'phases': dict((name, phase.to_json()) for (name, phase) in self.phases.items()),
+                'histograms': dict((name, h.to_json()) for (name, h) in self.histograms.items())}
+
+    def to_prometheus(self):
+        lines = []
+        program = prometheus_label(self.program)
+
+        def gauge(metric, help_text, values):
+            lines.append('# HELP atol_{} {}'.format(metric, help_text))
+            lines.append('# TYPE atol_{} gauge'.format(metric))
+            for (labels, value) in values:
+                lines.append('atol_{}{{program="{}"{}}} {}'.format(metric, program, labels, value))
+
+        phases = list(self.phases.items())
+        gauge('phase_wall_seconds', 'Wall time of the phase.',
+              [(',phase="{}"'.format(prometheus_label(name)), phase.wall) for (name, phase) in phases])
+        gauge('phase_cpu_seconds', 'CPU time of the phase.',
+              [(',phase="{}"'.format(prometheus_label(name)), phase.cpu) for (name, phase) in phases])
+        gauge('phase_calls', 'Times the phase ran.',
+              [(',phase="{}"'.format(prometheus_label(name)), phase.calls) for (name, phase) in phases])
+        gauge('phase_max_rss_bytes', 'Max resident set size of the process at the end of the phase.',
+              [(',phase="{}"'.format(prometheus_label(name)), phase.max_rss) for (name, phase) in phases])
+        gauge('phase_peak_memory_bytes', 'Peak traced memory during the phase.',
+              [(',phase="{}"'.format(prometheus_label(name)), phase.peak_memory) for (name, phase) in phases
+               if phase.peak_memory is not None])
+        gauge('phase_items', 'Items processed in the phase.',
+              [(',phase="{}",item="{}"'.format(prometheus_label(name), prometheus_label(item)), n)
+               for (name, phase) in phases for (item, n) in phase.counts.items()])
+        gauge('phase_items_per_second', 'Items processed per second of the phase.',
+              [(',phase="{}",item="{}"'.format(prometheus_label(name), prometheus_label(item)), n / phase.wall)
+               for (name, phase) in phases for (item, n) in phase.counts.items() if phase.wall > 0])
+        for (name, h) in self.histograms.items():
+            metric = 'atol_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+            lines.append('# TYPE {} histogram'.format(metric))
+            for (bound, n) in h.cumulative():
+                lines.append('{}_bucket{{program="{}",le="{}"}} {}'.format(metric, program, '+Inf' if bound == float('inf') else bound, n))
+            lines.append('{}_sum{{program="{}"}} {}'.format(metric, program, h.sum))
+            lines.append('{}_count{{program="{}"}} {}'.format(metric, program, h.count))
+        return '\n'.join(lines) + '\n'
+
+    # Written atomically, so a scraper never reads half a file.
+    def write(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), f, indent=1)
+                f.write('\n')
+        os.replace(tmp_path, path)
+
+
+# ru_maxrss is in kilobytes on Linux.
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Context manager of one run of a phase. Phases can nest: the peak
+# memory of a phase includes that of the phases inside it. Only the
+# outermost profiled phase is profiled, as cProfile cannot nest.
+class PhaseTimer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        if name not in metrics.phases:
+            metrics.phases[name] = Phase(name)
+        self.phase = metrics.phases[name]
+        self.profile = None
+
+    def __enter__(self):
+        m = self.metrics
+        if m.memory and tracemalloc.is_tracing():
+            if m.stack:
+                m.stack[-1][1][0] = max(m.stack[-1][1][0], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        # [peak memory of the phases inside this one]
+        m.stack.append((self.phase, [0]))
+        if m.profile_dir and not m.profiling:
+            if self.phase.profile is None:
+                self.phase.profile = cProfile.Profile()
+            self.profile = self.phase.profile
+            m.profiling = True
+            self.profile.enable()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        m = self.metrics
+        if self.profile is not None:
+            self.profile.disable()
+            m.profiling = False
+            self.profile.dump_stats(os.path.join(m.profile_dir, re.sub(r'[^\w.-]', '_', self.phase.name) + '.prof'))
+        (phase, inner_peak) = m.stack.pop()
+        phase.calls += 1
+        phase.wall += wall
+        phase.cpu += cpu
+        phase.max_rss = max_rss()
+        if m.memory and tracemalloc.is_tracing():
+            peak = max(inner_peak[0], tracemalloc.get_traced_memory()[1])
+            phase.peak_memory = max(phase.peak_memory or 0, peak)
+            if m.stack:
+                m.stack[-1][1][0] = max(m.stack[-1][1][0], peak)
+        return False
+
+
+# The metrics of this process.
+default = Metrics()
+
+
+def configure(program=None, memory=False, profile_dir=None):
+    default.configure(program, memory, profile_dir)
+
+
+def phase(name):
+    return default.phase(name)
+
+
+def count(name, n=1):
+    default.count(name, n)
+
+
+def observe(name, value):
+    default.observe(name, value)
+
+
+def write(path):
+    default.write(path)
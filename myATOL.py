@@ -54,18 +54,61 @@
 # Format of baseline label file:
 # Onion, Category[<comma-separated list of matching keywords>] 
 #
+# Train once and categorize new onions from the saved model:
+#   python myATOL.py -l train.labels -d WORD_GRP2 -k KeywordGroups.txt -i MASTER.Onion.Index.csv -t test.labels -s stopwords.txt -b weapons_outDead.txt -m "train" -o atol.model
+#   python myATOL.py -m "predict" -o atol.model -p NEW_WORD_GRP
+# The model file layout is described above SaveModel.
+#
+# Add -c STATE_FILE to "train" to train incrementally: only onions that
+# changed since the last run with the same state file are re-read (see
+# TrainIncremental).
+#
+# Sharded training (see TrainShard): "train" with --shards N splits the
+# word group files into N shards trained by a pool of processes. Across
+# machines sharing a filesystem, run each shard separately, then reduce:
+#   python myATOL.py ... -m "shard" --shards 4 --shard 0 --shard-dir SHARDS   (and 1, 2, 3)
+#   python myATOL.py ... -m "reduce" --shards 4 --shard-dir SHARDS -o atol.model
+#
+# Hyperparameter sweep (see LoadSweepCorpus): "sweep" reads the corpus
+# once and prints the accuracy of every combination of the --grid values,
+# computed by --workers processes:
+#   python myATOL.py ... -m "sweep" --grid kTitleMultiplier=5,10,20 --grid kMinDocSize=5,10
+#
+# Parsed word group files are cached in a .wordgrp.cache file in each
+# word group directory (see WordGrpCache), and described in a
+# .wordgrp.manifest file (see WordGrpManifest) used to skip files that
+# cannot contribute without reading them; --no-cache turns both off.
+#   python myATOL.py -m "manifest" -d WORD_GRP2
+# lists the files added, changed or removed since the last run.
+#
+# --metrics FILE writes the wall time, CPU time, memory and throughput
+# of every phase (see metrics.py) as JSON, or as Prometheus text if FILE
+# ends in .prom; --trace-memory adds the tracemalloc peak of each phase
+# (slow). --profile DIR writes cProfile stats of every phase to
+# DIR/<phase>.prof.
+#
 
 
-import getopt, glob, math, os, sys
+import getopt, glob, hashlib, io, itertools, json, os, shutil, struct, sys, tempfile, zlib
+from array import array
 from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
 
 from time import time
 
+import metrics
+import results
+
 kEpsilon = 0.0000000001  # Small number to add to denominator, to prevent /0.
 
 kMinKeywordLength = 3  # Prune out keywords with less than this lengh.
 kMinDocSize = 10  # Onions with less than this #unique words are ignored.
 kMaxVecSize = 50  # Max size of keyword vector
+kDedupThreshold = 0.8  # Min word set similarity of near-duplicate onions (-u, --dedup-threshold).
+kMinHashPerms = 128  # Hash functions per MinHash signature (-u).
+kMinHashSeed = 1  # Seed of the MinHash hash functions.
 
 # Multiplier weights, used to accumulate score in 'count' variable in
 # ProcessFilesInCategory function
@@ -75,34 +118,178 @@ kKeywordMultiplier = 100  # Scaling up factor for existing keywords.
 kPageMultiplier = 1  # Scaling up factor for pages
 kRatersMultiplier = 1.5  # Scaling up factor for human labels
 
+kTargets = ['DRUGS', 'HACKER', 'Weapons']  # Default targets of '-m evaluate' (--target).
+kDiscoveryThreshold = 0.5  # Min probability of the discovery lists.
+
+# Model file written by '-m train' and read by '-m predict'. Bump the
+# version whenever the layout changes.
+kModelMagic = b'ATOLMDL\0'
+kModelVersion = 1
+
 # Main driver function.
 def main(argv):
+    opts = ProcessArguments(argv)
+    metrics.configure('myATOL', memory=opts.trace_memory, profile_dir=opts.profile_dir)
+    if opts.results_file != None:
+        results.configure(opts.results_file, kResultColumns)
+    try:
+        RunMode(opts)
+    finally:
+        results.close()
+    if opts.metrics_file != None:
+        metrics.write(opts.metrics_file)
+
+
+# Runs the mode of opts (an Options).
+def RunMode(opts):
 
     t0 = time()
-    train_label_file, wordgrp_dir, keywords_file, index_file, test_label_file, stopwords_file, baseline_label_file, mode, dedup, practical_dir = ProcessArguments(argv)
-    (L, K, T, M, Mt, data, test, H, B) = CreateHashes(train_label_file,
-                                                      wordgrp_dir, 
-                                                      keywords_file,
-                                                      index_file,
-                                                      test_label_file,
-                                                      stopwords_file,
-                                                      baseline_label_file
-    )
+    train_label_file, wordgrp_dir, keywords_file, index_file, test_label_file, stopwords_file, baseline_label_file, mode, dedup, practical_dir, model_file, state_file = opts.Inputs()
+    (use_cache, quiet) = (opts.use_cache, opts.quiet)
+
+    # Predict only needs the model and the new onions, no training data.
+    if mode == 'predict':
+        with metrics.phase('load'):
+            (keywords, categories, constants) = LoadModel(model_file)
+            # Parse new onions the way the training data was parsed.
+            global kPageMultiplier
+            kPageMultiplier = constants['kPageMultiplier']
+            if not opts.stream:
+                practical_data = CreateData(practical_dir, use_cache=use_cache)
+        print(("\n Model & Dataset loading done in %0.3fs." % (time() - t0)))
+        print('\n\n==== Running PHASE 5 (Practical) ====')
+        print('\n\n==== PHASE 5: Categorizing from new onion website ====')
+        with metrics.phase('practical'):
+            if opts.stream:
+                StreamPracticalDiff(practical_dir, keywords, categories, chunk_size=opts.stream_chunk,
+                                    use_cache=use_cache, quiet=quiet)
+            else:
+                RunPracticalDiff(practical_data, keywords, categories, quiet=quiet)
+        return
+
+    # Only bring the manifests of the word group directories up to date.
+    if mode == 'manifest':
+        with metrics.phase('manifest'):
+            for directory in (wordgrp_dir, practical_dir):
+                if directory != None:
+                    UpdateManifest(directory, use_cache, quiet)
+        return
+
+    inputs = (train_label_file, wordgrp_dir, keywords_file, index_file, test_label_file, stopwords_file)
+
+    # A shard only writes its part of M (see TrainShard).
+    if mode == 'shard':
+        with metrics.phase('shard'):
+            TrainShard(inputs, opts.shard_index, opts.num_shards, opts.shard_dir, use_cache)
+        return
+
+    # Sharded training, or the reduce step of shards trained elsewhere.
+    if mode == 'reduce' or (mode == 'train' and opts.num_shards != None):
+        shard_dir = opts.shard_dir
+        if mode == 'train':
+            if shard_dir == None:
+                shard_dir = tempfile.mkdtemp(prefix='atol-shards-')
+            with metrics.phase('shards'):
+                RunShards(inputs, opts.num_shards, shard_dir, use_cache)
+        with metrics.phase('load'):
+            (L, test, K, S, T, H) = CreateTrainingInputs(inputs)
+        categories = sorted(set([item for sublist in list(L.values()) for item in sublist]))
+        print('\n\n==== Running PHASE 1 (Keywords) ====')
+        print('\n\n==== PHASE 1: New keyword list ====')
+        with metrics.phase('reduce'):
+            M = ReduceShards(shard_dir, opts.num_shards, ShardSettings(L, test, K, S, T, H))
+        if mode == 'train' and opts.shard_dir == None:
+            shutil.rmtree(shard_dir)
+        with metrics.phase('tficf'):
+            keywords = ComputeTFICF(M, M.T, K, categories, Lexicon(M.vocab, K, S), quiet)
+        print(("\n Sharded training done in %0.3fs." % (time() - t0)))
+        with metrics.phase('save_model'):
+            SaveModel(model_file, keywords, categories)
+        print('\n Model saved to ' + model_file)
+        return
+
+    # Accuracy of every setting of the grid, from one read of the corpus.
+    if mode == 'sweep':
+        with metrics.phase('load'):
+            (L, test, K, S, T, H) = CreateTrainingInputs(inputs)
+            configs = SweepConfigs(opts.sweep_grid)
+            corpus = LoadSweepCorpus(wordgrp_dir, L, T, K, S, H, test,
+                                     sorted(set(config['kMinDocSize'] for config in configs)), dedup,
+                                     opts.dedup_threshold, use_cache)
+        print(("\n Pre-processing & Dataset loading done in %0.3fs." % (time() - t0)))
+        t0 = time()
+        with metrics.phase('sweep'):
+            sweep_results = RunSweep(corpus, configs, opts.workers)
+        print(("\n Sweep of %d settings done in %0.3fs." % (len(configs), time() - t0)))
+        PrintSweepTable(configs, sweep_results)
+        return
+
+    # Discovery and practical without loading data (--stream): only M is
+    # built, then the onions are scored chunk by chunk.
+    if mode in ('discovery', 'practical') and opts.stream:
+        with metrics.phase('load'):
+            (L, test, K, S, T, H) = CreateTrainingInputs(inputs)
+            B = CreateB(baseline_label_file)
+            (M, Mt) = CreateM(wordgrp_dir, L, T, K, S, H, test, use_cache=use_cache)
+        categories = sorted(set([item for sublist in list(L.values()) for item in sublist]))
+        print('\n\n==== Running PHASE 1 (Keywords) ====')
+        print('\n\n==== PHASE 1: New keyword list ====')
+        print(("\n Pre-processing & Dataset loading done in %0.3fs." % (time() - t0)))
+        t0 = time()
+        with metrics.phase('tficf'):
+            keywords = ComputeTFICF(M, Mt, K, categories, Lexicon(M.vocab, K, S), quiet)
+        print(("\n TFICF Computation done in %0.3fs." % (time() - t0)))
+        del M, Mt
+        if mode == 'discovery':
+            print('\n\n==== Running PHASE 4 (Discovery) ====')
+            print('\n\n==== PHASE 4: From full data we find onions where Weapons has high probability ====')
+            with metrics.phase('discovery'):
+                StreamInferenceDiff(wordgrp_dir, B, keywords, categories, T, 'Weapons', 0.5, chunk_size=opts.stream_chunk,
+                                    use_cache=use_cache, quiet=quiet)
+        else:
+            print('\n\n==== Running PHASE 5 (Practical) ====')
+            print('\n\n==== PHASE 5: Categorizing from new onion website ====')
+            with metrics.phase('practical'):
+                StreamPracticalDiff(practical_dir, keywords, categories, chunk_size=opts.stream_chunk,
+                                    use_cache=use_cache, quiet=quiet)
+        return
+
+    # Incremental training only needs the label and index files, and the
+    # word group files that changed since the last run.
+    if mode == 'train' and state_file != None:
+        with metrics.phase('load'):
+            (L, test, K, S, T, H) = CreateTrainingInputs(inputs)
+        categories = sorted(set([item for sublist in list(L.values()) for item in sublist]))
+        print('\n\n==== Running PHASE 1 (Keywords) ====')
+        print('\n\n==== PHASE 1: New keyword list ====')
+        with metrics.phase('train'):
+            (M, keywords) = TrainIncremental(state_file, wordgrp_dir, L, T, K, S, H, test, categories, use_cache)
+            PrintFinalHash(keywords, quiet)
+            PrintTopNewKeywords(keywords, K, M, categories, Lexicon(M.vocab, K, S), quiet)
+        print(("\n Incremental training done in %0.3fs." % (time() - t0)))
+        with metrics.phase('save_model'):
+            SaveModel(model_file, keywords, categories)
+        print('\n Model saved to ' + model_file)
+        return
+
+    with metrics.phase('load'):
+        (L, K, T, M, Mt, data, test, H, B, lexicon) = CreateHashes(train_label_file,
+                                                                   wordgrp_dir, 
+                                                                   keywords_file,
+                                                                   index_file,
+                                                                   test_label_file,
+                                                                   stopwords_file,
+                                                                   baseline_label_file,
+                                                                   dedup,
+                                                                   opts.dedup_threshold,
+                                                                   use_cache
+        )
     if practical_dir != None:
-        practical_data = CreateData(practical_dir)
-
-    # Deduplicate if necessary.
-    if dedup:
-        print('\nDeduplicating data and test.')
-        print('Data size before deduplication: ' + str(len(list(data.keys()))))
-        data = DedupData(data, T)
-        print('Data size after deduplication: ' + str(len(list(data.keys()))))
-        print('Test size before deduplication: ' + str(len(list(test.keys()))))
-        test = DedupTest(test, T)
-        print('Test size after deduplication: ' + str(len(list(test.keys()))))
+        with metrics.phase('load_practical'):
+            practical_data = CreateData(practical_dir, data.vocab, use_cache)
 
     # Unique categories in labeled data.
-    categories = list(set([item for sublist in list(L.values()) for item in sublist]))
+    categories = sorted(set([item for sublist in list(L.values()) for item in sublist]))
 
     ##### Original data #####
 
@@ -113,21 +300,29 @@ def main(argv):
     K1 = TransformHashFormat(K)
     print(("\n Pre-processing & Dataset loading done in %0.3fs." % (time() - t0)))
     t0 = time()
-    keywords = ComputeTFICF(M, Mt, K, categories)
+    with metrics.phase('tficf'):
+        keywords = ComputeTFICF(M, Mt, K, categories, lexicon, quiet)
     print(("\n TFICF Computation done in %0.3fs." % (time() - t0)))
 
+    if mode == 'train':
+        with metrics.phase('save_model'):
+            SaveModel(model_file, keywords, categories)
+        print('\n Model saved to ' + model_file)
+
     ### Phase 2
     if mode == 'accuracy':
         print('\n\n==== Running PHASE 2 (Accuracy) ====')
         # Results with baseline keywords.
         print('\n\n==== PHASE 2: Probability estimates using baseline keyword list ====')
         t0 = time()
-        probs = RunInference(data, test, K1, list(M.keys()), T, 'baseline: ')
+        with metrics.phase('accuracy_baseline'):
+            probs = RunInference(data, test, K1, list(M.keys()), T, 'baseline: ', quiet=quiet)
         print(("\n Baseline running time: %0.3fs." % (time() - t0)))
         # Results with TFICF keywords.
         print('\n\n==== PHASE 2: Probability estimates using ATOL keyword list ====')
         t0 = time()
-        probs = RunInference(data, test, keywords, categories, T, 'atol: ')
+        with metrics.phase('accuracy_atol'):
+            probs = RunInference(data, test, keywords, categories, T, 'atol: ', quiet=quiet)
         print(("\n ATOL running time: %0.3fs." % (time() - t0)))
 
     ### Phase 3
@@ -135,67 +330,205 @@ def main(argv):
         print('\n\n==== Running PHASE 3 (Filtering) ====')
         # Results on subset of data labeled as DRUGS by original keywords.
         print('\n\n==== PHASE 3: Results on data subset labeled as DRUGS by baseline algorithm ====')
-        probsD = RunInferenceOnLabel(data, H, keywords, categories, T, 'DRUGS')
+        with metrics.phase('filtering_DRUGS'):
+            probsD = RunInferenceOnLabel(data, H, keywords, categories, T, 'DRUGS', quiet=quiet)
         # Results on subset of data labeled as HACKER by original keywords.
         print('\n\n==== PHASE 3: Results on data subset labeled as HACKER by baseline algorithm ====')
-        probsH = RunInferenceOnLabel(data, H, keywords, categories, T, 'HACKER')
+        with metrics.phase('filtering_HACKER'):
+            probsH = RunInferenceOnLabel(data, H, keywords, categories, T, 'HACKER', quiet=quiet)
         # Results on subset of data labeled as Weapons by original keywords.
         print('\n\n==== PHASE 3: Results on data subset labeled as Weapons by baseline algorithm ====')
-        probsW = RunInferenceOnLabel(data, H, keywords, categories, T, 'Weapons')
+        with metrics.phase('filtering_Weapons'):
+            probsW = RunInferenceOnLabel(data, H, keywords, categories, T, 'Weapons', quiet=quiet)
 
     ### Phase 4
     if mode == 'discovery':
         print('\n\n==== Running PHASE 4 (Discovery) ====')
         print('\n\n==== PHASE 4: From full data we find onions where Weapons has high probability ====')
-        probsW_all = RunInferenceDiff(data, B, keywords, categories, T, test, 'Weapons', 0.5)
+        with metrics.phase('discovery'):
+            probsW_all = RunInferenceDiff(data, B, keywords, categories, T, test, 'Weapons', 0.5, quiet=quiet)
+
+    ### Phases 2 to 4 for every keyword set and target at once
+    if mode == 'evaluate':
+        print('\n\n==== Running evaluation (Accuracy, Filtering, Discovery) ====')
+        keyword_sets = [('baseline', K1, list(M.keys())), ('atol', keywords, categories)]
+        for compare_model in opts.compare_models:
+            (compare_keywords, compare_categories, constants) = LoadModel(compare_model)
+            keyword_sets.append((compare_model, compare_keywords, compare_categories))
+        t0 = time()
+        with metrics.phase('evaluate'):
+            RunEvaluation(data, test, H, B, T, keyword_sets, opts.targets, kDiscoveryThreshold, quiet)
+        print(("\n Evaluation running time: %0.3fs." % (time() - t0)))
 
     if mode == 'practical':
         print('\n\n==== Running PHASE 5 (Practical) ====')
         print('\n\n==== PHASE 5: Categorizing from new onion website ====')
-        RunPracticalDiff(practical_data, keywords, categories)
+        with metrics.phase('practical'):
+            RunPracticalDiff(practical_data, keywords, categories, quiet=quiet)
 
 
 
-# Dedup data defaultdict.
-def DedupData(data, T):
-    dedup_data = defaultdict(lambda:defaultdict(int))
-    # Create transpose of title hash T.
-    Tt = {}
-    for (onion, title) in list(T.items()):
-        title_str = ' '.join(title)
-        if title_str in Tt:
-            Tt[title_str].append(onion)
+# Near-duplicate detection for -u. Every onion's set of words gets a
+# MinHash signature (kMinHashPerms hash functions, the smallest hash of
+# any of its words under each), whose share of equal entries between two
+# onions estimates the Jaccard similarity of their word sets. Signatures
+# are cut into bands (LSH); onions whose signatures agree on a whole band
+# are candidates, and candidates whose estimated similarity is at least
+# the threshold are put in the same cluster. Time is linear in the
+# number of word entries.
+#
+# Returns the clusters of more than one onion, each a list of onions in
+# data order. Onions without words are never clustered.
+def FindDuplicates(data, threshold=kDedupThreshold):
+    onions = [onion for onion in data.keys()]
+    lens = data.RowLengths(onions)
+    onions = [onion for (onion, n) in zip(onions, lens.tolist()) if n > 0]
+    if len(onions) < 2:
+        return []
+    sig = MinHashSignatures(data, onions)
+    (bands, rows) = LSHBands(threshold, kMinHashPerms)
+    rng = np.random.RandomState(kMinHashSeed + 1)
+    mult = rng.randint(1, 2**62, size=rows, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+    parent = list(range(len(onions)))
+
+    def Find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        cols = sig[:, band * rows:(band + 1) * rows]
+        # One key per onion for the band; keys that collide by accident
+        # are sorted out by the similarity check below.
+        key = (cols.astype(np.uint64) * mult).sum(axis=1)
+        perm = np.argsort(key, kind='stable')
+        key = key[perm]
+        first = np.ones(len(key), dtype=bool)
+        first[1:] = key[1:] != key[:-1]
+        group_first = perm[np.maximum.accumulate(np.where(first, np.arange(len(key)), 0))]
+        (members,) = np.nonzero(~first)
+        if len(members) == 0:
+            continue
+        members = perm[members]
+        leaders = group_first[np.nonzero(~first)[0]]
+        similar = (sig[members] == sig[leaders]).mean(axis=1) >= threshold
+        for (a, b) in zip(leaders[similar].tolist(), members[similar].tolist()):
+            (ra, rb) = (Find(a), Find(b))
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
+
+    clusters = defaultdict(list)
+    for i in range(len(onions)):
+        clusters[Find(i)].append(onions[i])
+    return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+
+# MinHash signatures of the word sets of 'onions' (all having words): a
+# len(onions) x kMinHashPerms uint32 array. Word ids are hashed with
+# seeded multiply-shift hash functions, after MixIds.
+def MinHashSignatures(data, onions):
+    rng = np.random.RandomState(kMinHashSeed)
+    a = rng.randint(1, 2**62, size=kMinHashPerms, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.randint(0, 2**62, size=kMinHashPerms, dtype=np.int64).astype(np.uint64)
+    (pos, ids, vals) = data.Entries(onions)
+    starts = np.flatnonzero(np.r_[True, pos[1:] != pos[:-1]])
+    ids = MixIds(ids)
+    sig = np.empty((len(onions), kMinHashPerms), dtype=np.uint32)
+    for k in range(kMinHashPerms):
+        h = ((ids * a[k] + b[k]) >> np.uint64(32)).astype(np.uint32)
+        sig[:, k] = np.minimum.reduceat(h, starts)
+    return sig
+
+
+# Word ids scrambled with the MurmurHash3 finalizer. Words are numbered
+# as they are first seen, so an onion's word ids are often runs of
+# consecutive numbers, and the minimum of a multiply-shift hash over
+# such runs is far from min-wise independent: signatures of similar
+# onions agree less often than their similarity.
+def MixIds(ids):
+    x = ids.astype(np.uint64)
+    x = (x ^ (x >> np.uint64(33))) * np.uint64(0xff51afd7ed558ccd)
+    x = (x ^ (x >> np.uint64(33))) * np.uint64(0xc4ceb9fe1a85ec53)
+    return x ^ (x >> np.uint64(33))
+
+
+# Number of bands and rows per band (bands * rows <= num_perm) that
+# best separate pairs above and below the threshold: the chance of pairs
+# less similar than the threshold becoming candidates, plus that of more
+# similar ones not becoming candidates, over all similarities, is
+# smallest. Missed pairs weigh 9 times more, as FindDuplicates checks
+# every candidate anyway.
+def LSHBands(threshold, num_perm):
+    steps = 100
+    below = (np.arange(steps) + 0.5) / steps * threshold
+    above = threshold + (np.arange(steps) + 0.5) / steps * (1 - threshold)
+    best = None
+    for rows in range(1, num_perm + 1):
+        for bands in range(1, num_perm // rows + 1):
+            false_pos = (1 - (1 - below ** rows) ** bands).mean() * threshold
+            false_neg = ((1 - above ** rows) ** bands).mean() * (1 - threshold)
+            error = 0.1 * false_pos + 0.9 * false_neg
+            if best is None or error < best[0]:
+                best = (error, bands, rows)
+    return (best[1], best[2])
+
+
+# Drops near-duplicate onions (-u) from data and test, keeping one onion
+# of each cluster (see DedupSurvivors). Returns (data, test, the onions
+# dropped).
+def Deduplicate(data, test, threshold=kDedupThreshold):
+    print('\nDeduplicating data and test.')
+    clusters = FindDuplicates(data, threshold)
+    print('Near-duplicate clusters: ' + str(len(clusters)) + ' (similarity >= ' + str(threshold) + ')')
+    print('Data size before deduplication: ' + str(len(list(data.keys()))))
+    test_size = len(list(test.keys()))
+    survivors = DedupSurvivors(data, clusters, test)
+    test = DedupTest(test, clusters, survivors)
+    data = DedupData(data, clusters, survivors)
+    print('Data size after deduplication: ' + str(len(list(data.keys()))))
+    print('Test size before deduplication: ' + str(test_size))
+    print('Test size after deduplication: ' + str(len(list(test.keys()))))
+    return (data, test, DedupDropped(clusters, survivors))
+
+
+# The onion kept of each cluster of near-duplicates, the same for data
+# and test: the first of the cluster's onions in test order if any is
+# in test, else the one with the most words (the first of them in data
+# order).
+def DedupSurvivors(data, clusters, test):
+    rank = dict((onion, i) for (i, onion) in enumerate(test))
+    survivors = []
+    for cluster in clusters:
+        in_test = [onion for onion in cluster if onion in rank]
+        if in_test:
+            survivors.append(min(in_test, key=rank.get))
         else:
-            Tt[title_str] = [onion]
-    # Create map of title to onion with largest word list.
-    Tmax = {}
-    for (title_str, onions) in list(Tt.items()):
-        selected_onion = 0
-        max_value = 0
-        for onion in onions:
-            if len(data[onion]) > max_value:
-                max_value = len(data[onion])
-                selected_onion = onion
-        Tmax[selected_onion] = title_str
-    for (onion, val) in list(data.items()):
-        if onion in Tmax:
-            dedup_data[onion] = val
-    return dedup_data
-
-
-# Dedup test hash.
-def DedupTest(test, T):
+            lens = data.RowLengths(cluster)
+            survivors.append(cluster[int(np.argmax(lens))])
+    return survivors
+
+
+# Onions of the clusters that are not kept (see DedupSurvivors).
+def DedupDropped(clusters, survivors):
+    drop = set()
+    for (cluster, keep) in zip(clusters, survivors):
+        drop.update(onion for onion in cluster if onion != keep)
+    return drop
+
+
+# Dedup data: of each cluster of near-duplicates keep its survivor.
+def DedupData(data, clusters, survivors):
+    drop = DedupDropped(clusters, survivors)
+    return data.Subset([onion for onion in data.keys() if onion not in drop])
+
+
+# Dedup test hash: of each cluster of near-duplicates keep its survivor.
+def DedupTest(test, clusters, survivors):
+    drop = DedupDropped(clusters, survivors)
     dedup_test = {}
-    testTt = {}
     for onion in list(test.keys()):
-        add_onion = True
-        if onion in T:
-            title_str = ' '.join(T[onion])
-            if title_str in testTt:
-                add_onion = False
-            else:
-                testTt[title_str] = onion
-        if add_onion:
+        if onion not in drop:
             dedup_test[onion] = test[onion]
     return dedup_test
 
@@ -218,24 +551,53 @@ def TransformHashFormat(K):
 #   2) T, mapping onion -> list of title words. (From index_file, limited to onions in train_label_file)
 #   3) K, mapping category -> list of keywords. (From keywords_file, limited to categories in train_label_file)
 #   4) M, mapping category x keyword -> count. (From words, train_label_file, T and K).
-#   5) Mt, Mt is the transpose of M. 
+#   5) Mt, Mt is the transpose of M (a view of M, not a copy).
 #   6) data, mapping onion x keyword -> count. (From words)
 #   7) test, mapping onion -> category list. (From test_label_file)
 #   8) H mapping onion -> category list. (From index_file)
 #   9) B mapping onion -> category list. (From baseline label file)
+# and the Lexicon of K and S over the vocabulary of data and M.
+#
+# With dedup (-u), near-duplicate onions are dropped from data and test
+# (see Deduplicate) before M is summed, so they do not count in M either.
+# use_cache: whether the word group cache is read and written (see
+# WordGrpCache), cleared by --no-cache.
 def CreateHashes(train_label_file, wordgrp_dir, keywords_file,
                  index_file, test_label_file, stopwords_file,
-                 baseline_label_file):
+                 baseline_label_file, dedup=False, dedup_threshold=kDedupThreshold, use_cache=True):
     L = CreateL(train_label_file)
     test = CreateL(test_label_file)
     K = CreateK(keywords_file, L)
-    data = CreateData(wordgrp_dir)
     S = CreateS(stopwords_file)
     T = CreateT(index_file, S)
     H = CreateH(index_file)
     B = CreateB(baseline_label_file)
-    (M, Mt) = CreateM(wordgrp_dir, L, T, K, S, H, test)
-    return (L, K, T, M, Mt, data, test, H, B)
+    # data, M and Mt are built in one pass over the word group files.
+    vocab = Vocabulary()
+    lexicon = Lexicon(vocab, K, S)
+    data = SparseHashBuilder(vocab)
+    pieces = CategoryContributions(wordgrp_dir, L, T, lexicon, H, test, data, use_cache)
+    data = data.Freeze()
+    drop = ()
+    if dedup:
+        with metrics.phase('dedup'):
+            (data, test, drop) = Deduplicate(data, test, dedup_threshold)
+    M = SumCategories(vocab, pieces, drop)
+    return (L, K, T, M, M.T, data, test, H, B, lexicon)
+
+
+# The hashes training needs besides the word groups, from inputs =
+# (train_label_file, wordgrp_dir, keywords_file, index_file,
+# test_label_file, stopwords_file). Returns (L, test, K, S, T, H).
+def CreateTrainingInputs(inputs):
+    (train_label_file, wordgrp_dir, keywords_file, index_file, test_label_file, stopwords_file) = inputs
+    L = CreateL(train_label_file)
+    test = CreateL(test_label_file)
+    K = CreateK(keywords_file, L)
+    S = CreateS(stopwords_file)
+    T = CreateT(index_file, S)
+    H = CreateH(index_file)
+    return (L, test, K, S, T, H)
 
 
 # Create Hash S mapping word -> 1.
@@ -413,6 +775,8 @@ def CreateK(keywords_file, L):
     #print 'Processing keywords file: ' + keywords_file
     f = open(keywords, 'r')
     lines = f.readlines()
+    # Categories of the labeled set.
+    L_cats = set([item for sublist in list(L.values()) for item in sublist])
     for line in lines:
         # Ignore comments.
         if line.startswith('#'):
@@ -422,9 +786,6 @@ def CreateK(keywords_file, L):
         tokens = stripped_line.split(',')
         cat_label = tokens[0]
         # Check if cat_label is in categories of labeled set, ignore if not.
-        # Flatten list, make items unique.
-        L_cats = list(set([item for sublist in list(L.values()) for item in sublist]))
-        # print 'Categories in L = ' + str(L_cats)
         if not cat_label in L_cats:
             # print 'Not processing category ' + cat_label + ', not in labeled data.'
             continue
@@ -444,50 +805,1011 @@ def CreateK(keywords_file, L):
     return K
 
 
-# Create Hash data mapping onion x keyword -> count.
-def CreateData(wordgrp_dir):
+# Compact storage for the 2d hashes (data: onion x word, M: category x
+# word). Nested defaultdicts cost one dict per onion, and Mt one per
+# word, which runs to gigabytes on large crawls. Instead words are
+# interned once in a Vocabulary, and each hash keeps all its rows in
+# three flat arrays (CSR): word ids sorted within each row for lookup,
+# the values, and the insertion order of the row so that iterating a
+# row gives keys in the same order the defaultdict did (ComputeTFICF
+# breaks ties on that order).
+#
+# Reading works as with the old hashes: hash.keys(), hash[key][word],
+# word in hash[key], len(hash[key]), hash[key].items(). A missing key
+# reads as an empty row, without being added.
+
+
+# Maps word <-> integer id, shared by all hashes built from one corpus.
+class Vocabulary(object):
+    def __init__(self):
+        self.ids = {}
+        self.words = []
+        self.lengths = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.words)
+
+    # Id of word, adding it if new.
+    def Id(self, word):
+        wid = self.ids.get(word)
+        if wid is None:
+            wid = len(self.words)
+            self.ids[word] = wid
+            self.words.append(word)
+        return wid
+
+    # Length of every word, indexed by id. Extended for words added
+    # since the last call.
+    def Lengths(self):
+        if len(self.lengths) < len(self.words):
+            new = self.words[len(self.lengths):]
+            self.lengths = np.concatenate((self.lengths, np.fromiter((len(w) for w in new), dtype=np.int32, count=len(new))))
+        return self.lengths
+
+
+# What the loaders and TFICF need to know about a word, compiled once
+# from the seed keywords K and stopwords S: frozensets for lookups by
+# word, and, per word id of vocab, whether it is a stopword and which
+# categories have it as a seed keyword (a words x categories bool
+# matrix), so whole rows of word ids are checked at once. The arrays
+# are extended as words are added to vocab.
+class Lexicon(object):
+    def __init__(self, vocab, K, S):
+        self.vocab = vocab
+        self.categories = list(K.keys())
+        self.cat_index = dict((cat, c) for (c, cat) in enumerate(self.categories))
+        self.keywords = dict((cat, frozenset(K[cat])) for cat in self.categories)
+        self.all_keywords = frozenset().union(*self.keywords.values())
+        self.stopwords = frozenset(S)
+        # Seed keyword -> column of every category having it.
+        self.keyword_cats = defaultdict(list)
+        for cat in self.categories:
+            for word in self.keywords[cat]:
+                self.keyword_cats[word].append(self.cat_index[cat])
+        self.size = 0
+        self.stopword = np.zeros(0, dtype=bool)
+        self.keyword = np.zeros((0, len(self.categories)), dtype=bool)
+
+    # Extend the arrays to the words added to vocab since the last call.
+    def Sync(self):
+        n = len(self.vocab)
+        if n == self.size:
+            return
+        if n > len(self.stopword):
+            capacity = max(n, 2 * len(self.stopword), 1024)
+            stopword = np.zeros(capacity, dtype=bool)
+            stopword[:self.size] = self.stopword[:self.size]
+            keyword = np.zeros((capacity, len(self.categories)), dtype=bool)
+            keyword[:self.size] = self.keyword[:self.size]
+            (self.stopword, self.keyword) = (stopword, keyword)
+        (stopwords, keyword_cats) = (self.stopwords, self.keyword_cats)
+        for (wid, word) in enumerate(self.vocab.words[self.size:n], self.size):
+            if word in stopwords:
+                self.stopword[wid] = True
+            if word in keyword_cats:
+                self.keyword[wid, keyword_cats[word]] = True
+        self.size = n
+
+    # Bool arrays over ids (word ids of vocab).
+    def IsStopword(self, ids):
+        self.Sync()
+        return self.stopword[ids]
+
+    def IsKeyword(self, ids, cat):
+        self.Sync()
+        if cat not in self.cat_index:
+            return np.zeros(len(ids), dtype=bool)
+        return self.keyword[ids, self.cat_index[cat]]
+
+
+# Read-only view of one row of a SparseHash, used like the inner dict
+# of the old defaultdict hashes.
+class SparseRow(object):
+    def __init__(self, vocab, ids, vals, order):
+        self.vocab = vocab
+        self.sorted_ids = ids
+        self.sorted_vals = vals
+        self.order = order
+
+    def _Find(self, word):
+        wid = self.vocab.ids.get(word)
+        if wid is None:
+            return -1
+        i = self.sorted_ids.searchsorted(wid)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == wid:
+            return i
+        return -1
+
+    def __len__(self):
+        return len(self.sorted_ids)
+
+    def __contains__(self, word):
+        return self._Find(word) >= 0
+
+    # Reads 0 for a missing word, as defaultdict(int) did.
+    def __getitem__(self, word):
+        i = self._Find(word)
+        if i < 0:
+            return 0
+        return float(self.sorted_vals[i])
+
+    # Word ids and values, in insertion order.
+    def Ids(self):
+        return self.sorted_ids[self.order]
+
+    def Values(self):
+        return self.sorted_vals[self.order]
+
+    def keys(self):
+        words = self.vocab.words
+        return [words[wid] for wid in self.Ids().tolist()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def values(self):
+        return self.Values().tolist()
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+
+class SparseHash(object):
+    # starts/ends give the slice of indices/values/order holding each
+    # row, so a subset of rows can share the arrays (see Subset).
+    def __init__(self, vocab, keys, starts, ends, indices, values, order):
+        self.vocab = vocab
+        self.row_keys = keys
+        self.rows = dict((key, i) for (i, key) in enumerate(keys))
+        self.starts = starts
+        self.ends = ends
+        self.indices = indices
+        self.values_ = values
+        self.order = order
+        self.column_counts = None
+
+    # Build from a (small) nested dict hash, such as the M accumulated
+    # by ProcessFilesInCategory.
+    @staticmethod
+    def FromHash(hsh, vocab):
+        builder = SparseHashBuilder(vocab)
+        for (key, row) in list(hsh.items()):
+            builder.AddRow(key, list(row.items()))
+        return builder.Freeze()
+
+    # Build from rows given as (word ids, values) arrays in insertion
+    # order, one per key.
+    @staticmethod
+    def FromRows(vocab, keys, rows):
+        lens = np.array([len(ids) for (ids, vals) in rows], dtype=np.int64)
+        ends = np.cumsum(lens)
+        starts = ends - lens
+        indices = []
+        values = []
+        order = []
+        for (ids, vals) in rows:
+            perm = np.argsort(ids, kind='stable')
+            indices.append(ids[perm])
+            values.append(vals[perm])
+            order.append(np.argsort(perm))
+        if len(rows) == 0:
+            return SparseHash(vocab, [], starts, ends, np.zeros(0, dtype=np.int32), np.zeros(0), np.zeros(0, dtype=np.int32))
+        return SparseHash(vocab, list(keys), starts, ends,
+                          np.concatenate(indices).astype(np.int32),
+                          np.concatenate(values).astype(np.float64),
+                          np.concatenate(order).astype(np.int32))
+
+    def __len__(self):
+        return len(self.row_keys)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def keys(self):
+        return list(self.row_keys)
+
+    def __iter__(self):
+        return iter(self.row_keys)
+
+    def __getitem__(self, key):
+        i = self.rows.get(key)
+        if i is None:
+            return SparseRow(self.vocab, self.indices[0:0], self.values_[0:0], self.order[0:0])
+        s = self.starts[i]
+        e = self.ends[i]
+        return SparseRow(self.vocab, self.indices[s:e], self.values_[s:e], self.order[s:e])
+
+    def items(self):
+        return [(key, self[key]) for key in self.row_keys]
+
+    def values(self):
+        return [self[key] for key in self.row_keys]
+
+    # Number of words in the row of each key (0 for missing keys).
+    def RowLengths(self, keys):
+        lens = np.zeros(len(keys), dtype=np.int64)
+        for (pos, key) in enumerate(keys):
+            i = self.rows.get(key)
+            if i is not None:
+                lens[pos] = self.ends[i] - self.starts[i]
+        return lens
+
+    # All entries of the rows of the given keys, as three arrays:
+    # position of the key in 'keys', word id and value.
+    def Entries(self, keys):
+        pos = np.array([p for (p, key) in enumerate(keys) if key in self.rows], dtype=np.int64)
+        rows = np.array([self.rows[keys[p]] for p in pos.tolist()], dtype=np.int64)
+        if len(rows) == 0:
+            return (pos, self.indices[0:0], self.values_[0:0])
+        lens = self.ends[rows] - self.starts[rows]
+        offsets = np.cumsum(lens) - lens
+        idx = np.arange(int(lens.sum())) - np.repeat(offsets, lens) + np.repeat(self.starts[rows], lens)
+        return (np.repeat(pos, lens), self.indices[idx], self.values_[idx])
+
+    # Number of rows each word id occurs in.
+    def ColumnCounts(self):
+        if self.column_counts is None:
+            used = np.zeros(len(self.indices), dtype=bool)
+            for (s, e) in zip(self.starts.tolist(), self.ends.tolist()):
+                used[s:e] = True
+            self.column_counts = np.bincount(self.indices[used], minlength=len(self.vocab))
+        return self.column_counts
+
+    # Hash with only the given keys, sharing this hash's arrays.
+    def Subset(self, keys):
+        keys = [key for key in keys if key in self.rows]
+        rows = np.array([self.rows[key] for key in keys], dtype=np.int64)
+        return SparseHash(self.vocab, keys, self.starts[rows], self.ends[rows],
+                          self.indices, self.values_, self.order)
+
+    # Transpose (word x key) view, e.g. Mt from M.
+    @property
+    def T(self):
+        return TransposeView(self)
+
+
+# Transpose of a SparseHash, computed on access rather than stored.
+# Mt[word] is a small dict key -> value.
+class TransposeView(object):
+    def __init__(self, hsh):
+        self.hsh = hsh
+
+    def keys(self):
+        words = self.hsh.vocab.words
+        return [words[wid] for wid in np.flatnonzero(self.hsh.ColumnCounts()).tolist()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.hsh.ColumnCounts()))
+
+    def __contains__(self, word):
+        wid = self.hsh.vocab.ids.get(word)
+        counts = self.hsh.ColumnCounts()
+        return wid is not None and wid < len(counts) and counts[wid] > 0
+
+    def __getitem__(self, word):
+        col = {}
+        for key in self.hsh.row_keys:
+            row = self.hsh[key]
+            if word in row:
+                col[key] = row[word]
+        return col
+
+    def items(self):
+        return [(word, self[word]) for word in self.keys()]
+
+
+# Collects rows for a SparseHash one at a time, e.g. one onion per word
+# group file, so that only the flat arrays grow while loading. Rows
+# added under an existing key are summed into it.
+class SparseHashBuilder(object):
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self.row_keys = []
+        self.rows = {}
+        # Entries are appended in segments, one per AddRow call.
+        self.segment_rows = array('l')
+        self.segment_lens = array('l')
+        self.entry_ids = array('i')
+        self.entry_vals = array('d')
+
+    def _Row(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.row_keys)
+            self.rows[key] = row
+            self.row_keys.append(key)
+        return row
+
+    # word_values: list of (word, value), added in that order.
+    def AddRow(self, key, word_values):
+        row = self._Row(key)
+        vocab_id = self.vocab.Id
+        n = len(self.entry_ids)
+        for (word, value) in word_values:
+            self.entry_ids.append(vocab_id(word))
+            self.entry_vals.append(value)
+        self.segment_rows.append(row)
+        self.segment_lens.append(len(self.entry_ids) - n)
+
+    # Same as AddRow, with the words given by their ids in self.vocab.
+    def AddRowIds(self, key, ids, values):
+        row = self._Row(key)
+        self.entry_ids.frombytes(np.asarray(ids, dtype=np.int32).tobytes())
+        self.entry_vals.frombytes(np.asarray(values, dtype=np.float64).tobytes())
+        self.segment_rows.append(row)
+        self.segment_lens.append(len(ids))
+
+    def Freeze(self):
+        rows = np.repeat(np.array(self.segment_rows, dtype=np.int64), np.array(self.segment_lens, dtype=np.int64))
+        ids = np.array(self.entry_ids, dtype=np.int32)
+        vals = np.array(self.entry_vals, dtype=np.float64)
+        # Sort entries by (row, word id); stable, so repeats of a word in
+        # a row stay in insertion order.
+        perm = np.lexsort((ids, rows))
+        rows = rows[perm]
+        ids = ids[perm]
+        vals = vals[perm]
+        first = perm
+        if len(ids) > 0:
+            new = np.ones(len(ids), dtype=bool)
+            new[1:] = (rows[1:] != rows[:-1]) | (ids[1:] != ids[:-1])
+            if not new.all():
+                # Sum repeated words left to right, as += did.
+                group = np.cumsum(new) - 1
+                summed = np.zeros(int(group[-1]) + 1)
+                for (g, v) in zip(group.tolist(), vals.tolist()):
+                    summed[g] += v
+                vals = summed
+                rows = rows[new]
+                ids = ids[new]
+                first = perm[new]
+        num_rows = len(self.row_keys)
+        lens = np.bincount(rows, minlength=num_rows)
+        ends = np.cumsum(lens)
+        starts = ends - lens
+        # Position (within its row) of the i-th inserted entry.
+        order = np.lexsort((first, rows)) - np.repeat(starts, lens)
+        return SparseHash(self.vocab, self.row_keys, starts, ends,
+                          ids, vals, order.astype(np.int32))
+
+
+# Create Hash data mapping onion x keyword -> count. Pass the vocab of
+# the training data to share word ids with it.
+def CreateData(wordgrp_dir, vocab=None, use_cache=True):
     # Create 2d hash data.
-    data = defaultdict(lambda:defaultdict(int))
-    data = ProcessFilesInDir(wordgrp_dir, data)
-    return data
+    if vocab is None:
+        vocab = Vocabulary()
+    data = SparseHashBuilder(vocab)
+    data = ProcessFilesInDir(wordgrp_dir, data, use_cache)
+    return data.Freeze()
+
+
+# Read a word group file. Returns the list of (word, count, pages) rows
+# in the file, its number of lines (for the kMinDocSize check) and the
+# sha1 of its content (see WordGrpManifest).
+def ReadWordGrpFile(filename):
+    f = open(filename, 'rb')
+    content = f.read()
+    f.close()
+    # Decoded as open(filename, 'r') would.
+    lines = io.TextIOWrapper(io.BytesIO(content)).readlines()
+    return (ParseWordGrpLines(lines), len(lines), hashlib.sha1(content).hexdigest())
+
+
+# Parse the lines of a word group into (word, count, pages) rows.
+def ParseWordGrpLines(lines):
+    rows = []
+    for line in lines:
+        # Ignore comments.
+        if line.startswith('#'):
+            continue
+        stripped_line = line.rstrip('\n')
+        tokens = stripped_line.split(',')
+        if '' in tokens:
+            continue
+        rows.append((tokens[0], int(tokens[1]), int(tokens[2])))
+    return rows
+
+
+# Cache of parsed word group files, kept in the word group directory
+# as kCacheFile (glob('*') skips dot files). It holds an interned
+# vocabulary and the (word id, count, pages) rows of every file as flat
+# arrays, so later runs map the arrays instead of parsing text. A
+# file's rows are used only while its mtime and size are unchanged;
+# other files are parsed again and the cache is rewritten.
+#
+# Cache file layout (all integers little-endian):
+#   kCacheMagic, uint32 version, uint32 header size,
+#   header: JSON with the number of words, the size of the word list
+#           and, per file name, [mtime_ns, size, num_lines, start, end],
+#   padding to a multiple of 8 bytes,
+#   words: the vocabulary in id order, utf-8, one per line,
+#   word ids (int32), counts (int64), pages (int64): rows of all files,
+#           a file's rows being [start, end) of each,
+# with each part padded to a multiple of 8 bytes.
+#
+# The cache and its manifest (WordGrpManifest, unless another is given)
+# are read and written only if persist is set; --no-cache clears it.
+kCacheMagic = b'ATOLWGC\0'
+kCacheVersion = 1
+kCacheFile = '.wordgrp.cache'
+kCacheBlock = 1 << 20  # Bytes of the word list read at once.
+
+
+# The rows of one word group file, as read through a WordGrpCache.
+# Iterating gives (word, count, pages) tuples like ReadWordGrpFile.
+class WordGrpRows(object):
+    def __init__(self, cache, ids, counts, pages):
+        self.cache = cache
+        self.ids = ids
+        self.counts = counts
+        self.pages = pages
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        words = self.cache.words
+        return zip([words[wid] for wid in self.ids.tolist()], self.counts.tolist(), self.pages.tolist())
+
+    # Ids of the words in vocab, adding new words in row order.
+    def VocabIds(self, vocab):
+        return self.cache.VocabIds(vocab, self.ids)
+
+
+# Reads the cache file written by WordGrpCache.Save. The word list is
+# read in blocks, each passed to take_words(words, first word id) in id
+# order, so a reader needing only some words does not hold all of them.
+# Returns (files, arrays): name -> (mtime_ns, size, num_lines, start,
+# end) and the (word ids, counts, pages) arrays, mapped.
+def ReadCacheFile(cache_file, take_words):
+    f = open(cache_file, 'rb')
+    try:
+        if f.read(len(kCacheMagic)) != kCacheMagic:
+            raise ValueError('not a word group cache')
+        (version, header_size) = struct.unpack('<II', f.read(8))
+        if version != kCacheVersion:
+            raise ValueError('cache version ' + str(version) + ', expected ' + str(kCacheVersion))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+        remaining = header['words_size']
+        partial = b''
+        wid = 0
+        while remaining > 0:
+            block = f.read(min(kCacheBlock, remaining))
+            if not block:
+                raise ValueError('truncated word list')
+            remaining -= len(block)
+            partial += block
+            # Words are cut at the last complete line of the block.
+            cut = partial.rfind(b'\n')
+            if remaining > 0 and cut >= 0:
+                words = partial[:cut].decode('utf-8').split('\n')
+                partial = partial[cut+1:]
+                take_words(words, wid)
+                wid += len(words)
+        if header['num_words']:
+            take_words(partial.decode('utf-8').split('\n'), wid)
+    finally:
+        f.close()
+    offset = len(kCacheMagic) + 8 + header_size + header['words_size'] + (-header['words_size'] % 8)
+    num_entries = header['num_entries']
+    arrays = []
+    for dtype in ('<i4', '<i8', '<i8'):
+        if num_entries:
+            # Plain ndarray views slice faster than np.memmap.
+            arrays.append(np.memmap(cache_file, dtype=dtype, mode='r', offset=offset, shape=(num_entries,)).view(np.ndarray))
+        else:
+            arrays.append(np.zeros(0, dtype=dtype))
+        offset += np.dtype(dtype).itemsize * num_entries
+        offset += -offset % 8
+    return (dict((name, tuple(entry)) for (name, entry) in header['files'].items()), tuple(arrays))
+
+
+# The cache entry of filename from files (see ReadCacheFile) if it is
+# still valid, i.e. the file's mtime and size are unchanged, else None.
+# Returns (os.stat of the file, entry), counting the file in the
+# metrics.
+def CacheEntry(files, filename):
+    st = os.stat(filename)
+    metrics.count('files')
+    metrics.count('bytes', st.st_size)
+    entry = files.get(os.path.basename(filename))
+    if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+        metrics.count('lines', entry[2])
+        return (st, entry)
+    return (st, None)
+
+
+# Parse a word group file into arrays: (word ids, counts, pages,
+# num_lines, sha1). word_id(word) gives the id of a word, or -1 to
+# leave its row out.
+def ReadWordGrpArrays(filename, word_id):
+    (rows, num_lines, digest) = ReadWordGrpFile(filename)
+    metrics.count('lines', num_lines)
+    metrics.count('files_parsed')
+    ids = np.array([word_id(word) for (word, count, pages) in rows], dtype=np.int32)
+    counts = np.array([count for (word, count, pages) in rows], dtype=np.int64)
+    pages = np.array([pages for (word, count, pages) in rows], dtype=np.int64)
+    keep = ids >= 0
+    if not keep.all():
+        (ids, counts, pages) = (ids[keep], counts[keep], pages[keep])
+    return (ids, counts, pages, num_lines, digest)
+
+
+class WordGrpCache(object):
+    def __init__(self, directory, persist=True, manifest=None):
+        self.cache_file = os.path.join(directory, kCacheFile)
+        self.persist = persist
+        self.words = []
+        self.word_ids = {}
+        # name -> (mtime_ns, size, num_lines, start, end) in the arrays.
+        self.files = {}
+        self.arrays = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        # name -> (mtime_ns, size, num_lines, ids, counts, pages) of files
+        # parsed in this run.
+        self.new_files = {}
+        # id(vocab) -> (vocab, cache word id -> vocab word id, -1 if none).
+        self.vocab_maps = {}
+        self.manifest = WordGrpManifest(directory, persist) if manifest is None else manifest
+        if self.persist and os.path.exists(self.cache_file):
+            try:
+                self.Load()
+            except (OSError, ValueError) as error:
+                print('Ignoring word group cache ' + self.cache_file + ': ' + str(error))
+
+    def Load(self):
+        words = []
+        (self.files, self.arrays) = ReadCacheFile(self.cache_file, lambda block, first: words.extend(block))
+        self.words = words
+        self.word_ids = dict((word, wid) for (wid, word) in enumerate(words))
+
+    def WordId(self, word):
+        wid = self.word_ids.get(word)
+        if wid is None:
+            wid = len(self.words)
+            self.word_ids[word] = wid
+            self.words.append(word)
+        return wid
+
+    # Returns (rows, num_lines) like ReadWordGrpFile, rows being a
+    # WordGrpRows.
+    def Read(self, filename):
+        (st, entry) = CacheEntry(self.files, filename)
+        if entry is not None:
+            (ids, counts, pages) = self.arrays
+            (start, end) = (entry[3], entry[4])
+            if self.manifest.Entry(filename, st) is None:
+                self.manifest.Record(filename, st, end - start, entry[2], self.manifest.Digest(filename, st))
+            return (WordGrpRows(self, ids[start:end], counts[start:end], pages[start:end]), entry[2])
+        (ids, counts, pages, num_lines, digest) = ReadWordGrpArrays(filename, self.WordId)
+        self.manifest.Record(filename, st, len(ids), num_lines, digest)
+        self.new_files[os.path.basename(filename)] = (st.st_mtime_ns, st.st_size, num_lines, ids, counts, pages)
+        return (WordGrpRows(self, ids, counts, pages), num_lines)
+
+    def VocabIds(self, vocab, ids):
+        (vocab, mapping) = self.vocab_maps.get(id(vocab), (vocab, np.zeros(0, dtype=np.int32)))
+        if len(mapping) < len(self.words):
+            mapping = np.concatenate((mapping, np.full(len(self.words) - len(mapping), -1, dtype=np.int32)))
+            self.vocab_maps[id(vocab)] = (vocab, mapping)
+        vocab_ids = mapping[ids]
+        missing = np.flatnonzero(vocab_ids < 0)
+        if len(missing) > 0:
+            words = self.words
+            vocab_id = vocab.Id
+            for wid in ids[missing].tolist():
+                mapping[wid] = vocab_id(words[wid])
+            vocab_ids = mapping[ids]
+        return vocab_ids
+
+    # Rewrite the cache file if files were parsed or are gone.
+    # filenames: the files now in the directory.
+    def Save(self, filenames):
+        self.manifest.Save(filenames)
+        if not self.persist:
+            return
+        names = [os.path.basename(filename) for filename in filenames]
+        if not self.new_files and len(names) == len(self.files) and all(name in self.files for name in names):
+            return
+        files = {}
+        pieces = []
+        num_entries = 0
+        for name in names:
+            if name in self.new_files:
+                (mtime, size, num_lines, ids, counts, pages) = self.new_files[name]
+            elif name in self.files:
+                (mtime, size, num_lines, start, end) = self.files[name]
+                (ids, counts, pages) = (a[start:end] for a in self.arrays)
+            else:
+                continue
+            files[name] = [mtime, size, num_lines, num_entries, num_entries + len(ids)]
+            pieces.append((ids, counts, pages))
+            num_entries += len(ids)
+        if pieces:
+            (ids, counts, pages) = (np.concatenate(a) for a in zip(*pieces))
+        else:
+            (ids, counts, pages) = self.arrays
+        # Keep only the words still used, in id order.
+        used = np.unique(ids)
+        new_id = np.zeros(len(self.words), dtype=np.int32)
+        new_id[used] = np.arange(len(used), dtype=np.int32)
+        ids = new_id[ids]
+        words = self.words
+        words = '\n'.join(words[wid] for wid in used.tolist()).encode('utf-8')
+        header = {'num_words': len(used), 'words_size': len(words), 'num_entries': num_entries, 'files': files}
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_bytes += b' ' * (-(len(kCacheMagic) + 8 + len(header_bytes)) % 8)
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            f = open(tmp_file, 'wb')
+            f.write(kCacheMagic)
+            f.write(struct.pack('<II', kCacheVersion, len(header_bytes)))
+            f.write(header_bytes)
+            for part in (words, ids.astype('<i4').tobytes(), counts.astype('<i8').tobytes(), pages.astype('<i8').tobytes()):
+                f.write(part)
+                f.write(b'\0' * (-len(part) % 8))
+            f.close()
+            os.replace(tmp_file, self.cache_file)
+        except OSError as error:
+            print('Could not write word group cache ' + self.cache_file + ': ' + str(error))
+
+
+# Manifest of a word group directory, kept next to the cache as
+# kManifestFile: per file name, [onion, number of rows (unique words),
+# number of lines, size, mtime_ns, sha1 of the content]. An entry is
+# valid while the file's size and mtime are unchanged, so loaders can
+# tell from a stat alone which files cannot contribute (see
+# ProcessFilesInCategory) and skip them without opening them. Every
+# file that is read is recorded; files whose mtime changed but whose
+# content hash did not (rewritten or touched) are not counted as
+# changed. The changes since the manifest was last written are in
+# added, changed, touched and (after Save) removed.
+kManifestFile = '.wordgrp.manifest'
+kManifestVersion = 1
+
+
+class WordGrpManifest(object):
+    def __init__(self, directory, persist=True):
+        self.manifest_file = os.path.join(directory, kManifestFile)
+        self.persist = persist
+        # name -> [onion, num_words, num_lines, size, mtime_ns, sha1].
+        self.files = {}
+        self.added = []
+        self.changed = []
+        self.touched = []
+        self.removed = []
+        self.dirty = False
+        if self.persist and os.path.exists(self.manifest_file):
+            try:
+                self.Load()
+            except (OSError, ValueError, KeyError) as error:
+                print('Ignoring word group manifest ' + self.manifest_file + ': ' + str(error))
+                self.files = {}
+
+    def Load(self):
+        f = open(self.manifest_file, 'r')
+        try:
+            manifest = json.load(f)
+        finally:
+            f.close()
+        if manifest['version'] != kManifestVersion:
+            raise ValueError('manifest version ' + str(manifest['version']) + ', expected ' + str(kManifestVersion))
+        self.files = manifest['files']
+
+    # The entry of filename if it is still valid for st (its os.stat),
+    # else None.
+    def Entry(self, filename, st=None):
+        entry = self.files.get(os.path.basename(filename))
+        if entry is None:
+            return None
+        if st is None:
+            st = os.stat(filename)
+        if entry[3] != st.st_size or entry[4] != st.st_mtime_ns:
+            return None
+        return entry
+
+    def Record(self, filename, st, num_words, num_lines, digest):
+        name = os.path.basename(filename)
+        entry = [DataOnionName(filename), num_words, num_lines, st.st_size, st.st_mtime_ns, digest]
+        old = self.files.get(name)
+        if old == entry:
+            return
+        if old is None:
+            self.added.append(name)
+            metrics.count('files_added')
+        elif old[5] != digest:
+            self.changed.append(name)
+            metrics.count('files_changed')
+        else:
+            self.touched.append(name)
+        self.files[name] = entry
+        self.dirty = True
+
+    # sha1 of the content of filename, read only if its entry is not
+    # valid. A file whose content is unchanged gets its entry back.
+    def Digest(self, filename, st):
+        entry = self.Entry(filename, st)
+        if entry is not None:
+            return entry[5]
+        f = open(filename, 'rb')
+        digest = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+        old = self.files.get(os.path.basename(filename))
+        if old is not None and old[5] == digest:
+            self.Record(filename, st, old[1], old[2], digest)
+        return digest
+
+    # Entries of files read for the first time or changed, without
+    # parsing those of files whose content did not change.
+    def Refresh(self, filenames):
+        for filename in filenames:
+            st = os.stat(filename)
+            if self.Entry(filename, st) is not None:
+                continue
+            self.Digest(filename, st)
+            if self.Entry(filename, st) is None:
+                (rows, num_lines, digest) = ReadWordGrpFile(filename)
+                self.Record(filename, st, len(rows), num_lines, digest)
+
+    # Rewrite the manifest file if entries were recorded or files are
+    # gone. filenames: the files now in the directory.
+    def Save(self, filenames):
+        names = set(os.path.basename(filename) for filename in filenames)
+        self.removed = sorted(name for name in self.files if name not in names)
+        if self.removed:
+            metrics.count('files_removed', len(self.removed))
+        if not self.persist or not (self.dirty or self.removed):
+            return
+        for name in self.removed:
+            del self.files[name]
+        tmp_file = self.manifest_file + '.tmp'
+        try:
+            f = open(tmp_file, 'w')
+            json.dump({'version': kManifestVersion, 'files': self.files}, f, sort_keys=True)
+            f.close()
+            os.replace(tmp_file, self.manifest_file)
+            self.dirty = False
+        except OSError as error:
+            print('Could not write word group manifest ' + self.manifest_file + ': ' + str(error))
+
+
+# Reads only the entries of some words (the keywords of a model) from
+# word group files, for streaming (see StreamData). Unchanged files are
+# read from the word group cache (WordGrpCache) when there is one, which
+# is mapped rather than loaded: of its word list only the ids of the
+# wanted words are kept. Other files are parsed. The cache is never
+# written.
+class KeywordReader(object):
+    def __init__(self, directory, vocab, use_cache=True):
+        self.vocab = vocab
+        self.cache_file = os.path.join(directory, kCacheFile)
+        # name -> (mtime_ns, size, num_lines, start, end) in the arrays.
+        self.files = {}
+        self.arrays = None
+        # Cache word ids of the words of vocab (sorted), and their ids
+        # in vocab.
+        self.cache_ids = np.zeros(0, dtype=np.int32)
+        self.vocab_ids = np.zeros(0, dtype=np.int32)
+        if use_cache and os.path.exists(self.cache_file):
+            try:
+                self.Load()
+            except (OSError, ValueError) as error:
+                print('Ignoring word group cache ' + self.cache_file + ': ' + str(error))
+                self.files = {}
+
+    # Of the word list, only the ids of the words of vocab are kept.
+    def Load(self):
+        vocab_ids = self.vocab.ids
+        found = []
+
+        def take_words(words, first):
+            for (i, word) in enumerate(words):
+                if word in vocab_ids:
+                    found.append((first + i, vocab_ids[word]))
+
+        (self.files, self.arrays) = ReadCacheFile(self.cache_file, take_words)
+        self.cache_ids = np.array([wid for (wid, vid) in found], dtype=np.int32)
+        self.vocab_ids = np.array([vid for (wid, vid) in found], dtype=np.int32)
+
+    # Returns (ids, values) of each file's entries of words of vocab, in
+    # file order, with the values of AddOnionToData. The entries of all
+    # files found in the cache are filtered at once.
+    def Read(self, filenames):
+        rows = [None] * len(filenames)
+        cached = []
+        vocab_ids = self.vocab.ids
+        for (i, filename) in enumerate(filenames):
+            (st, entry) = CacheEntry(self.files, filename)
+            if entry is not None:
+                cached.append((i, entry[3], entry[4]))
+                continue
+            (ids, counts, pages, num_lines, digest) = ReadWordGrpArrays(filename, lambda word: vocab_ids.get(word, -1))
+            rows[i] = (ids, counts + kPageMultiplier * np.sqrt(pages))
+        if cached:
+            (ids, counts, pages) = (np.concatenate([a[start:end] for (i, start, end) in cached]) for a in self.arrays)
+            lens = np.array([end - start for (i, start, end) in cached], dtype=np.int64)
+            pos = np.minimum(np.searchsorted(self.cache_ids, ids), max(len(self.cache_ids) - 1, 0))
+            keep = self.cache_ids[pos] == ids if len(self.cache_ids) else np.zeros(len(ids), dtype=bool)
+            # Kept entries of each file.
+            ends = np.concatenate(([0], np.cumsum(keep)))[np.cumsum(lens)]
+            starts = np.concatenate(([0], ends[:-1]))
+            ids = self.vocab_ids[pos[keep]]
+            values = counts[keep] + kPageMultiplier * np.sqrt(pages[keep])
+            for ((i, start, end), s, e) in zip(cached, starts.tolist(), ends.tolist()):
+                rows[i] = (ids[s:e], values[s:e])
+        return rows
+
+
+# Onion name used as key of 'data'. Cut at the first '.', where the
+# category loader cuts at the last one (see CategoryOnionName).
+def DataOnionName(filename):
+    return filename[filename.rfind('/')+1:filename.find('.')]
+
+
+# Onion name used when accumulating M.
+def CategoryOnionName(filename):
+    return filename[filename.rfind('/')+1:filename.rfind('.')]
+
+
+# Add the word counts of one onion to 'data' (a SparseHashBuilder).
+# rows: WordGrpRows.
+def AddOnionToData(data, onion, rows):
+    data.AddRowIds(onion, rows.VocabIds(data.vocab), rows.counts + kPageMultiplier * np.sqrt(rows.pages))
 
 
 # Process files in directory to create dataset hash 'data'.
-def ProcessFilesInDir(directory, data):
+def ProcessFilesInDir(directory, data, use_cache=True):
     # Read all filenames in directory.
     path = os.getcwd() + '/' + directory + '/*'
-    filenames = glob.glob(path)
-    counter = 0
+    filenames = sorted(glob.glob(path))
+    cache = WordGrpCache(directory, use_cache)
     #print 'Processing files for word lookup in dir: ' + str(path)
     for filename in filenames:
-        counter += 1
         # Get onion from filename
-        onion = filename[filename.rfind('/')+1:filename.find('.')]
+        onion = DataOnionName(filename)
         # print 'Extracted onion name: ' + onion
-        f = open(filename, 'r')
-        lines = f.readlines()
-        for line in lines:
-            # Ignore comments.
-            if line.startswith('#'):
-                continue
-            stripped_line = line.rstrip('\n')
-            tokens = stripped_line.split(',')
-            if '' in tokens:
-                continue
-            word = tokens[0]
-            count = int(tokens[1]) + kPageMultiplier * math.sqrt(int(tokens[2]))
-            # print 'Line: ' + stripped_line + ' --> word: ' + word + ', count: ' + count + ', category: ' + str(cat_list)
-            data[onion][word] += count
+        # Every onion is in data, but files without words need not be read.
+        entry = cache.manifest.Entry(filename)
+        if entry is not None and entry[1] == 0:
+            metrics.count('files_pruned')
+            data.AddRowIds(onion, np.zeros(0, dtype=np.int32), np.zeros(0))
+            continue
+        (rows, num_lines) = cache.Read(filename)
+        AddOnionToData(data, onion, rows)
+    cache.Save(filenames)
     return data
 
 
-# Create Hash M mapping category x keyword -> count.
-def CreateM(wordgrp_dir, L, T, K, S, H, tst):
-    # Create 2d hashes M and Mt (Mt is the transpose of M).
-    M = defaultdict(lambda:defaultdict(int))
-    Mt = defaultdict(lambda:defaultdict(int))
-    (M, Mt) = ProcessFilesInCategory(wordgrp_dir, L, T, K, M, Mt, S, H, tst)
-    return (M, Mt)
+# Create Hash M mapping category x keyword -> count. If 'data' is given
+# it is filled in the same pass over the files (see CreateData).
+def CreateM(wordgrp_dir, L, T, K, S, H, tst, data=None, vocab=None, lexicon=None, use_cache=True):
+    # Mt is the transpose view of M.
+    if vocab is None:
+        vocab = Vocabulary()
+    if lexicon is None:
+        lexicon = Lexicon(vocab, K, S)
+    M = ProcessFilesInCategory(wordgrp_dir, L, T, lexicon, H, tst, data, use_cache)
+    return (M, M.T)
+
+
+# Categories an onion counts towards in M: its labels from L if it is
+# labeled (cat_from_raters), else its original categories from the
+# index file. Returns None for labeled onions that are also in the test
+# set, which are kept out of M.
+def OnionCategories(onion, L, H, test):
+    if onion not in L:
+        # Getting original category list from index file.
+        if onion in H:
+            return (H[onion], False)
+        return ([], False)
+    if onion in test:
+        # print 'Onion ' + onion + ' is in intersection of training and test set.'
+        return None
+    return (L[onion], True)
+
+
+# What one onion adds to M, as a list of (category, word ids, counts)
+# in the order it is added, without empty ones. See
+# ProcessFilesInCategory for the algorithm. rows: WordGrpRows.
+def OnionContributions(onion, rows, num_lines, cat_list, cat_from_raters, T, lexicon):
+    contributions = []
+    if num_lines < kMinDocSize:
+        return contributions
+    ids = rows.VocabIds(lexicon.vocab)
+    # Ignore stop words from kw list.
+    keep = ~lexicon.IsStopword(ids)
+    ids = ids[keep]
+    count = rows.counts[keep].astype(np.float64)
+
+    # Step 1. The multipliers carry over from one category of the onion
+    # to the next.
+    if len(cat_list) > 0:
+        count = count / len(cat_list)
+    for cat in cat_list:
+        count = np.where(lexicon.IsKeyword(ids, cat), count * kKeywordMultiplier, count)
+        if cat_from_raters:
+            count = count * kRatersMultiplier
+        contributions.append((cat, ids, count))
+
+    # Step 2.
+    if onion in T:
+        vocab_id = lexicon.vocab.Id
+        title_ids = np.array([vocab_id(title_word) for title_word in T[onion]], dtype=np.int32)
+        for cat in cat_list:
+            contributions.append((cat, title_ids, np.full(len(title_ids), float(kTitleMultiplier))))
+    return [(cat, ids, count) for (cat, ids, count) in contributions if len(ids) > 0]
+
+
+# OnionContributions split into the parts the multipliers scale, for
+# the sweep (see LoadSweepCorpus): every contribution of a category is
+# base * kKeywordMultiplier**hits * kRatersMultiplier**raters, or
+# kTitleMultiplier per title word. Returns (kw, title), with kw a list
+# of (cat, ids, base, hits, raters) and title a list of (cat, ids), in
+# the order OnionContributions adds them. The kMinDocSize check is left
+# to the caller.
+def OnionComponents(onion, rows, cat_list, cat_from_raters, T, lexicon):
+    kw = []
+    title = []
+    ids = rows.VocabIds(lexicon.vocab)
+    keep = ~lexicon.IsStopword(ids)
+    ids = ids[keep]
+    base = rows.counts[keep].astype(np.float64)
+    if len(cat_list) > 0:
+        base = base / len(cat_list)
+    hits = np.zeros(len(ids), dtype=np.int64)
+    for (j, cat) in enumerate(cat_list):
+        hits = hits + lexicon.IsKeyword(ids, cat)
+        kw.append((cat, ids, base, hits, j + 1 if cat_from_raters else 0))
+    if onion in T:
+        vocab_id = lexicon.vocab.Id
+        title_ids = np.array([vocab_id(title_word) for title_word in T[onion]], dtype=np.int32)
+        for cat in cat_list:
+            title.append((cat, title_ids))
+    return (kw, title)
+
+
+# Sums the counts of each word id, as adding them one by one to a
+# defaultdict would: word ids in order of first appearance, counts
+# added left to right. Returns (word ids, sums).
+def SumContributions(ids, counts):
+    (unique_ids, first, inverse) = np.unique(ids, return_index=True, return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=counts, minlength=len(unique_ids))
+    order = np.argsort(first, kind='stable')
+    return (unique_ids[order].astype(np.int32), sums[order])
+
+
+# Update the manifest of directory and print the files added, changed
+# (content), removed and touched (mtime only) since it was last written.
+def UpdateManifest(directory, use_cache=True, quiet=False):
+    path = os.getcwd() + '/' + directory + '/*'
+    filenames = sorted(glob.glob(path))
+    manifest = WordGrpManifest(directory, use_cache)
+    manifest.Refresh(filenames)
+    manifest.Save(filenames)
+    print('Manifest of ' + directory + ': ' + str(len(filenames)) + ' files, ' + str(len(manifest.added)) + ' added, '
+          + str(len(manifest.changed)) + ' changed, ' + str(len(manifest.removed)) + ' removed, '
+          + str(len(manifest.touched)) + ' touched.')
+    if quiet:
+        return
+    for (change, names) in (('added', manifest.added), ('changed', manifest.changed),
+                            ('removed', manifest.removed), ('touched', manifest.touched)):
+        for name in names:
+            print('  ' + change + ': ' + name)
+
+
+# Whether a file can add to M, from its categories (OnionCategories)
+# and, if the manifest knows the file, its number of lines: files that
+# cannot are skipped without being read.
+def Contributes(filename, categories, manifest):
+    if categories is None or len(categories[0]) == 0:
+        return False
+    entry = manifest.Entry(filename)
+    if entry is not None and entry[2] < kMinDocSize:
+        metrics.count('files_pruned')
+        return False
+    return True
 
 
 # Process files in directory to create 2d hash M. Algorithm:
@@ -496,87 +1818,66 @@ def CreateM(wordgrp_dir, L, T, K, S, H, tst):
 #       1b. If W is a keyword for C, multiply count M[C][W] by kKeywordMultiplier.
 # 2. For each word W in title of O with category C:
 #       2a. Add kTitleMultiplier to existing count of M[C][W].
-def ProcessFilesInCategory(directory, L, T, K, M, Mt, S, H, test):
+#
+# The contributions of every onion are collected per category and
+# summed once all files are read (see CategoryContributions and
+# SumCategories).
+#
+# If 'data' (a SparseHashBuilder) is given, every file is also added to
+# it (as ProcessFilesInDir does), so each file is read and parsed only
+# once.
+def ProcessFilesInCategory(directory, L, T, lexicon, H, test, data=None, use_cache=True):
+    return SumCategories(lexicon.vocab, CategoryContributions(directory, L, T, lexicon, H, test, data, use_cache))
+
+
+# The contributions to M of the files in directory: category -> list of
+# (position, onion, word ids, counts), categories in the order of their
+# first contribution. position orders the contributions of all files;
+# onion is the data name of the file (DataOnionName), so that
+# SumCategories can leave out onions dropped from data.
+def CategoryContributions(directory, L, T, lexicon, H, test, data=None, use_cache=True):
     # Read all filenames in directory.
     path = os.getcwd() + '/' + directory + '/*'
-    filenames = glob.glob(path)
-    counter = 0
+    filenames = sorted(glob.glob(path))
+    cache = WordGrpCache(directory, use_cache)
+    pieces = {}
     #print 'Processing files for category lookup in dir: ' + str(path)
-    commonOnions = []
-    for filename in filenames:
-        counter += 1
+    for (file_index, filename) in enumerate(filenames):
         # Get onion from filename
-        onion = filename[filename.rfind('/')+1:filename.rfind('.')]
+        onion = CategoryOnionName(filename)
         # print 'Extracted onion name: ' + onion
-        
+
         # If this onion is not in Label set, ignore if not.
-        cat_list = []
-        cat_from_raters = False
-        if onion not in L:
-            # Getting original category list from index file.
-            if onion in H:
-                cat_list = H[onion]
-        else:
-            if onion in test:
-                # print 'Onion ' + onion + ' is in intersection of training and test set.'
-                commonOnions.append(onion)
-                continue
-            cat_list = L[onion]
-            cat_from_raters = True
-#            print 'Reading filename #' + str(counter) + ': '  + filename 
-#            print 'Processing onion: ' + onion + ', in labeled set with categories: ' + str(cat_list)
-
-        f = open(filename, 'r')
-        lines = f.readlines()
-        if len(lines) < kMinDocSize:
+        categories = OnionCategories(onion, L, H, test)
+        if data is None and not Contributes(filename, categories, cache.manifest):
             continue
-        else: 
-            for line in lines:
-                # Ignore comments.
-                if line.startswith('#'):
-                    continue
-                stripped_line = line.rstrip('\n')
-                tokens = stripped_line.split(',')
-                if '' in tokens:
-                    continue
-                word = tokens[0]
-                # Ignore stop words from kw list.
-                if word in S:
-                    continue
-                count = int(tokens[1])
-                # print 'Line: ' + stripped_line + ' --> word: ' + word + ', count: ' + count + ', category: ' + str(cat_list)
-
-                # Step 1.
-                if len(cat_list) > 0:
-                    count = float(count) / len(cat_list)
-                for cat in cat_list:
-                    if cat in K and word in K[cat]:
-                        count  *= kKeywordMultiplier
-                    if cat_from_raters:
-                        count *= kRatersMultiplier
-                    M[cat][word]  += count
-                    Mt[word][cat] += count
-
-        # Step 2.
-        if onion not in T:
-#            print 'Onion: ' + onion + ' not a key in T_hash'
+        (rows, num_lines) = cache.Read(filename)
+        if data is not None:
+            AddOnionToData(data, DataOnionName(filename), rows)
+        if categories is None:
             continue
-        for title_word in T[onion]:
-            for cat in cat_list:
-                M[cat][title_word]  += kTitleMultiplier
-                Mt[title_word][cat] += kTitleMultiplier            
-
-    commonCatCount = {}
-    for onion in commonOnions:
-        cat = L[onion]
-        if cat[0] in commonCatCount:
-            commonCatCount[cat[0]] += 1
-        else:
-            commonCatCount[cat[0]] = 1
-#    print 'commonCatCount = ' + str(commonCatCount)
-#    print '\n===== Hash M =====\n'
-    # print str(M)
-    return (M, Mt)
+        (cat_list, cat_from_raters) = categories
+#        print 'Processing onion: ' + onion + ', in labeled set with categories: ' + str(cat_list)
+        contributions = OnionContributions(onion, rows, num_lines, cat_list, cat_from_raters, T, lexicon)
+        for (i, (cat, ids, counts)) in enumerate(contributions):
+            pieces.setdefault(cat, []).append(((file_index, i), DataOnionName(filename), ids, counts))
+    cache.Save(filenames)
+    return pieces
+
+
+# M from the contributions of CategoryContributions, without those of
+# the onions in 'drop': the same M as if their files were not there.
+def SumCategories(vocab, pieces, drop=()):
+    firsts = []
+    for cat in pieces:
+        kept = [piece for piece in pieces[cat] if piece[1] not in drop]
+        if kept:
+            firsts.append((kept[0][0], cat, kept))
+    firsts.sort(key=lambda x: x[0])
+    return SparseHash.FromRows(vocab, [cat for (first, cat, kept) in firsts],
+                               [SumContributions(np.concatenate([ids for (position, onion, ids, counts) in kept]),
+                                                 np.concatenate([counts for (position, onion, ids, counts) in kept]))
+                                for (first, cat, kept) in firsts])
 
 
 # This function computes the TFICF of the keywords in each category.
@@ -585,33 +1886,608 @@ def ProcessFilesInCategory(directory, L, T, K, M, Mt, S, H, test):
 # (ICF) of each keyword j in category i. For each category i, it sorts
 # the keywords using TF*ICF and outputs the resulting vector of
 # category keywords with TFICF weights.
-def ComputeTFICF(M, Mt, K, categories):
-    ICF = {}
-    all_cat = len(list(M.keys()))
-    for key in list(Mt.keys()):
-        key_cat = len(Mt[key])
-        key_tficf = (all_cat + kEpsilon)/(key_cat + kEpsilon)
-        ICF[key] = key_tficf
+def ComputeTFICF(M, Mt, K, categories, lexicon=None, quiet=False):
+    if lexicon is None:
+        lexicon = Lexicon(M.vocab, K, {})
+    ICF = ComputeICF(M)
     cat_tficf = {}
     for cat in categories:
-        kw_hash = M[cat]
-        lst = []
-        for kw in list(kw_hash.keys()):
-            icf = ICF[kw]
-            tf  = kw_hash[kw]
-            # print 'tf = ' + str(tf) + ', icf = ' + str(icf)
-            tficf = math.sqrt(tf * icf)
-            lst.append((kw, tficf))
-        sorted_lst = sorted(lst, key=lambda x: x[1], reverse=True)
-        # Remove keywords having string length<= kMinKeywordLength.
-        pruned_lst = [x for x in sorted_lst if len(x[0]) > kMinKeywordLength]
-        cat_tficf[cat] = pruned_lst[0:kMaxVecSize]
+        cat_tficf[cat] = CategoryTFICF(M, cat, ICF)
     # cat_tficf = PostProcessHash(cat_tficf)
-    PrintFinalHash(cat_tficf)
-    PrintTopNewKeywords(cat_tficf, K, M, categories)
+    PrintFinalHash(cat_tficf, quiet)
+    PrintTopNewKeywords(cat_tficf, K, M, categories, lexicon, quiet)
     return cat_tficf
 
 
+# ICF of every word id: #categories / #categories having the word.
+def ComputeICF(M):
+    all_cat = len(list(M.keys()))
+    # Number of categories each word is in, i.e. len(Mt[word]).
+    key_cat = M.ColumnCounts()
+    return (all_cat + kEpsilon)/(key_cat + kEpsilon)
+
+
+# Top kMaxVecSize (or max_vec_size) (keyword, TFICF) of one category,
+# highest first. Short keywords are dropped before selecting, and only
+# the candidates at or above the kMaxVecSize-th value get sorted. Equal
+# values keep the order the keywords were added to M, as the stable sort
+# over the whole row used to.
+def CategoryTFICF(M, cat, ICF, max_vec_size=None):
+    if max_vec_size is None:
+        max_vec_size = kMaxVecSize
+    kw_hash = M[cat]
+    ids = kw_hash.Ids()
+    # Remove keywords having string length<= kMinKeywordLength.
+    pos = np.flatnonzero(M.vocab.Lengths()[ids] > kMinKeywordLength)
+    tficf = np.sqrt(kw_hash.Values()[pos] * ICF[ids[pos]])
+    if len(pos) > max_vec_size:
+        kth = -np.partition(-tficf, max_vec_size - 1)[max_vec_size - 1]
+        keep = np.flatnonzero(tficf >= kth)
+        pos = pos[keep]
+        tficf = tficf[keep]
+    top = np.lexsort((pos, -tficf))[:max_vec_size]
+    words = M.vocab.words
+    return [(words[wid], value) for (wid, value) in zip(ids[pos[top]].tolist(), tficf[top].tolist())]
+
+
+# Incremental training ('-m train -c STATE_FILE').
+#
+# The state file keeps, for every file of the word group directory, what
+# its onion added to M (OnionContributions, in order) together with what
+# that was computed from: the file's mtime and size, the onion's
+# categories and its title words. It also keeps the resulting M and
+# keyword lists. The next run re-reads only files that are new or
+# changed, or whose onion's labels or title changed. M rows are rebuilt
+# only for categories those onions add to, and keyword lists are
+# recomputed only for categories whose M row, or the ICF of one of
+# whose words, changed.
+#
+# Rows are rebuilt by adding up the contributions of all onions, in
+# file order, exactly as ProcessFilesInCategory does, so the result is
+# the same as a full retrain. A change to the keywords file, the
+# stopwords or any constant means a full retrain.
+kStateVersion = 1
+
+
+# Fingerprint of the inputs every onion's contributions depend on.
+def TrainingSettings(K, S):
+    settings = {'constants': ModelConstants(), 'K': K, 'S': sorted(S.keys())}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def LoadTrainingState(state_file):
+    arrays = np.load(state_file, allow_pickle=False)
+    meta = json.loads(arrays['meta'].tobytes().decode('utf-8'))
+    if meta['version'] != kStateVersion:
+        raise ValueError(state_file + ' has state version ' + str(meta['version']) + ', expected ' + str(kStateVersion))
+    vocab = Vocabulary()
+    for word in meta['words']:
+        vocab.Id(word)
+    M = SparseHash(vocab, meta['M_keys'], arrays['M_starts'], arrays['M_ends'],
+                   arrays['M_indices'], arrays['M_values'], arrays['M_order'])
+    keywords = dict((cat, [tuple(x) for x in lst]) for (cat, lst) in list(meta['keywords'].items()))
+    return {'settings': meta['settings'], 'vocab': vocab, 'cat_names': meta['cat_names'],
+            'files': meta['files'], 'cat_ids': arrays['cat_ids'], 'word_ids': arrays['word_ids'],
+            'values': arrays['values'], 'M': M, 'keywords': keywords}
+
+
+# Written to a temp file and renamed, so an interrupted run leaves the
+# previous state intact.
+def SaveTrainingState(state_file, state):
+    M = state['M']
+    meta = {'version': kStateVersion, 'settings': state['settings'],
+            'words': state['vocab'].words, 'cat_names': state['cat_names'],
+            'files': state['files'], 'M_keys': M.keys(), 'keywords': state['keywords']}
+    tmp_file = state_file + '.tmp'
+    f = open(tmp_file, 'wb')
+    np.savez(f, meta=np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8),
+             cat_ids=state['cat_ids'], word_ids=state['word_ids'], values=state['values'],
+             M_starts=M.starts, M_ends=M.ends, M_indices=M.indices, M_values=M.values_, M_order=M.order)
+    f.close()
+    os.replace(tmp_file, state_file)
+
+
+# Train from state_file, updating it for the current word group
+# directory and labels. Returns (M, keywords) as a full retrain would
+# (CreateM and ComputeTFICF).
+def TrainIncremental(state_file, wordgrp_dir, L, T, K, S, H, test, categories, use_cache=True):
+    settings = TrainingSettings(K, S)
+    state = None
+    if os.path.exists(state_file):
+        state = LoadTrainingState(state_file)
+        if state['settings'] != settings:
+            print('Keywords, stopwords or constants changed, retraining from scratch.')
+            state = None
+    if state is None:
+        vocab = Vocabulary()
+        state = {'vocab': vocab, 'cat_names': [], 'files': {},
+                 'cat_ids': np.zeros(0, dtype=np.int32), 'word_ids': np.zeros(0, dtype=np.int32),
+                 'values': np.zeros(0), 'M': SparseHash.FromRows(vocab, [], []), 'keywords': {}}
+    vocab = state['vocab']
+    lexicon = Lexicon(vocab, K, S)
+    # Word group files are parsed, not cached: only changed ones are read.
+    cache = WordGrpCache(wordgrp_dir, persist=False, manifest=WordGrpManifest(wordgrp_dir, use_cache))
+    cat_names = list(state['cat_names'])
+    cat_index = dict((cat, i) for (i, cat) in enumerate(cat_names))
+    old_files = state['files']
+
+    # Contributions of every file, in file order: either a slice of the
+    # old arrays, or new arrays for files that are re-read.
+    files = {}
+    pieces = []
+    offset = 0
+    changed_cats = set()
+    num_read = 0
+    path = os.getcwd() + '/' + wordgrp_dir + '/*'
+    filenames = sorted(glob.glob(path))
+    manifest = cache.manifest
+    for filename in filenames:
+        name = os.path.basename(filename)
+        onion = CategoryOnionName(filename)
+        categories_ = OnionCategories(onion, L, H, test)
+        sig = None
+        if categories_ is not None:
+            sig = [list(categories_[0]), categories_[1], T.get(onion)]
+        st = os.stat(filename)
+        stamp = [st.st_mtime_ns, st.st_size]
+        old = old_files.pop(name, None)
+        # A file rewritten with the same content (same hash) is unchanged.
+        digest = None
+        if old is not None and old['sig'] == sig and old['stamp'] != stamp and old.get('sha1') is not None:
+            digest = manifest.Digest(filename, st)
+        entry = manifest.Entry(filename, st)
+        sha1 = entry[5] if entry is not None else None
+        if old is not None and old['sig'] == sig and (old['stamp'] == stamp or digest == old['sha1']):
+            if sha1 is None:
+                sha1 = old.get('sha1')
+            pieces.append((state['cat_ids'][old['start']:old['end']],
+                           state['word_ids'][old['start']:old['end']],
+                           state['values'][old['start']:old['end']]))
+        else:
+            if old is not None:
+                changed_cats.update(state['cat_ids'][old['start']:old['end']].tolist())
+            contributions = []
+            if Contributes(filename, categories_, manifest):
+                num_read += 1
+                (rows, num_lines) = cache.Read(filename)
+                sha1 = manifest.Entry(filename, st)[5]
+                contributions = OnionContributions(onion, rows, num_lines, sig[0], sig[1], T, lexicon)
+            for (cat, ids, counts) in contributions:
+                if cat not in cat_index:
+                    cat_index[cat] = len(cat_names)
+                    cat_names.append(cat)
+                changed_cats.add(cat_index[cat])
+            pieces.append((np.concatenate([np.zeros(0, dtype=np.int32)] + [np.full(len(ids), cat_index[cat], dtype=np.int32) for (cat, ids, counts) in contributions]),
+                           np.concatenate([np.zeros(0, dtype=np.int32)] + [ids for (cat, ids, counts) in contributions]),
+                           np.concatenate([np.zeros(0)] + [counts for (cat, ids, counts) in contributions])))
+        files[name] = {'stamp': stamp, 'sig': sig, 'sha1': sha1, 'start': offset, 'end': offset + len(pieces[-1][0])}
+        offset += len(pieces[-1][0])
+    # Files that are gone.
+    for old in list(old_files.values()):
+        changed_cats.update(state['cat_ids'][old['start']:old['end']].tolist())
+    manifest.Save(filenames)
+    print('Incremental training: ' + str(num_read) + ' files read, ' + str(len(old_files)) + ' removed.')
+
+    if len(pieces) > 0:
+        cat_ids = np.concatenate([piece[0] for piece in pieces])
+        word_ids = np.concatenate([piece[1] for piece in pieces])
+        values = np.concatenate([piece[2] for piece in pieces])
+    else:
+        (cat_ids, word_ids, values) = (state['cat_ids'][0:0], state['word_ids'][0:0], state['values'][0:0])
+
+    # M rows, in the order categories first get a contribution (the key
+    # order of M in a full run). Changed rows are summed again from the
+    # contributions, left to right as ProcessFilesInCategory adds them.
+    (used, first) = np.unique(cat_ids, return_index=True)
+    old_M = state['M']
+    M_keys = []
+    M_rows = []
+    for c in used[np.argsort(first)].tolist():
+        cat = cat_names[c]
+        M_keys.append(cat)
+        if c in changed_cats or cat not in old_M:
+            mask = cat_ids == c
+            M_rows.append(SumContributions(word_ids[mask], values[mask]))
+        else:
+            row = old_M[cat]
+            M_rows.append((row.Ids(), row.Values()))
+    M = SparseHash.FromRows(vocab, M_keys, M_rows)
+
+    # Keyword lists to recompute: changed rows, and rows having a word
+    # whose number of categories (hence ICF) changed.
+    old_counts = np.zeros(len(vocab), dtype=np.int64)
+    old_counts[:len(old_M.ColumnCounts())] = old_M.ColumnCounts()
+    changed_words = old_counts != M.ColumnCounts()
+    ICF = ComputeICF(M)
+    keywords = {}
+    num_computed = 0
+    for cat in categories:
+        row = M[cat]
+        if (len(old_M.keys()) != len(M.keys()) or cat not in state['keywords']
+                or cat_index.get(cat) in changed_cats or changed_words[row.Ids()].any()):
+            keywords[cat] = CategoryTFICF(M, cat, ICF)
+            num_computed += 1
+        else:
+            keywords[cat] = state['keywords'][cat]
+    print('Incremental training: keywords recomputed for ' + str(num_computed) + ' of ' + str(len(categories)) + ' categories.')
+
+    SaveTrainingState(state_file, {'settings': settings, 'vocab': vocab, 'cat_names': cat_names,
+                                   'files': files, 'cat_ids': cat_ids, 'word_ids': word_ids,
+                                   'values': values, 'M': M, 'keywords': keywords})
+    return (M, keywords)
+
+
+# Sharded training. Each onion belongs to shard ShardOf(onion) of N, a
+# stable hash of its name, so any process on any machine assigns it the
+# same shard. TrainShard accumulates the contributions of the onions of
+# one shard (as ProcessFilesInCategory does) into a partial M, written
+# to a shard file; ReduceShards adds up the partial Ms of all N shard
+# files into M. Contributions are kept unsummed in the shard files,
+# each with its position (index of the file among all word group files,
+# and offset of the contribution in it): ReduceShards puts them back in
+# the order a single process adds them and sums them the same way, so
+# M is the same to the last bit.
+#
+# Shard file layout (np.savez):
+#   meta: JSON with the version, shard, number of shards, ShardSettings,
+#         the words of the shard's vocabulary, the categories and the
+#         position of each category's first contribution,
+#   row_lens: number of contributions to each category,
+#   word_ids (in the shard's words), counts, positions: the
+#         contributions to all categories, one category after the other.
+kShardVersion = 2
+
+
+def ShardOf(onion, num_shards):
+    return zlib.crc32(onion.encode('utf-8')) % num_shards
+
+
+def ShardFile(shard_dir, shard, num_shards):
+    return os.path.join(shard_dir, 'shard-{:04d}-of-{:04d}.npz'.format(shard, num_shards))
+
+
+# Fingerprint of everything besides the word groups that the partial
+# Ms depend on, so shards trained from other inputs are not mixed.
+def ShardSettings(L, test, K, S, T, H):
+    inputs = {'training': TrainingSettings(K, S), 'L': L, 'test': sorted(test.keys()), 'T': T, 'H': H}
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Train shard 'shard' of num_shards and write it to shard_dir. inputs:
+# see CreateTrainingInputs.
+def TrainShard(inputs, shard, num_shards, shard_dir, use_cache=True):
+    (L, test, K, S, T, H) = CreateTrainingInputs(inputs)
+    wordgrp_dir = inputs[1]
+    path = os.getcwd() + '/' + wordgrp_dir + '/*'
+    filenames = sorted(glob.glob(path))
+    vocab = Vocabulary()
+    lexicon = Lexicon(vocab, K, S)
+    # The cache is read but not written: other shards may be writing
+    # the same directory.
+    cache = WordGrpCache(wordgrp_dir, use_cache)
+    # Category -> (word ids, counts, positions) list.
+    pieces = {}
+    cat_first = {}
+    num_files = 0
+    for (file_index, filename) in enumerate(filenames):
+        onion = CategoryOnionName(filename)
+        if ShardOf(onion, num_shards) != shard:
+            continue
+        categories = OnionCategories(onion, L, H, test)
+        if categories is None:
+            continue
+        num_files += 1
+        if not Contributes(filename, categories, cache.manifest):
+            continue
+        (rows, num_lines) = cache.Read(filename)
+        (cat_list, cat_from_raters) = categories
+        offsets = {}
+        for (i, (cat, ids, counts)) in enumerate(OnionContributions(onion, rows, num_lines, cat_list, cat_from_raters, T, lexicon)):
+            if cat not in cat_first:
+                cat_first[cat] = (file_index << 32) + i
+            offset = offsets.get(cat, 0)
+            offsets[cat] = offset + len(ids)
+            pieces.setdefault(cat, []).append((ids, counts, (file_index << 32) + offset + np.arange(len(ids), dtype=np.int64)))
+
+    cats = list(pieces.keys())
+    rows = [tuple(np.concatenate(a) for a in zip(*pieces[cat])) for cat in cats]
+    meta = {'version': kShardVersion, 'shard': shard, 'num_shards': num_shards,
+            'settings': ShardSettings(L, test, K, S, T, H), 'words': vocab.words,
+            'cats': cats, 'cat_first': [cat_first[cat] for cat in cats]}
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir, exist_ok=True)
+    shard_file = ShardFile(shard_dir, shard, num_shards)
+    tmp_file = shard_file + '.tmp'
+    f = open(tmp_file, 'wb')
+    np.savez(f, meta=np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8),
+             row_lens=np.array([len(row[0]) for row in rows], dtype=np.int64),
+             word_ids=np.concatenate([np.zeros(0, dtype=np.int32)] + [row[0] for row in rows]),
+             counts=np.concatenate([np.zeros(0)] + [row[1] for row in rows]),
+             positions=np.concatenate([np.zeros(0, dtype=np.int64)] + [row[2] for row in rows]))
+    f.close()
+    os.replace(tmp_file, shard_file)
+    print('Shard ' + str(shard) + ' of ' + str(num_shards) + ': ' + str(num_files) + ' onions, written to ' + shard_file)
+
+
+# Train all num_shards shards with a pool of processes.
+def RunShards(inputs, num_shards, shard_dir, use_cache=True):
+    pool = Pool(min(num_shards, os.cpu_count() or 1))
+    try:
+        pool.starmap(TrainShard, [(inputs, shard, num_shards, shard_dir, use_cache) for shard in range(num_shards)])
+    finally:
+        pool.close()
+        pool.join()
+
+
+# M from the num_shards shard files in shard_dir, which must all have
+# been trained with 'settings' (see ShardSettings).
+def ReduceShards(shard_dir, num_shards, settings):
+    vocab = Vocabulary()
+    # Category -> (word ids, counts, positions) list, one per shard.
+    pieces = {}
+    cat_first = {}
+    for shard in range(num_shards):
+        shard_file = ShardFile(shard_dir, shard, num_shards)
+        if not os.path.exists(shard_file):
+            raise ValueError('Missing shard ' + shard_file)
+        arrays = np.load(shard_file, allow_pickle=False)
+        meta = json.loads(arrays['meta'].tobytes().decode('utf-8'))
+        if meta['version'] != kShardVersion:
+            raise ValueError(shard_file + ' has shard version ' + str(meta['version']) + ', expected ' + str(kShardVersion))
+        if meta['settings'] != settings:
+            raise ValueError(shard_file + ' was trained with other labels, keywords, stopwords or constants')
+        word_ids = np.array([vocab.Id(word) for word in meta['words']], dtype=np.int32)[arrays['word_ids']]
+        (counts, positions) = (arrays['counts'], arrays['positions'])
+        ends = np.cumsum(arrays['row_lens'])
+        starts = ends - arrays['row_lens']
+        for (c, cat) in enumerate(meta['cats']):
+            (lo, hi) = (starts[c], ends[c])
+            pieces.setdefault(cat, []).append((word_ids[lo:hi], counts[lo:hi], positions[lo:hi]))
+            cat_first[cat] = min(cat_first.get(cat, meta['cat_first'][c]), meta['cat_first'][c])
+    cats = sorted(pieces.keys(), key=lambda cat: cat_first[cat])
+    rows = []
+    for cat in cats:
+        (ids, counts, positions) = (np.concatenate(a) for a in zip(*pieces[cat]))
+        order = np.argsort(positions, kind='stable')
+        rows.append(SumContributions(ids[order], counts[order]))
+    return SparseHash.FromRows(vocab, cats, rows)
+
+
+# Hyperparameter sweep ('-m sweep'). The corpus is read once
+# (LoadSweepCorpus) and every setting of the constants below is then a
+# recombination of arrays kept in memory:
+#  - M: OnionComponents splits what every onion adds to M into the part
+#    scaled by kKeywordMultiplier**hits * kRatersMultiplier**raters and
+#    the title words scaled by kTitleMultiplier. These are summed per
+#    (category, word, hits, raters) and per (category, word) for the
+#    title words, separately for every kMinDocSize of the grid: the
+#    onions are put in buckets by which of those sizes they reach. M of
+#    a setting is one multiply-add over the sums of the buckets it
+#    keeps. Words keep the position of their first contribution, so M
+#    rows are in the order ProcessFilesInCategory adds them.
+#  - data: word counts and sqrt(pages) are kept apart, data of a
+#    kPageMultiplier is counts + kPageMultiplier * sqrt(pages).
+#  - kMaxVecSize is passed to CategoryTFICF.
+# Values can differ from a run with the constants edited in the last
+# bits, as the sums are added in another order.
+kSweepConstants = ('kTitleMultiplier', 'kKeywordMultiplier', 'kRatersMultiplier', 'kPageMultiplier', 'kMinDocSize', 'kMaxVecSize')
+kSweepIntConstants = ('kMinDocSize', 'kMaxVecSize')
+
+
+# '--grid NAME=V1,V2,...' -> (NAME, [V1, V2, ...]), None if malformed.
+def ParseGrid(arg):
+    (name, sep, values) = arg.partition('=')
+    if name not in kSweepConstants or not sep:
+        return None
+    convert = int if name in kSweepIntConstants else float
+    try:
+        return (name, [convert(value) for value in values.split(',')])
+    except ValueError:
+        return None
+
+
+# Every combination of the grid values, as constant -> value dicts.
+# Constants not in the grid keep their value.
+def SweepConfigs(grid):
+    values = [grid.get(name, [globals()[name]]) for name in kSweepConstants]
+    return [dict(zip(kSweepConstants, combination)) for combination in itertools.product(*values)]
+
+
+class SweepCorpus(object):
+    def __init__(self, vocab, L, test, min_doc_sizes):
+        self.vocab = vocab
+        self.categories = sorted(set([item for sublist in list(L.values()) for item in sublist]))
+        self.test = test
+        self.min_doc_sizes = min_doc_sizes
+        # Component sums of each M category, see Add.
+        self.kinds = []
+        self.cats = []
+        self.cat_first = {}
+        self.rows = {}
+        # data, with counts and sqrt(pages) as values.
+        self.counts = None
+        self.sqrt_pages = None
+        self.data_by_multiplier = {}
+
+    # Sets the per-category sums from (ids, values, kinds, buckets,
+    # positions) pieces: kind k of a contribution is hits/raters
+    # combination kinds[k], or the title (kind -1). cat_first: category
+    # -> position of its first contribution in the onions of each bucket.
+    def Add(self, pieces, kinds, cat_first):
+        self.kinds = kinds
+        self.cats = list(pieces.keys())
+        num_buckets = len(self.min_doc_sizes) + 1
+        for cat in self.cats:
+            # Of the onions of bucket b or more, for every b.
+            self.cat_first[cat] = np.minimum.accumulate(np.array(cat_first[cat], dtype=np.int64)[::-1])[::-1]
+            (ids, values, kind, bucket, position) = (np.concatenate(a) for a in zip(*pieces[cat]))
+            (words, inverse) = np.unique(ids, return_inverse=True)
+            inverse = inverse.ravel()
+            # Sum of each (word, kind, bucket).
+            key = (inverse * (len(kinds) + 1) + (kind + 1)) * num_buckets + bucket
+            (keys, key_inverse) = np.unique(key, return_inverse=True)
+            sums = np.bincount(key_inverse.ravel(), weights=values, minlength=len(keys))
+            # First position of each word in the onions of bucket b or
+            # more, for every b.
+            first = np.full((len(words), num_buckets), np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(first, (inverse, bucket), position)
+            first = np.minimum.accumulate(first[:, ::-1], axis=1)[:, ::-1]
+            self.rows[cat] = (words.astype(np.int32), keys // num_buckets // (len(kinds) + 1),
+                              keys // num_buckets % (len(kinds) + 1) - 1, keys % num_buckets, sums, first)
+
+    # M of a setting (a SweepConfigs dict).
+    def M(self, config):
+        bucket = self.min_doc_sizes.index(config['kMinDocSize']) + 1
+        factors = np.array([config['kKeywordMultiplier'] ** hits * config['kRatersMultiplier'] ** raters
+                            for (hits, raters) in self.kinds] + [config['kTitleMultiplier']])
+        cats = []
+        for cat in self.cats:
+            (words, word, kind, buckets, sums, first) = self.rows[cat]
+            keep = buckets >= bucket
+            row = np.bincount(word[keep], weights=sums[keep] * factors[kind[keep]], minlength=len(words))
+            present = np.flatnonzero(first[:, bucket] != np.iinfo(np.int64).max)
+            if len(present) == 0:
+                continue
+            order = present[np.argsort(first[present, bucket], kind='stable')]
+            cats.append((self.cat_first[cat][bucket], cat, (words[order], row[order])))
+        cats.sort(key=lambda x: x[0])
+        return SparseHash.FromRows(self.vocab, [cat for (f, cat, row) in cats], [row for (f, cat, row) in cats])
+
+    # data of a kPageMultiplier, sharing the counts' layout.
+    def Data(self, page_multiplier):
+        if page_multiplier not in self.data_by_multiplier:
+            c = self.counts
+            self.data_by_multiplier[page_multiplier] = SparseHash(
+                c.vocab, c.row_keys, c.starts, c.ends, c.indices,
+                c.values_ + page_multiplier * self.sqrt_pages.values_, c.order)
+        return self.data_by_multiplier[page_multiplier]
+
+
+# Reads the word group files once for the sweep, as CreateHashes does.
+# min_doc_sizes: the sorted kMinDocSize values of the grid. With dedup
+# (-u), near-duplicate onions are dropped before M is summed, as
+# CreateHashes does.
+def LoadSweepCorpus(wordgrp_dir, L, T, K, S, H, test, min_doc_sizes, dedup=False,
+                    dedup_threshold=kDedupThreshold, use_cache=True):
+    vocab = Vocabulary()
+    lexicon = Lexicon(vocab, K, S)
+    counts = SparseHashBuilder(vocab)
+    sqrt_pages = SparseHashBuilder(vocab)
+    path = os.getcwd() + '/' + wordgrp_dir + '/*'
+    filenames = sorted(glob.glob(path))
+    cache = WordGrpCache(wordgrp_dir, use_cache)
+    kinds = []
+    kind_index = {}
+    # (file index, onion, bucket, contributions) of every file adding to M.
+    files = []
+    for (file_index, filename) in enumerate(filenames):
+        onion = CategoryOnionName(filename)
+        (rows, num_lines) = cache.Read(filename)
+        ids = rows.VocabIds(vocab)
+        counts.AddRowIds(DataOnionName(filename), ids, rows.counts)
+        sqrt_pages.AddRowIds(DataOnionName(filename), ids, np.sqrt(rows.pages))
+        categories = OnionCategories(onion, L, H, test)
+        bucket = int(np.searchsorted(min_doc_sizes, num_lines, side='right'))
+        if categories is None or bucket == 0:
+            continue
+        (cat_list, cat_from_raters) = categories
+        (kw, title) = OnionComponents(onion, rows, cat_list, cat_from_raters, T, lexicon)
+        # Positions as in OnionContributions: the kw parts, then titles.
+        contributions = []
+        for (cat, ids, base, hits, raters) in kw:
+            kind = np.zeros(len(ids), dtype=np.int64)
+            for h in np.unique(hits).tolist():
+                if (h, raters) not in kind_index:
+                    kind_index[(h, raters)] = len(kinds)
+                    kinds.append((h, raters))
+                kind[hits == h] = kind_index[(h, raters)]
+            contributions.append((cat, ids, base, kind))
+        for (cat, ids) in title:
+            contributions.append((cat, ids, np.ones(len(ids)), np.full(len(ids), -1, dtype=np.int64)))
+        files.append((file_index, DataOnionName(filename), bucket, contributions))
+    cache.Save(filenames)
+    counts = counts.Freeze()
+    sqrt_pages = sqrt_pages.Freeze()
+    drop = ()
+    if dedup:
+        with metrics.phase('dedup'):
+            (counts, test, drop) = Deduplicate(counts, test, dedup_threshold)
+        sqrt_pages = sqrt_pages.Subset(counts.keys())
+
+    pieces = {}
+    cat_first = {}
+    no_position = np.iinfo(np.int64).max
+    for (file_index, onion, bucket, contributions) in files:
+        if onion in drop:
+            continue
+        offsets = {}
+        for (i, (cat, ids, values, kind)) in enumerate([c for c in contributions if len(c[1]) > 0]):
+            if cat not in cat_first:
+                cat_first[cat] = [no_position] * (len(min_doc_sizes) + 1)
+            cat_first[cat][bucket] = min(cat_first[cat][bucket], (file_index << 32) + i)
+            offset = offsets.get(cat, 0)
+            offsets[cat] = offset + len(ids)
+            pieces.setdefault(cat, []).append((ids, values, kind, np.full(len(ids), bucket, dtype=np.int64),
+                                               (file_index << 32) + offset + np.arange(len(ids), dtype=np.int64)))
+    corpus = SweepCorpus(vocab, L, test, min_doc_sizes)
+    corpus.Add(pieces, kinds, cat_first)
+    corpus.counts = counts
+    corpus.sqrt_pages = sqrt_pages
+    return corpus
+
+
+# The corpus of the sweep workers, set by InitSweepWorker.
+sweep_corpus = None
+
+
+def InitSweepWorker(corpus):
+    global sweep_corpus
+    sweep_corpus = corpus
+
+
+# Trains and scores one setting. Returns (accuracy, correct count,
+# total count).
+def SweepConfig(config):
+    corpus = sweep_corpus
+    M = corpus.M(config)
+    ICF = ComputeICF(M)
+    keywords = dict((cat, CategoryTFICF(M, cat, ICF, config['kMaxVecSize'])) for cat in corpus.categories)
+    (onions, cats, probs, best, counted, correct) = ScoreTest(corpus.Data(config['kPageMultiplier']), corpus.test,
+                                                            keywords, corpus.categories)
+    (correct_count, total_count) = (int(correct.sum()), int(counted.sum()))
+    return ((correct_count * 100.0) / (total_count * 1.0) if total_count else 0.0, correct_count, total_count)
+
+
+# Results of all configs, with 'workers' processes (default every core).
+def RunSweep(corpus, configs, workers=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(configs))
+    if workers <= 1:
+        InitSweepWorker(corpus)
+        return [SweepConfig(config) for config in configs]
+    pool = Pool(workers, InitSweepWorker, (corpus,))
+    try:
+        return pool.map(SweepConfig, configs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# One line per setting, then the best one.
+def PrintSweepTable(configs, sweep_results):
+    header = list(kSweepConstants) + ['Accuracy', 'Correct', 'Total']
+    lines = [[str(config[name]) for name in kSweepConstants] + ['%0.4f' % accuracy, str(correct), str(total)]
+             for (config, (accuracy, correct, total)) in zip(configs, sweep_results)]
+    widths = [max(len(line[i]) for line in [header] + lines) for i in range(len(header))]
+    print('\n\n==== Sweep: accuracy (percentage) of each setting ====')
+    for line in [header] + lines:
+        print('  '.join(value.rjust(width) for (value, width) in zip(line, widths)))
+    best = max(range(len(sweep_results)), key=lambda i: sweep_results[i][0])
+    print('Best: ' + ', '.join(name + '=' + str(configs[best][name]) for name in kSweepConstants)
+          + ', Accuracy = ' + str(sweep_results[best][0]))
+
+
 # Post-process to remove words that occur in more than 1 category.
 def PostProcessHash(cat_tficf):
     word_cat_count = {}
@@ -627,198 +2503,496 @@ def PostProcessHash(cat_tficf):
     return cat_tficf
 
 
-# Runs inference on the test set using the following:
+# Model file layout (all integers little-endian):
+#   kModelMagic, uint32 version, uint32 header size,
+#   header: JSON with the categories, each category's keywords, the
+#           offset of its weights and the constants used in training,
+#   padding to a multiple of 8 bytes,
+#   weights: float64 array, the keyword weights of every category.
+# The weights are memory-mapped on load.
+def ModelConstants():
+    return {'kEpsilon': kEpsilon,
+            'kMinKeywordLength': kMinKeywordLength,
+            'kMinDocSize': kMinDocSize,
+            'kMaxVecSize': kMaxVecSize,
+            'kTitleMultiplier': kTitleMultiplier,
+            'kKeywordMultiplier': kKeywordMultiplier,
+            'kPageMultiplier': kPageMultiplier,
+            'kRatersMultiplier': kRatersMultiplier}
+
+
+# Write the keyword vectors of ComputeTFICF to model_file. The file is
+# replaced atomically, so a reader never sees a partial model.
+def SaveModel(model_file, keywords, categories):
+    header = {'categories': categories, 'keywords': {}, 'offsets': {}, 'constants': ModelConstants()}
+    weights = []
+    for cat in categories:
+        header['keywords'][cat] = [x for (x, w) in keywords[cat]]
+        header['offsets'][cat] = len(weights)
+        weights.extend([w for (x, w) in keywords[cat]])
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(len(kModelMagic) + 8 + len(header_bytes)) % 8)
+    tmp_file = model_file + '.tmp'
+    f = open(tmp_file, 'wb')
+    f.write(kModelMagic)
+    f.write(struct.pack('<II', kModelVersion, len(header_bytes)))
+    f.write(header_bytes)
+    f.write(np.array(weights, dtype='<f8').tobytes())
+    f.close()
+    os.replace(tmp_file, model_file)
+
+
+# Read a model written by SaveModel. Returns (keywords, categories,
+# constants), with keywords as returned by ComputeTFICF.
+def LoadModel(model_file):
+    f = open(model_file, 'rb')
+    magic = f.read(len(kModelMagic))
+    if magic != kModelMagic:
+        f.close()
+        raise ValueError(model_file + ' is not an ATOL model file')
+    (version, header_size) = struct.unpack('<II', f.read(8))
+    if version != kModelVersion:
+        f.close()
+        raise ValueError(model_file + ' has model version ' + str(version) + ', expected ' + str(kModelVersion))
+    header = json.loads(f.read(header_size).decode('utf-8'))
+    f.close()
+    offset = len(kModelMagic) + 8 + header_size
+    num_weights = sum(len(kws) for kws in list(header['keywords'].values()))
+    weights = np.memmap(model_file, dtype='<f8', mode='r', offset=offset, shape=(num_weights,)) if num_weights else np.zeros(0)
+    keywords = {}
+    for cat in header['categories']:
+        start = header['offsets'][cat]
+        kws = header['keywords'][cat]
+        keywords[cat] = list(zip(kws, weights[start:start + len(kws)].tolist()))
+    return (keywords, header['categories'], header['constants'])
+
+
+# Scores onions against keyword vectors, all onions at once:
 #   data: onion x word -> count
-#   test: onion -> category
-#   keywords: category -> list of (word, weight) tuples5C
+#   onions: list of onions to score
+#   keywords: category -> list of (word, weight) tuples
 #   categories: category list
 #
 # Method:
-#   For each onion in test
-#    1. For each category, traverse the list of (word, weights).
-#       If a word is in data[onion], accumulate score += weights * count.
-#    2. Normalize the scores across categories to sum to 1, using softmax.
-#
-# Returns a hash 'probs' mapping onion -> list of (category, probability)
-def RunInference(data, test, keywords, categories, T, txt):
-    probs = {}
-    correct_count = 0
-    total_count = 0
-    for (onion, label) in list(test.items()):
-        #if T.has_key(onion):
-            #print '\nonion = ' + str(onion) + ', label = ' + str(label) + ', title words = ' + str(T[onion])
-        #else:
-            #print '\nonion = ' + str(onion) + ', label = ' + str(label) + ', title words UNKNOWN'
-        total_score = 0
-        lst = []
-        for category in categories:
-            # print 'category = ' + category
-            score = 0
-            if category in keywords:
-                for (x, w) in keywords[category]:
-                    if x in data[onion]:
-                        count = data[onion][x]
-                        score += count * w
-                        # print 'x = ' + str(x) + ', w = ' + str(w) + ', count = ' + str(count) + ', score = ' + str(score)
-                lst.append((category, score))
-                # print 'lst = ' + str(lst)
-                total_score += score
-        if total_score > 0:
-            lst = [(x[0], x[1]/total_score) for x in lst]
-        probs[onion] = lst
-        sorted_lst = sorted(lst, key=lambda x: x[1], reverse=True)
-        #print '\tProbs = ' + str(sorted_lst)
-        # Compute accuracy
-        if onion in data and len(data[onion]) > 1:
-            total_count += 1
-            if sorted_lst[0][0] == test[onion][0]:
-                correct_count += 1
-        print('\tCorrect_Count = ' + str(correct_count) + ', Total_Count = ' + str(total_count))
-    print(str(sorted_lst[0][0]) + '::' + str(test[onion][0]))
+#    1. For each category, traverse the list of (word, weights). Every
+#       onion having the word in data gets score += weights * count.
+#    2. Normalize the scores across categories to sum to 1.
+#
+# Step 1 runs once per keyword over all onions having it, and adds in
+# the same order as a per-onion loop would, so the result does not
+# depend on batching.
+#
+# Returns (cats, probs): the categories that have keywords, and a
+# len(onions) x len(cats) array of probabilities.
+def ScoreOnions(data, onions, keywords, categories):
+    return ScoreOnionsSets(data, onions, [(keywords, categories)])[0]
+
+
+# ScoreOnions for several keyword sets, given as (keywords, categories)
+# pairs. The entries of data are gathered once for all of them. Returns
+# a (cats, probs) pair per set.
+def ScoreOnionsSets(data, onions, keyword_sets):
+    metrics.count('onions', len(onions))
+    vocab_ids = data.vocab.ids
+    # Column of each keyword's word id.
+    kw_ids = set(vocab_ids[x] for (keywords, categories) in keyword_sets
+                 for cat in categories if cat in keywords for (x, w) in keywords[cat] if x in vocab_ids)
+    kw_ids = np.array(sorted(kw_ids), dtype=np.int64)
+    column = np.full(len(data.vocab), -1, dtype=np.int64)
+    column[kw_ids] = np.arange(len(kw_ids))
+    # Entries of data for these onions and keywords, grouped by keyword.
+    (rows, ids, vals) = data.Entries(onions)
+    mask = column[ids] >= 0
+    rows = rows[mask]
+    cols = column[ids[mask]]
+    vals = vals[mask]
+    by_col = np.argsort(cols, kind='stable')
+    rows = rows[by_col]
+    vals = vals[by_col]
+    bounds = np.searchsorted(cols[by_col], np.arange(len(kw_ids) + 1))
+    scores_by_set = []
+    for (keywords, categories) in keyword_sets:
+        cats = [cat for cat in categories if cat in keywords]
+        scores = np.zeros((len(onions), len(cats)))
+        for (c, cat) in enumerate(cats):
+            for (x, w) in keywords[cat]:
+                if x not in vocab_ids:
+                    continue
+                k = column[vocab_ids[x]]
+                (lo, hi) = (bounds[k], bounds[k + 1])
+                if hi - lo == 1:
+                    # One onion has the keyword (always so for a single
+                    # page): cheaper than indexing with a slice.
+                    scores[rows[lo], c] += vals[lo] * w
+                elif hi > lo:
+                    scores[rows[lo:hi], c] += vals[lo:hi] * w
+        total_score = np.zeros(len(onions))
+        for c in range(len(cats)):
+            total_score += scores[:, c]
+        nonzero = total_score > 0
+        scores[nonzero] /= total_score[nonzero][:, None]
+        scores_by_set.append((cats, scores))
+    return scores_by_set
+
+
+# Top category and its probability for each row of ScoreOnions probs.
+# Ties go to the first category, as with a stable sort.
+def BestCategories(probs):
+    best = np.argmax(probs, axis=1)
+    return (best, probs[np.arange(len(probs)), best])
+
+
+# (category, probability) list of one onion, most probable first.
+def SortedProbs(cats, prob_row):
+    return sorted(zip(cats, prob_row.tolist()), key=lambda x: x[1], reverse=True)
+
+
+# Scores the test set (test: onion -> category). Returns (onions, cats,
+# probs, best, counted, correct): ScoreOnions' result, the most probable
+# category of each onion, and bool arrays of the onions that count
+# towards the accuracy (more than one word) and of those predicted
+# correctly.
+def ScoreTest(data, test, keywords, categories):
+    onions = list(test.keys())
+    (cats, probs) = ScoreOnions(data, onions, keywords, categories)
+    return TestResults(data, test, onions, cats, probs)
+
+
+# ScoreTest from the ScoreOnions probs of the test onions.
+def TestResults(data, test, onions, cats, probs):
+    (best, best_prob) = BestCategories(probs)
+    counted = data.RowLengths(onions) > 1
+    correct = counted & np.array([cats[best[i]] == test[onion][0] for (i, onion) in enumerate(onions)], dtype=bool)
+    return (onions, cats, probs, best, counted, correct)
+
+
+# Result files (--results, see results.py): one row per onion of every
+# report. 'flag' is 1 if the onion was categorized correctly, 0 if not
+# and -1 if it does not count (accuracy, filtering), 1 if the baseline
+# does not label it as the target (discovery), -1 otherwise. 'probs'
+# maps every category to its probability.
+kResultColumns = (('report', 'str'), ('keywords', 'str'), ('target', 'str'), ('onion', 'str'),
+                  ('label', 'str'), ('predicted', 'str'), ('probability', 'float'), ('flag', 'int'),
+                  ('probs', 'json'))
+
+
+# Writes rows of a report to the result file, if there is one. labels:
+# label list of each onion, rows: rows of probs of the onions.
+def WriteResults(report, keyword_set, target, onions, labels, cats, probs, rows, flags):
+    if not results.enabled() or len(onions) == 0:
+        return
+    probs = probs[rows]
+    (best, best_prob) = BestCategories(probs)
+    results.write({'report': [report] * len(onions), 'keywords': [keyword_set] * len(onions),
+                   'target': [target] * len(onions), 'onion': onions,
+                   'label': [','.join(label) for label in labels],
+                   'predicted': [cats[c] for c in best.tolist()], 'probability': best_prob,
+                   'flag': flags, 'probs': [dict(zip(cats, row)) for row in probs.tolist()]})
+
+
+# Writes lines at once, rather than a print() per line.
+def PrintLines(lines):
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
+
+
+def TitleLine(onion, T):
+    if onion in T:
+        return '\nonion = ' + str(onion) + ', title words = ' + str(' '.join(T[onion]))
+    return '\nonion = ' + str(onion) + ', title words UNKNOWN'
+
+
+# Runs inference on the test set (test: onion -> category) and prints
+# the accuracy of the most probable category.
+#
+# Returns AccuracyResult's result.
+def RunInference(data, test, keywords, categories, T, txt, quiet=False):
+    onions = list(test.keys())
+    (cats, probs) = ScoreOnions(data, onions, keywords, categories)
+    result = AccuracyResult(data, test, onions, cats, probs)
+    PrintAccuracy(result, test, txt, quiet)
+    WriteAccuracy(result, test, txt.rstrip(': '))
+    return result
+
+
+# The accuracy of RunInference from the probs of the test onions, as a
+# dict: TestResults' arrays, and correct_count, total_count and
+# accuracy (percentage).
+def AccuracyResult(data, test, onions, cats, probs):
+    (onions, cats, probs, best, counted, correct) = TestResults(data, test, onions, cats, probs)
+    correct_count = int(correct.sum())
+    total_count = int(counted.sum())
     accuracy = (correct_count * 100.0) / (total_count * 1.0)
-    print(str(txt) + ' Accuracy (percentage) = ' + str(accuracy) + '\tCorrect_Count = ' + str(correct_count) + ', Total_Count = ' + str(total_count))
-    return probs
-
-
-def RunInferenceOnLabel(data, test, keywords, categories, T, target):
-    probs = {}
-    correct_count = 0
-    total_count = 0
-    correct_probs = []
-    list_80 = []
-    list_90 = []
-    for (onion, label) in list(test.items()):
-        if not target in label:
-            continue;
-        if onion in T:
-            print('\nonion = ' + str(onion) + ', label = ' + str(label) + ', title words = ' + str(T[onion]))
-        else:
-            print('\nonion = ' + str(onion) + ', label = ' + str(label) + ', title words UNKNOWN')
-        total_score = 0
-        lst = []
-        for category in categories:
-            # print 'category = ' + category
-            score = 0
-            if category in keywords:
-                for (x, w) in keywords[category]:
-                    if x in data[onion]:
-                        count = data[onion][x]
-                        score += count * w
-                        # print 'x = ' + str(x) + ', w = ' + str(w) + ', count = ' + str(count) + ', score = ' + str(score)
-                lst.append((category, score))
-                # print 'lst = ' + str(lst)
-                total_score += score
-        if total_score > 0:
-            lst = [(x[0], x[1]/total_score) for x in lst]
-        probs[onion] = lst
-        sorted_lst = sorted(lst, key=lambda x: x[1], reverse=True)
-        print('\tProbs = ' + str(sorted_lst))
-        # Compute accuracy
-        if onion in data and len(data[onion]) > 1:
-            total_count += 1
-            if sorted_lst[0][0] == test[onion][0]:
-                correct_count += 1
-                correct_probs.append(sorted_lst[0][1])
-                if sorted_lst[0][1] > 0.8:
-                    list_80.append(onion)
-                if sorted_lst[0][1] > 0.9:
-                    list_90.append(onion)
-        print('\tCorrect_Count = ' + str(correct_count) + ', Total_Count = ' + str(total_count))
-    print('\nTotal found = ' + str(total_count))
-    print('Number of predictions: ')
-    print('\t > 0.5 = ' + str(len([x for x in correct_probs if x > 0.5])))
-    print('\t > 0.6 = ' + str(len([x for x in correct_probs if x > 0.6])))
-    print('\t > 0.7 = ' + str(len([x for x in correct_probs if x > 0.7])))
-    print('\t > 0.8 = ' + str(len([x for x in correct_probs if x > 0.8])))
-    print('\t > 0.9 = ' + str(len([x for x in correct_probs if x > 0.9])))
-
-    print('\n==== List for > 0.9, size = ' + str(len([x for x in correct_probs if x > 0.9])))
-    for onion in list_90:
-        if onion in T:
-            print('\nonion = ' + str(onion) + ', title words = ' + str(' '.join(T[onion])))
-        else:
-            print('\nonion = ' + str(onion) + ', title words UNKNOWN')
-    print('\n==== List for > 0.8, size = ' + str(len([x for x in correct_probs if x > 0.8])))
-    for onion in list_80:
-        if onion in T:
-            print('\nonion = ' + str(onion) + ', title words = ' + str(' '.join(T[onion])))
-        else:
-            print('\nonion = ' + str(onion) + ', title words UNKNOWN')
+    return {'onions': onions, 'cats': cats, 'probs': probs, 'best': best, 'counted': counted, 'correct': correct,
+            'correct_count': correct_count, 'total_count': total_count, 'accuracy': accuracy}
 
 
-def RunInferenceDiff(data, B, keywords, categories, T, test, target, threshold):
-    probs = {}
-    numTargetOnions = 0
-    numDiffOnions = 0
-    numAllOnions = 0
-    for onion in list(data.keys()):
-        numAllOnions += 1
-        total_score = 0
-        lst = []
-        for category in categories:
-            # print 'category = ' + category
-            score = 0
-            if category in keywords:
-                for (x, w) in keywords[category]:
-                    if x in data[onion]:
-                        count = data[onion][x]
-                        score += count * w
-                        # print 'x = ' + str(x) + ', w = ' + str(w) + ', count = ' + str(count) + ', score = ' + str(score)
-                lst.append((category, score))
-                # print 'lst = ' + str(lst)
-                total_score += score
-        if total_score > 0:
-            lst = [(x[0], x[1]/total_score) for x in lst]
-        probs[onion] = lst
-        sorted_lst = sorted(lst, key=lambda x: x[1], reverse=True)
-        # Print onions that have > threshold probability of being of category 'target'
-        if sorted_lst[0][0] == target and sorted_lst[0][1] > threshold and sorted_lst[0][1] < 1.0:
-            numTargetOnions += 1
-            if onion not in B or target not in B[onion]:
-                numDiffOnions += 1
-                if onion in T:
-                    print('\nonion = ' + str(onion) + ', title words = ' + str(' '.join(T[onion])))
-                else:
-                    print('\nonion = ' + str(onion) + ', title words UNKNOWN')
-                print('\tProbs = ' + str(sorted_lst))
-                if onion in B:
-                    print('\tBaseline labels = ' + str(B[onion]))
-    print('NumAllOnions = ' + str(numAllOnions))
-    print('NumTargetOnions = ' + str(numTargetOnions))
-    print('NumDiffOnions = ' + str(numDiffOnions) + ', at threshold= ' + str(threshold))
-
-def RunPracticalDiff(data, keywords, categories):
-    probs = {}
-    numTargetOnions = 0
-    numDiffOnions = 0
-    numAllOnions = 0
-    for onion in list(data.keys()):
-        numAllOnions += 1
-        total_score = 0
-        lst = []
-        for category in categories:
-            # print 'category = ' + category
-            score = 0
-            if category in keywords:
-                for (x, w) in keywords[category]:
-                    if x in data[onion]:
-                        count = data[onion][x]
-                        score += count * w
-                        # print 'x = ' + str(x) + ', w = ' + str(w) + ', count = ' + str(count) + ', score = ' + str(score)
-                lst.append((category, score))
-                # print 'lst = ' + str(lst)
-                total_score += score
-        if total_score > 0:
-            lst = [(x[0], x[1]/total_score) for x in lst]
-        probs[onion] = lst
-        sorted_lst = sorted(lst, key=lambda x: x[1], reverse=True)
-        # Print onions that have > threshold probability of being of category 'target'
-        print('onion = {}'.format(onion))
-        print('Probs = {}'.format(sorted_lst))
+def PrintAccuracy(result, test, txt, quiet=False):
+    if not quiet:
+        (onions, cats, best) = (result['onions'], result['cats'], result['best'])
+        total_counts = np.cumsum(result['counted']).tolist()
+        correct_counts = np.cumsum(result['correct']).tolist()
+        lines = ['\tCorrect_Count = ' + str(c) + ', Total_Count = ' + str(t) for (c, t) in zip(correct_counts, total_counts)]
+        lines.append(str(cats[best[-1]]) + '::' + str(test[onions[-1]][0]))
+        PrintLines(lines)
+    print(str(txt) + ' Accuracy (percentage) = ' + str(result['accuracy']) + '\tCorrect_Count = ' + str(result['correct_count']) + ', Total_Count = ' + str(result['total_count']))
+
+
+def WriteAccuracy(result, test, keyword_set):
+    onions = result['onions']
+    flags = np.where(result['counted'], result['correct'].astype(np.int64), -1)
+    WriteResults('accuracy', keyword_set, '', onions, [test[onion] for onion in onions],
+                 result['cats'], result['probs'], np.arange(len(onions)), flags)
+
+
+# Runs inference on the onions labeled 'target' in test, and prints how
+# many were predicted correctly at each confidence level.
+#
+# Returns OnLabelResult's result.
+def RunInferenceOnLabel(data, test, keywords, categories, T, target, keyword_set='atol', quiet=False):
+    onions = [onion for (onion, label) in list(test.items()) if target in label]
+    (cats, probs) = ScoreOnions(data, onions, keywords, categories)
+    result = OnLabelResult(data, test, onions, cats, probs)
+    PrintOnLabel(result, test, T, quiet)
+    WriteOnLabel(result, test, keyword_set, target)
+    return result
+
+
+# RunInferenceOnLabel's results from the probs of the onions, as a dict:
+# TestResults' arrays, total_count, histogram ((threshold, number of
+# correct predictions above it) list) and list_90, list_80 (onions
+# predicted correctly above 0.9 and 0.8).
+def OnLabelResult(data, test, onions, cats, probs):
+    (onions, cats, probs, best, counted, correct) = TestResults(data, test, onions, cats, probs)
+    (best, best_prob) = BestCategories(probs)
+    correct_probs = best_prob[correct]
+    return {'onions': onions, 'cats': cats, 'probs': probs, 'best': best, 'counted': counted, 'correct': correct,
+            'total_count': int(counted.sum()),
+            'histogram': [(x, int((correct_probs > x).sum())) for x in (0.5, 0.6, 0.7, 0.8, 0.9)],
+            'list_90': [onions[i] for i in np.flatnonzero(correct & (best_prob > 0.9)).tolist()],
+            'list_80': [onions[i] for i in np.flatnonzero(correct & (best_prob > 0.8)).tolist()]}
+
+
+def PrintOnLabel(result, test, T, quiet=False):
+    (onions, cats, probs) = (result['onions'], result['cats'], result['probs'])
+    if not quiet:
+        total_counts = np.cumsum(result['counted']).tolist()
+        correct_counts = np.cumsum(result['correct']).tolist()
+        lines = []
+        for (i, onion) in enumerate(onions):
+            label = test[onion]
+            if onion in T:
+                lines.append('\nonion = ' + str(onion) + ', label = ' + str(label) + ', title words = ' + str(T[onion]))
+            else:
+                lines.append('\nonion = ' + str(onion) + ', label = ' + str(label) + ', title words UNKNOWN')
+            lines.append('\tProbs = ' + str(SortedProbs(cats, probs[i])))
+            lines.append('\tCorrect_Count = ' + str(correct_counts[i]) + ', Total_Count = ' + str(total_counts[i]))
+        PrintLines(lines)
+    print('\nTotal found = ' + str(result['total_count']))
+    print('Number of predictions: ')
+    for (x, n) in result['histogram']:
+        print('\t > ' + str(x) + ' = ' + str(n))
+    if quiet:
+        return
+    print('\n==== List for > 0.9, size = ' + str(len(result['list_90'])))
+    PrintLines([TitleLine(onion, T) for onion in result['list_90']])
+    print('\n==== List for > 0.8, size = ' + str(len(result['list_80'])))
+    PrintLines([TitleLine(onion, T) for onion in result['list_80']])
+
+
+def WriteOnLabel(result, test, keyword_set, target):
+    onions = result['onions']
+    flags = np.where(result['counted'], result['correct'].astype(np.int64), -1)
+    WriteResults('filtering', keyword_set, target, onions, [test[onion] for onion in onions],
+                 result['cats'], result['probs'], np.arange(len(onions)), flags)
+
+
+# Prints the onions of data whose most probable category is 'target'
+# with probability above threshold, but that the baseline B does not
+# label as 'target'.
+#
+# Returns DiffResult's result.
+def RunInferenceDiff(data, B, keywords, categories, T, test, target, threshold, keyword_set='atol', quiet=False):
+    onions = data.keys()
+    (cats, probs) = ScoreOnions(data, onions, keywords, categories)
+    result = DiffResult(B, onions, cats, probs, target, threshold)
+    PrintDiff(result, B, T, quiet)
+    WriteDiff(result, B, keyword_set)
+    return result
+
+
+# RunInferenceDiff's results from the probs of all onions of data, as a
+# dict: found (rows of probs of the onions above threshold), new (the
+# found ones the baseline does not label as target), and the counts.
+def DiffResult(B, onions, cats, probs, target, threshold):
+    (best, best_prob) = BestCategories(probs)
+    # Onions that have > threshold probability of being of category 'target'
+    is_target = np.array([cat == target for cat in cats], dtype=bool)[best]
+    found = np.flatnonzero(is_target & (best_prob > threshold) & (best_prob < 1.0))
+    new = np.array([onions[i] not in B or target not in B[onions[i]] for i in found.tolist()], dtype=bool)
+    return {'onions': onions, 'cats': cats, 'probs': probs, 'target': target, 'threshold': threshold,
+            'found': found, 'new': new, 'num_all': len(onions), 'num_target': len(found), 'num_diff': int(new.sum())}
+
+
+def PrintDiff(result, B, T, quiet=False):
+    PrintDiffOnions(result, B, T, quiet)
+    PrintDiffSummary(result)
+
+
+# The onions found that the baseline does not label as target.
+def PrintDiffOnions(result, B, T, quiet=False):
+    if quiet:
+        return
+    (onions, cats, probs) = (result['onions'], result['cats'], result['probs'])
+    lines = []
+    for i in result['found'][result['new']].tolist():
+        onion = onions[i]
+        lines.append(TitleLine(onion, T))
+        lines.append('\tProbs = ' + str(SortedProbs(cats, probs[i])))
+        if onion in B:
+            lines.append('\tBaseline labels = ' + str(B[onion]))
+    PrintLines(lines)
+
+
+def PrintDiffSummary(result):
+    print('NumAllOnions = ' + str(result['num_all']))
+    print('NumTargetOnions = ' + str(result['num_target']))
+    print('NumDiffOnions = ' + str(result['num_diff']) + ', at threshold= ' + str(result['threshold']))
+
+
+def WriteDiff(result, B, keyword_set):
+    found = result['found']
+    onions = [result['onions'][i] for i in found.tolist()]
+    WriteResults('discovery', keyword_set, result['target'], onions, [B.get(onion, []) for onion in onions],
+                 result['cats'], result['probs'], found, result['new'].astype(np.int64))
+
+
+# Every report of the accuracy, filtering and discovery modes for
+# several keyword sets and targets, scoring every onion once for all
+# sets (ScoreOnionsSets). keyword_sets: (name, keywords, categories)
+# list. For every set: the accuracy on test, then for every target the
+# filtering report of the onions H labels so (RunInferenceOnLabel) and
+# the onions of data found above threshold but not labeled so by B
+# (RunInferenceDiff).
+def RunEvaluation(data, test, H, B, T, keyword_sets, targets, threshold, quiet=False):
+    onions = data.keys()
+    onions += [onion for onion in test if onion not in data]
+    onions += [onion for onion in H if onion not in data and onion not in test]
+    position = dict((onion, i) for (i, onion) in enumerate(onions))
+    test_onions = list(test.keys())
+    test_rows = np.array([position[onion] for onion in test_onions], dtype=np.int64)
+    data_rows = np.arange(len(data))
+    scores = ScoreOnionsSets(data, onions, [(keywords, categories) for (name, keywords, categories) in keyword_sets])
+    for ((name, keywords, categories), (cats, probs)) in zip(keyword_sets, scores):
+        print('\n\n==== Accuracy: probability estimates using ' + name + ' keyword list ====')
+        result = AccuracyResult(data, test, test_onions, cats, probs[test_rows])
+        PrintAccuracy(result, test, name + ': ', quiet)
+        WriteAccuracy(result, test, name)
+        for target in targets:
+            print('\n\n==== Filtering: results on data subset labeled as ' + target + ', ' + name + ' keyword list ====')
+            target_onions = [onion for (onion, label) in list(H.items()) if target in label]
+            target_rows = np.array([position[onion] for onion in target_onions], dtype=np.int64)
+            result = OnLabelResult(data, H, target_onions, cats, probs[target_rows])
+            PrintOnLabel(result, H, T, quiet)
+            WriteOnLabel(result, H, name, target)
+            print('\n\n==== Discovery: from full data we find onions where ' + target + ' has high probability, ' + name + ' keyword list ====')
+            result = DiffResult(B, onions[:len(data)], cats, probs[data_rows], target, threshold)
+            PrintDiff(result, B, T, quiet)
+            WriteDiff(result, B, name)
+
+# Prints the category probabilities of every onion in data.
+#
+# Returns (onions, cats, probs) as given by ScoreOnions.
+def RunPracticalDiff(data, keywords, categories, keyword_set='atol', quiet=False):
+    onions = data.keys()
+    (cats, probs) = ScoreOnions(data, onions, keywords, categories)
+    if not quiet:
+        lines = []
+        for (i, onion) in enumerate(onions):
+            lines.append('onion = {}'.format(onion))
+            lines.append('Probs = {}'.format(SortedProbs(cats, probs[i])))
+        PrintLines(lines)
+    WriteResults('practical', keyword_set, '', onions, [[]] * len(onions), cats, probs,
+                 np.arange(len(onions)), np.full(len(onions), -1, dtype=np.int64))
+    return (onions, cats, probs)
+
+
+# Streaming ('--stream'), for word group directories too large to load
+# as one data hash. The files are read in chunks of chunk_size onions
+# holding only the entries of the keywords (KeywordReader); each chunk
+# is scored, reported and dropped before the next is read. Only the
+# keyword vectors and the file names stay in memory, and results are
+# printed (and written, see --results) as the chunks are scored. An
+# onion's scores only depend on its own row, so the output is the same
+# as without streaming.
+kStreamChunk = 10000  # Default onions per chunk (--chunk-size).
+
+
+# Vocabulary of the words of keyword vectors.
+def KeywordVocabulary(keywords):
+    vocab = Vocabulary()
+    for cat in keywords:
+        for (word, weight) in keywords[cat]:
+            vocab.Id(word)
+    return vocab
+
+
+# The onions of wordgrp_dir as data hashes of chunk_size onions (all
+# files of an onion go in the same chunk), with only the words of vocab.
+def StreamData(wordgrp_dir, vocab, chunk_size=kStreamChunk, use_cache=True):
+    path = os.getcwd() + '/' + wordgrp_dir + '/*'
+    filenames = sorted(glob.glob(path))
+    reader = KeywordReader(wordgrp_dir, vocab, use_cache)
+    chunk = []
+    num_onions = 0
+    for filename in filenames + [None]:
+        onion = DataOnionName(filename) if filename is not None else None
+        if chunk and (filename is None or (onion != DataOnionName(chunk[-1]) and num_onions >= chunk_size)):
+            data = SparseHashBuilder(vocab)
+            for (chunk_filename, (ids, values)) in zip(chunk, reader.Read(chunk)):
+                data.AddRowIds(DataOnionName(chunk_filename), ids, values)
+            yield data.Freeze()
+            chunk = []
+            num_onions = 0
+        if filename is None:
+            break
+        if not chunk or onion != DataOnionName(chunk[-1]):
+            num_onions += 1
+        chunk.append(filename)
+
+
+# RunInferenceDiff over the onions of wordgrp_dir, streamed. Returns
+# the counts of DiffResult.
+def StreamInferenceDiff(wordgrp_dir, B, keywords, categories, T, target, threshold, keyword_set='atol',
+                        chunk_size=kStreamChunk, use_cache=True, quiet=False):
+    total = {'num_all': 0, 'num_target': 0, 'num_diff': 0, 'threshold': threshold}
+    for data in StreamData(wordgrp_dir, KeywordVocabulary(keywords), chunk_size, use_cache):
+        onions = data.keys()
+        (cats, probs) = ScoreOnions(data, onions, keywords, categories)
+        result = DiffResult(B, onions, cats, probs, target, threshold)
+        PrintDiffOnions(result, B, T, quiet)
+        WriteDiff(result, B, keyword_set)
+        for key in ('num_all', 'num_target', 'num_diff'):
+            total[key] += result[key]
+    PrintDiffSummary(total)
+    return total
+
+
+# RunPracticalDiff over the onions of wordgrp_dir, streamed. Returns
+# the number of onions.
+def StreamPracticalDiff(wordgrp_dir, keywords, categories, keyword_set='atol',
+                        chunk_size=kStreamChunk, use_cache=True, quiet=False):
+    num_onions = 0
+    for data in StreamData(wordgrp_dir, KeywordVocabulary(keywords), chunk_size, use_cache):
+        RunPracticalDiff(data, keywords, categories, keyword_set, quiet)
+        num_onions += len(data)
+    return num_onions
 
 
 # Print final tficf_hash with weights.
-def PrintFinalHash(cat_tficf):
+def PrintFinalHash(cat_tficf, quiet=False):
+    if quiet:
+        return
     num = kMaxVecSize
     print('\n\n==== Printing final weighted keyword list, pruned to top ' + str(num) + ' ====\n\n')
     for (key, val) in list(cat_tficf.items()):
@@ -826,12 +3000,11 @@ def PrintFinalHash(cat_tficf):
 
 
 # Prints top keywords for the category, sorted in decreasing order of weight.
-def PrintTopNewKeywords(cat_tficf, K, M, categories):
+def PrintTopNewKeywords(cat_tficf, K, M, categories, lexicon, quiet=False):
+    if quiet:
+        return
     print('\n==== Printing original and new keyword lists ====')
-    final_kw_hash = {}
-    all_kw = set([])
-    for cat in categories:
-        all_kw = all_kw.union(set(K[cat]))        
+    all_kw = lexicon.all_keywords
     for cat in categories:
         old_lst = K[cat]
         new_lst = [x[0] for x in cat_tficf[cat] if (x[0] not in all_kw)]
@@ -840,8 +3013,50 @@ def PrintTopNewKeywords(cat_tficf, K, M, categories):
         print('\nNew keywords for category: ' + cat + ' = ' + str(sub_new_lst))
 
 
-# Function that processes the input arguments.
+# Settings of a run, as given on the command line (see
+# ProcessArguments).
+class Options(object):
+    def __init__(self):
+        self.train_label_file = None
+        self.wordgrp_dir = None
+        self.keywords_file = None
+        self.index_file = None
+        self.test_label_file = None
+        self.stopwords_file = None
+        self.baseline_label_file = None
+        self.mode = None
+        self.dedup = False
+        self.practical_dir = None
+        self.model_file = None
+        self.state_file = None
+        self.use_cache = True  # Cleared by --no-cache.
+        self.dedup_threshold = kDedupThreshold  # Min word set similarity of near-duplicates (-u).
+        self.metrics_file = None  # Per-phase metrics output (--metrics), see metrics.py.
+        self.profile_dir = None  # Per-phase cProfile output (--profile).
+        self.trace_memory = False  # Per-phase tracemalloc peaks in the metrics (--trace-memory).
+        self.num_shards = None  # Shards of sharded training (--shards).
+        self.shard_index = None  # Shard trained by '-m shard' (--shard).
+        self.shard_dir = None  # Where shards are written and reduced from (--shard-dir).
+        self.sweep_grid = {}  # Constant -> values tried by '-m sweep' (--grid).
+        self.workers = None  # Processes of '-m sweep' (--workers, default every core).
+        self.targets = list(kTargets)  # Targets of '-m evaluate' (--target).
+        self.compare_models = []  # Models '-m evaluate' also scores (--compare).
+        self.results_file = None  # Per-onion results output (--results), see results.py.
+        self.quiet = False  # Print only the summary of every report (-q).
+        self.stream = False  # Score discovery/practical/predict onions in chunks (--stream).
+        self.stream_chunk = kStreamChunk  # Onions per chunk (--chunk-size).
+
+    # The input files, mode, -u, practical directory, model and state
+    # files.
+    def Inputs(self):
+        return (self.train_label_file, self.wordgrp_dir, self.keywords_file, self.index_file, self.test_label_file,
+                self.stopwords_file, self.baseline_label_file, self.mode, self.dedup, self.practical_dir,
+                self.model_file, self.state_file)
+
+
+# Function that processes the input arguments. Returns an Options.
 def ProcessArguments(argv):
+    opts = Options()
     found_l = False
     found_d = False
     found_k = False
@@ -851,12 +3066,10 @@ def ProcessArguments(argv):
     found_b = False
     found_m = False
     abort = False
-    stopwords_file = None
-    dedup = False
-    practical_dir = None
+    targets = []
 
     try:
-        options, args = getopt.getopt(sys.argv[1:],'hl:d:k:i:t:s:b:m:up:',['help','label=','dir=','keywords=','index=','test=','stopwords=','baseline=','mode=','unique','practical='])
+        options, args = getopt.getopt(argv,'hl:d:k:i:t:s:b:m:up:o:c:q',['help','label=','dir=','keywords=','index=','test=','stopwords=','baseline=','mode=','unique','practical=','model=','state=','no-cache','dedup-threshold=','metrics=','profile=','trace-memory','shards=','shard=','shard-dir=','grid=','workers=','target=','compare=','results=','quiet','stream','chunk-size='])
     except getopt.GetoptError as error:
         # Print error and usage
         print(str(error))
@@ -870,52 +3083,157 @@ def ProcessArguments(argv):
             sys.exit()
         elif opt in ('-l', '--label'):
             # Training label file
-            train_label_file = arg
+            opts.train_label_file = arg
             found_l = True
             # print 'Training label file is:', train_label_file
         elif opt in ('-d', '--dir'):
             # Wordgrp_dir
-            wordgrp_dir = arg
+            opts.wordgrp_dir = arg
             found_d = True
             # print 'Wordgrp directory is:', wordgrp_dir
         elif opt in ('-k', '--keywords'):
             # Keywords file
-            keywords_file = arg
+            opts.keywords_file = arg
             found_k = True
             # print 'Keywords file is:', keywords_file
         elif opt in ('-i', '--index'):
             # Index file
-            index_file = arg
+            opts.index_file = arg
             found_i = True
             # print 'Index file is:', index_file
         elif opt in ('-t', '--test'):
             # Test label file
-            test_label_file = arg
+            opts.test_label_file = arg
             found_t = True
             # print 'Test label file is:', test_label_file
         elif opt in ('-s', '--stopwords'):
             # Stopwords file
-            stopwords_file = arg
+            opts.stopwords_file = arg
             found_s = True
             # print 'Stopwords file is:', stopwords_file
         elif opt in ('-b', '--baseline'):
             # Baseline label file
-            baseline_label_file = arg
+            opts.baseline_label_file = arg
             found_b = True
             # print 'Baseline label file is:', baseline_label_file
         elif opt in ('-m', '--mode'):
             # Mode
-            mode = arg
+            opts.mode = arg
             found_m = True
             # print 'Mode is:', mode
         elif opt in ('-u', '--unique'):
             # Dedup data
-            dedup = True
+            opts.dedup = True
         elif opt in ('-p', '--practical'):
-            practical_dir = arg
+            opts.practical_dir = arg
+        elif opt == '--dedup-threshold':
+            # Near-duplicate similarity for -u (see FindDuplicates)
+            opts.dedup_threshold = float(arg)
+        elif opt == '--no-cache':
+            # Always parse the word group files (see WordGrpCache)
+            opts.use_cache = False
+        elif opt == '--metrics':
+            # Per-phase metrics file (see metrics.py)
+            opts.metrics_file = arg
+        elif opt == '--trace-memory':
+            # tracemalloc peak of every phase in the metrics
+            opts.trace_memory = True
+        elif opt == '--profile':
+            # Directory for per-phase cProfile stats
+            opts.profile_dir = arg
+        elif opt == '--shards':
+            # Number of shards (train, shard, reduce)
+            opts.num_shards = int(arg)
+        elif opt == '--shard':
+            # Shard to train (shard)
+            opts.shard_index = int(arg)
+        elif opt == '--shard-dir':
+            # Directory of the shard files (shard, reduce)
+            opts.shard_dir = arg
+        elif opt == '--grid':
+            # Values of one constant (sweep), e.g. kTitleMultiplier=5,10,20
+            grid = ParseGrid(arg)
+            if grid == None:
+                print('--grid takes NAME=V1,V2,... with NAME one of ' + ', '.join(kSweepConstants))
+                abort = True
+            else:
+                opts.sweep_grid[grid[0]] = grid[1]
+        elif opt == '--workers':
+            # Processes (sweep)
+            opts.workers = int(arg)
+        elif opt == '--target':
+            # Target category (evaluate), replaces the default targets
+            targets.append(arg)
+        elif opt == '--compare':
+            # Model whose keywords are also scored (evaluate)
+            opts.compare_models.append(arg)
+        elif opt == '--results':
+            # Per-onion results file (see results.py)
+            opts.results_file = arg
+        elif opt in ('-q', '--quiet'):
+            # Only the summary of every report
+            opts.quiet = True
+        elif opt == '--stream':
+            # Score in chunks, without loading data (discovery, practical, predict)
+            opts.stream = True
+        elif opt == '--chunk-size':
+            # Onions per chunk (--stream)
+            opts.stream_chunk = int(arg)
+        elif opt in ('-o', '--model'):
+            # Model file (train, predict)
+            opts.model_file = arg
+        elif opt in ('-c', '--state'):
+            # Incremental training state file (train)
+            opts.state_file = arg
+    if targets:
+        opts.targets = targets
 
 
     # Check if arguments are given
+    mode = opts.mode
+    if mode in ('train', 'predict', 'reduce') and opts.model_file == None:
+        print('Required option -o not given')
+        abort = True
+    if mode in ('shard', 'reduce'):
+        if opts.num_shards == None:
+            print('Required option --shards not given')
+            abort = True
+        if opts.shard_dir == None:
+            print('Required option --shard-dir not given')
+            abort = True
+    if mode == 'shard' and (opts.shard_index == None or opts.num_shards == None or not 0 <= opts.shard_index < opts.num_shards):
+        print('Required option --shard (0 to --shards - 1) not given')
+        abort = True
+    if opts.stream and mode not in ('discovery', 'practical', 'predict'):
+        print('--stream only applies to "discovery", "practical" and "predict"')
+        abort = True
+    if opts.stream and opts.dedup:
+        print('-u needs all of data loaded, it cannot be used with --stream')
+        abort = True
+    if opts.stream_chunk < 1:
+        print('--chunk-size must be at least 1')
+        abort = True
+    if opts.num_shards != None and opts.num_shards < 1:
+        print('--shards must be at least 1')
+        abort = True
+    if mode == 'manifest':
+        # Only the word group directories are needed.
+        if opts.wordgrp_dir == None and opts.practical_dir == None:
+            print('Required option -d or -p not given')
+            abort = True
+        if abort:
+            PrintUsage()
+            sys.exit(2)
+        return opts
+    if mode == 'predict':
+        # Only the model and the new onions are needed.
+        if opts.practical_dir == None:
+            print('Required option -p not given')
+            abort = True
+        if abort:
+            PrintUsage()
+            sys.exit(2)
+        return opts
     if not found_l:
         print('Required option -l not given')
         abort = True
@@ -944,7 +3262,7 @@ def ProcessArguments(argv):
         PrintUsage()
         sys.exit(2)
     else:
-        return train_label_file, wordgrp_dir, keywords_file, index_file, test_label_file, stopwords_file, baseline_label_file, mode, dedup, practical_dir
+        return opts
 
 
 # Function for printing the usage of the program.
@@ -953,6 +3271,22 @@ def PrintUsage():
     print('\tGet accuracy results on Feb 19 data: python enhance_keywords.py -l train.labels -d WORD_GRP2 -k KeywordGroups.txt -i MASTER.Onion.Index.csv -t test.labels -s stopwords.txt -b weapons_outDead.txt -m "accuracy"')
     print('\tGet filtering results on Feb 19 data: python enhance_keywords.py -l train.labels -d WORD_GRP2 -k KeywordGroups.txt -i MASTER.Onion.Index.csv -t test.labels -s stopwords.txt -b weapons_outDead.txt -m "filtering"')
     print('\tGet discovery results on Mar 2 data: python enhance_keywords.py -l train.labels -d WORD_GRP3 -k KeywordGroups_03022016.txt -i MASTER.Onion.Index_03022016.csv -t test.labels -s stopwords.txt -b wordGrp3_Results_03022016.dat -m "discovery"')
+    print('\tTrain and save a model: python enhance_keywords.py -l train.labels -d WORD_GRP2 -k KeywordGroups.txt -i MASTER.Onion.Index.csv -t test.labels -s stopwords.txt -b weapons_outDead.txt -m "train" -o atol.model')
+    print('\tCategorize new onions with a saved model: python enhance_keywords.py -m "predict" -o atol.model -p NEW_WORD_GRP')
+    print('\tTrain incrementally, re-reading only changed onions: add -c atol.state to "train"')
+    print('\tTrain in 8 shards with a pool of processes: add --shards 8 to "train"')
+    print('\tTrain shard 3 of 8 on this machine: python enhance_keywords.py -l train.labels -d WORD_GRP2 -k KeywordGroups.txt -i MASTER.Onion.Index.csv -t test.labels -s stopwords.txt -b weapons_outDead.txt -m "shard" --shards 8 --shard 3 --shard-dir SHARDS')
+    print('\tCombine the shards and save the model: same inputs, -m "reduce" --shards 8 --shard-dir SHARDS -o atol.model')
+    print('\tAccuracy of every combination of constants, reading the data once: same inputs as "accuracy", -m "sweep" --grid kTitleMultiplier=5,10,20 --grid kMaxVecSize=25,50,100 (' + ', '.join(kSweepConstants) + '), --workers 4')
+    print('\tAccuracy, filtering and discovery results in one pass: same inputs, -m "evaluate", add --target DRUGS --target Weapons to choose the targets (default DRUGS, HACKER, Weapons) and --compare other.model to also score the keywords of a saved model')
+    print('\tWrite one row per scored onion to a file: add --results results.csv (or .jsonl, or any other name for the binary columnar format, see results.py)')
+    print('\tPrint only the accuracy and the other summaries, not every onion: add -q')
+    print('\tScore "discovery", "practical" or "predict" onions in chunks of 10000 without loading them all: add --stream, and --chunk-size 1000 for smaller chunks')
+    print('\tList the word group files added, changed or removed since the last run: python enhance_keywords.py -m "manifest" -d WORD_GRP2')
+    print('\tParse the word group files without using or writing the .wordgrp.cache and .wordgrp.manifest files: add --no-cache')
+    print('\tDrop near-duplicate onions from data and test: add -u, and --dedup-threshold 0.9 to require more similarity (default 0.8)')
+    print('\tWrite time, memory and throughput of every phase: add --metrics metrics.json (or metrics.prom for Prometheus text), and --trace-memory for tracemalloc peaks')
+    print('\tWrite cProfile stats of every phase to DIR/<phase>.prof: add --profile DIR')
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -1,2 +1,6 @@
-python myATOL.py -l parameters/train.txt -d wrdgroups/ -k parameters/keywords.txt -i parameters/title.txt -t parameters/test.txt -s parameters/stopwords.txt -b parameters/empty.txt -m $1 -p my_word_group/
-
+MODEL=parameters/atol.model
+if [ "$1" = "predict" ]; then
+    python myATOL.py -m predict -o $MODEL -p my_word_group/
+else
+    python myATOL.py -l parameters/train.txt -d wrdgroups/ -k parameters/keywords.txt -i parameters/title.txt -t parameters/test.txt -s parameters/stopwords.txt -b parameters/empty.txt -m $1 -p my_word_group/ -o $MODEL
+fi
@@ -1,65 +1,93 @@
 
 # coding: utf-8
 
-# In[1]:
-
-
+# Builds the myATOL.py inputs from the crawled pages under data/:
+# parameters/title.txt, parameters/train.txt, parameters/test.txt and
+# one word group file per training page in the word group directory.
+#
+# Usage: python3 preprocess.py [--workers N] wrdgroups
+#
+# With --workers N the word groups are generated by N processes
+# (0 = one per core).
+
+import getopt
 import os
 import sys
-import subprocess
+from multiprocessing import Pool
 
-PARAMS_DIR = 'parameters/'
-WORD_GRP   = sys.argv[1]
-dirs  = [x for x in os.listdir('data') if 'tr_' in x]
+from wordgrp import generate_wordgrp, write_wordgrp_file
 
+PARAMS_DIR = 'parameters/'
 
-# In[2]:
 
+def list_docs(cat_path):
+    return [f for f in os.listdir(cat_path) if '.DS' not in f]
 
-# generate title
-with open(PARAMS_DIR+'title.txt', 'w', encoding='utf-8') as f:    
-    for cat in dirs:
-        cat_path = 'data/'+cat
-        for d in [f for f in os.listdir(cat_path) if '.DS' not in f]:
-            with open('{}/{},,,,,,,,,,'.format(cat_path, d), 'r', encoding='utf-8') as ff:
-                title = ff.readline().rstrip()
-            f.write('{},,{}\n'.format(d, title))
 
+# Reads one page, writes its word group and returns its title (first
+# line of the page), so every page is read exactly once.
+def make_wordgrp(job):
+    src, dst = job
+    with open(src, 'r', encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    # Trailing blank line as in the java tool's output, so line counts
+    # (kMinDocSize in myATOL.py) do not change.
+    write_wordgrp_file(dst, generate_wordgrp(text) + [''])
+    return text.split('\n', 1)[0].rstrip()
 
-# In[3]:
 
+def preprocess(word_grp, workers=1):
+    dirs  = [x for x in os.listdir('data') if 'tr_' in x]
+    if not os.path.exists(word_grp):
+        os.makedirs(word_grp)
 
-#generate training labeled data
-with open(PARAMS_DIR+'train.txt', 'w', encoding='utf-8') as f:    
+    # One walk over the tree collects training pages and test labels.
+    train = []
+    test = []
+    jobs = []
     for cat in dirs:
         cat_path = 'data/'+cat
-        for d in [f for f in os.listdir(cat_path) if '.DS' not in f]:
-            f.write('{},{}\n'.format(d, cat[3:]))
-
-
-# In[4]:
-
-
-#generate testing data
-with open(PARAMS_DIR+'test.txt', 'w', encoding='utf-8') as f:    
-    for cat in ['{}{}'.format('te_', d[3:]) for d in dirs]:
-        cat_path = 'data/'+cat
-        for d in [f for f in os.listdir(cat_path) if '.DS' not in f]:
-            f.write('{},{}\n'.format(d, cat[3:]))
-
-
-# In[5]:
-
-
-# generate word groups
-for cat in dirs:
-    cat_path = 'data/'+cat
-    for d in [f for f in os.listdir(cat_path) if '.DS' not in f]:
-        process = subprocess.Popen(['java', 'GenerateWordGrp', '{}/{}'.format(cat_path, d)], stdout=subprocess.PIPE)
-        stdout = process.communicate()[0]
-        wrdgrp = stdout.decode('UTF-8').split('\n')
-        with open('{}/{}.{}'.format('wrdgroups', d, 'onion'), 'w', encoding='utf-8') as ff:
-            for wrd in wrdgrp:
-                ff.write('{}\n'.format(wrd))            
-            
-
+        for d in list_docs(cat_path):
+            train.append((d, cat[3:]))
+            jobs.append(('{}/{}'.format(cat_path, d), '{}/{}.{}'.format(word_grp, d, 'onion')))
+        te_path = 'data/te_'+cat[3:]
+        for d in list_docs(te_path):
+            test.append((d, cat[3:]))
+
+    # generate word groups (and collect titles on the way)
+    if workers == 1:
+        titles = list(map(make_wordgrp, jobs))
+    else:
+        with Pool(workers or None) as pool:
+            chunksize = max(1, len(jobs) // (8 * (workers or os.cpu_count())))
+            titles = pool.map(make_wordgrp, jobs, chunksize=chunksize)
+
+    # generate title
+    with open(PARAMS_DIR+'title.txt', 'w', encoding='utf-8') as f:
+        for (d, cat), title in zip(train, titles):
+            f.write('{},,{},,,,,,,,,,\n'.format(d, title))
+
+    #generate training labeled data
+    with open(PARAMS_DIR+'train.txt', 'w', encoding='utf-8') as f:
+        for d, cat in train:
+            f.write('{},{}\n'.format(d, cat))
+
+    #generate testing data
+    with open(PARAMS_DIR+'test.txt', 'w', encoding='utf-8') as f:
+        for d, cat in test:
+            f.write('{},{}\n'.format(d, cat))
+
+
+if __name__ == '__main__':
+    try:
+        options, args = getopt.getopt(sys.argv[1:], 'w:', ['workers='])
+    except getopt.GetoptError as error:
+        print(str(error))
+        print('Usage: python3 preprocess.py [--workers N] wrdgrp_dir')
+        sys.exit(2)
+    workers = 1
+    for opt, arg in options:
+        if opt in ('-w', '--workers'):
+            workers = int(arg)
+    WORD_GRP = args[0]
+    preprocess(WORD_GRP, workers)
@@ -0,0 +1,192 @@
+# Result files of myATOL.py: one row per scored onion, for tools that
+# would otherwise have to scrape stdout.
+#
+# Rows are buffered and written in batches of batch_size. The format
+# follows the file name:
+#   .csv    comma separated, with a header line,
+#   .jsonl  one JSON object per line,
+#   else    binary columnar (see ColumnarWriter, read with
+#           read_columnar).
+#
+# Columns are (name, kind) pairs, kind one of 'str', 'int', 'float' or
+# 'json' (any JSON value: embedded as is in .jsonl, as JSON text in the
+# other formats).
+#
+# The module functions write to one file per process, like metrics.py:
+# configure(path, columns), then write(batch) with batch a dict of
+# column name -> sequence, and close().
+
+import csv
+import json
+import struct
+
+import numpy as np
+
+BATCH_SIZE = 10000
+
+COLUMNAR_MAGIC = b'ATOLRES\0'
+COLUMNAR_VERSION = 1
+
+
+class Writer(object):
+    def __init__(self, path, columns, batch_size=BATCH_SIZE):
+        self.path = path
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.buffer = dict((name, []) for (name, kind) in self.columns)
+        self.size = 0
+        self.rows_written = 0
+        self.f = self.open(path)
+
+    def open(self, path):
+        return open(path, 'w', newline='', buffering=1 << 20)
+
+    # Adds the rows of batch (column name -> sequence, all of the same
+    # length), writing whenever batch_size rows are buffered.
+    def write(self, batch):
+        n = None
+        for (name, kind) in self.columns:
+            values = batch[name]
+            if n is None:
+                n = len(values)
+            elif len(values) != n:
+                raise ValueError('column ' + name + ' has ' + str(len(values)) + ' rows, expected ' + str(n))
+            self.buffer[name].extend(values.tolist() if isinstance(values, np.ndarray) else values)
+        self.size += n or 0
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.size > 0:
+            self.write_block(self.buffer, self.size)
+            self.rows_written += self.size
+            self.buffer = dict((name, []) for (name, kind) in self.columns)
+            self.size = 0
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    # Values of column i of the buffered rows, JSON columns as text.
+    def text_column(self, buffer, i):
+        (name, kind) = self.columns[i]
+        if kind == 'json':
+            return [json.dumps(value) for value in buffer[name]]
+        return buffer[name]
+
+
+class CsvWriter(Writer):
+    def __init__(self, path, columns, batch_size=BATCH_SIZE):
+        Writer.__init__(self, path, columns, batch_size)
+        self.csv = csv.writer(self.f)
+        self.csv.writerow([name for (name, kind) in self.columns])
+
+    def write_block(self, buffer, n):
+        self.csv.writerows(zip(*[self.text_column(buffer, i) for i in range(len(self.columns))]))
+
+
+class JsonlWriter(Writer):
+    def write_block(self, buffer, n):
+        names = [name for (name, kind) in self.columns]
+        rows = zip(*[buffer[name] for name in names])
+        self.f.write(''.join(json.dumps(dict(zip(names, row))) + '\n' for row in rows))
+
+
+# Binary columnar format: COLUMNAR_MAGIC, version and header size
+# (uint32), the JSON header {"columns": [[name, kind], ...]}, then one
+# block per batch: its number of rows n (uint64), then every column in
+# order. 'int' and 'float' columns are n little-endian int64/float64;
+# 'str' and 'json' columns are n int64 UTF-8 byte lengths followed by
+# the bytes.
+class ColumnarWriter(Writer):
+    def open(self, path):
+        f = open(path, 'wb', buffering=1 << 20)
+        header = json.dumps({'columns': self.columns}).encode('utf-8')
+        f.write(COLUMNAR_MAGIC)
+        f.write(struct.pack('<II', COLUMNAR_VERSION, len(header)))
+        f.write(header)
+        return f
+
+    def write_block(self, buffer, n):
+        self.f.write(struct.pack('<Q', n))
+        for (i, (name, kind)) in enumerate(self.columns):
+            if kind == 'int':
+                self.f.write(np.asarray(buffer[name], dtype='<i8').tobytes())
+            elif kind == 'float':
+                self.f.write(np.asarray(buffer[name], dtype='<f8').tobytes())
+            else:
+                encoded = [value.encode('utf-8') for value in self.text_column(buffer, i)]
+                self.f.write(np.array([len(value) for value in encoded], dtype='<i8').tobytes())
+                self.f.write(b''.join(encoded))
+
+
+# The batches of a file written by ColumnarWriter, as dicts of column
+# name -> numpy array (int, float) or list (str, json).
+def read_columnar(path):
+    with open(path, 'rb') as f:
+        if f.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError(path + ' is not a columnar result file')
+        (version, header_size) = struct.unpack('<II', f.read(8))
+        if version != COLUMNAR_VERSION:
+            raise ValueError(path + ' has version ' + str(version) + ', expected ' + str(COLUMNAR_VERSION))
+        columns = json.loads(f.read(header_size).decode('utf-8'))['columns']
+        while True:
+            size = f.read(8)
+            if not size:
+                break
+            (n,) = struct.unpack('<Q', size)
+            batch = {}
+            for (name, kind) in columns:
+                if kind == 'int':
+                    batch[name] = np.frombuffer(f.read(8 * n), dtype='<i8')
+                elif kind == 'float':
+                    batch[name] = np.frombuffer(f.read(8 * n), dtype='<f8')
+                else:
+                    lens = np.frombuffer(f.read(8 * n), dtype='<i8')
+                    data = f.read(int(lens.sum()))
+                    ends = np.cumsum(lens).tolist()
+                    values = [data[s:e].decode('utf-8') for (s, e) in zip([0] + ends[:-1], ends)]
+                    batch[name] = [json.loads(value) for value in values] if kind == 'json' else values
+            yield batch
+
+
+def open_writer(path, columns, batch_size=BATCH_SIZE):
+    if path.endswith('.csv'):
+        return CsvWriter(path, columns, batch_size)
+    if path.endswith('.jsonl'):
+        return JsonlWriter(path, columns, batch_size)
+    return ColumnarWriter(path, columns, batch_size)
+
+
+# The result file of this process, None until configure.
+default = None
+
+
+def configure(path, columns, batch_size=BATCH_SIZE):
+    global default
+    close()
+    default = open_writer(path, columns, batch_size)
+
+
+def enabled():
+    return default is not None
+
+
+def write(batch):
+    if default is not None:
+        default.write(batch)
+
+
+def close():
+    global default
+    if default is not None:
+        default.close()
+        default = None
@@ -0,0 +1,133 @@
+# Tests of the classification service of atol_server.py, on a model
+# trained from a generated corpus and served over HTTP on a local port.
+#
+# Run with: python -m pytest -q
+
+import http.client
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import atol_server
+import bench_atol
+import myATOL
+
+
+# A model trained on a generated corpus, and the word group lines of
+# some of its onions.
+@pytest.fixture(scope='module')
+def model(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('atol'))
+    bench_atol.MakeCorpus(directory, 300, 0)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        myATOL.main(['-l', 'train.txt', '-d', 'wg', '-k', 'keywords.txt', '-i', 'title.txt', '-t', 'test.txt',
+                     '-s', 'stopwords.txt', '-b', 'baseline.txt', '-m', 'train', '-o', 'atol.model', '-q'])
+    finally:
+        os.chdir(cwd)
+    pages = []
+    for onion in range(100):
+        with open(os.path.join(directory, 'wg', '{}.onion'.format(onion))) as f:
+            pages.append(f.read())
+    return (os.path.join(directory, 'atol.model'), pages)
+
+
+# The service on a free port, as atol_server.py runs it.
+@pytest.fixture
+def server(model):
+    server = atol_server.ThreadingHTTPServer(('127.0.0.1', 0), atol_server.Handler)
+    server.batcher = atol_server.Batcher(model[0])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(connection, path, obj):
+    body = json.dumps(obj).encode('utf-8')
+    connection.request('POST', path, body, {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    return (response.status, json.loads(response.read().decode('utf-8')))
+
+
+def connect(server):
+    return http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+
+
+# Pages are scored as `myATOL.py -m predict` scores them.
+def test_classify_matches_predict(model, server):
+    (model_file, pages) = model
+    (keywords, categories, constants) = myATOL.LoadModel(model_file)
+    data = myATOL.SparseHashBuilder(myATOL.Vocabulary())
+    for (i, page) in enumerate(pages):
+        rows = myATOL.ParseWordGrpLines(page.split('\n'))
+        data.AddRow(i, [(word, count + constants['kPageMultiplier'] * np.sqrt(num_pages))
+                        for (word, count, num_pages) in rows])
+    data = data.Freeze()
+    (cats, probs) = myATOL.ScoreOnions(data, list(range(len(pages))), keywords, categories)
+
+    connection = connect(server)
+    for (i, page) in enumerate(pages):
+        (status, reply) = post(connection, '/classify', {'wordgrp': page})
+        assert status == 200
+        expected = myATOL.SortedProbs(cats, probs[i])
+        assert [cat for (cat, prob) in reply['probs']] == [cat for (cat, prob) in expected]
+        assert np.allclose([prob for (cat, prob) in reply['probs']], [prob for (cat, prob) in expected])
+        assert reply['category'] == expected[0][0]
+    (status, reply) = post(connection, '/classify', {'text': 'cocaine heroin weed'})
+    assert status == 200 and reply['category'] in categories
+
+
+def test_bad_requests(server):
+    connection = connect(server)
+    assert post(connection, '/classify', {'page': 'no text'})[0] == 400
+    assert post(connection, '/classify', {'wordgrp': 'word,not a count,0,0'})[0] == 400
+    assert post(connection, '/other', {})[0] == 404
+
+
+# A failure while scoring is answered with a 500 and the connection
+# stays usable.
+def test_scoring_error_is_a_server_error(server, monkeypatch):
+    def fail(model, batch):
+        raise RuntimeError('out of memory')
+
+    monkeypatch.setattr(server.batcher, 'Score', fail)
+    connection = connect(server)
+    (status, reply) = post(connection, '/classify', {'text': 'cocaine'})
+    assert status == 500
+    assert 'out of memory' in reply['error']
+    monkeypatch.undo()
+    assert post(connection, '/classify', {'text': 'cocaine'})[0] == 200
+
+
+# Per-page latency: the time the service spends on a page (parsing
+# and classifying), and the round trip of sequential requests on one
+# keep-alive connection. The target for the service time is below a
+# millisecond; the bounds leave room for slow test machines.
+def test_latency(model, server):
+    pages = model[1]
+    service = []
+    for page in pages * 3:
+        s = time.perf_counter()
+        server.batcher.Classify(myATOL.ParseWordGrpLines(page.split('\n')))
+        service.append(time.perf_counter() - s)
+    connection = connect(server)
+    post(connection, '/classify', {'wordgrp': pages[0]})
+    round_trip = []
+    for page in pages * 3:
+        s = time.perf_counter()
+        (status, reply) = post(connection, '/classify', {'wordgrp': page})
+        round_trip.append(time.perf_counter() - s)
+        assert status == 200
+    for (name, latencies) in (('service', service), ('round trip', round_trip)):
+        print('Per-page {}: median {:.3f} ms, p99 {:.3f} ms'.format(
+            name, 1000 * float(np.median(latencies)), 1000 * float(np.percentile(latencies, 99))))
+    assert np.median(service) < 0.002
+    assert np.median(round_trip) < 0.005
@@ -0,0 +1,392 @@
+# Tests of the concurrent crawl of getBOW.py (crawl_onions) against a
+# local aiohttp server standing in for the onions, reached directly as
+# with --proxy none.
+#
+# Run with: python -m pytest -q
+
+import asyncio
+import json
+import os
+import socket
+import time
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+
+import getBOW
+
+
+# Local server. Every request is counted per path and logged as
+# (method, path), and the requests in flight (most at once) are
+# tracked. Routes:
+#   /page/NAME?delay=S  answers 'page NAME' after S seconds,
+#   /flaky/NAME?fail=N  answers 503 to the first N requests of NAME,
+#   /big                answers 1 MiB,
+#   /etag/NAME          answers 'page NAME' with ETag "NAME", or 304 to
+#                       a request that sends it back.
+# HEAD requests (probes) are answered at once.
+class Server(object):
+    def __init__(self):
+        self.requests = {}
+        self.log = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.not_modified = 0
+        self.runner = None
+        self.port = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/page/{name}', self.page)
+        app.router.add_get('/flaky/{name}', self.flaky)
+        app.router.add_get('/big', self.big)
+        app.router.add_get('/etag/{name}', self.etag)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.port, path)
+
+    def count(self, request):
+        self.requests[request.path] = self.requests.get(request.path, 0) + 1
+        self.log.append((request.method, request.path))
+
+    async def page(self, request):
+        self.count(request)
+        if request.method == 'HEAD':
+            return web.Response(text='')
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(float(request.query.get('delay', 0)))
+        finally:
+            self.in_flight -= 1
+        return web.Response(text='page ' + request.match_info['name'], content_type='text/html')
+
+    async def flaky(self, request):
+        self.count(request)
+        if self.requests[request.path] <= int(request.query['fail']):
+            return web.Response(status=503, text='busy')
+        return web.Response(text='page ' + request.match_info['name'])
+
+    async def big(self, request):
+        self.count(request)
+        return web.Response(body=b'x' * (1 << 20))
+
+    async def etag(self, request):
+        self.count(request)
+        tag = '"{}"'.format(request.match_info['name'])
+        if request.headers.get('If-None-Match') == tag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={'ETag': tag})
+        return web.Response(text='page ' + request.match_info['name'], content_type='text/html', headers={'ETag': tag})
+
+
+# Runs scenario(server) against a started Server.
+def run(scenario):
+    async def main():
+        server = Server()
+        await server.start()
+        try:
+            return await scenario(server)
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+
+# Everything crawl_onions yields, in order.
+async def crawl(urls, **options):
+    options.setdefault('backoff', 0.01)
+    return [item async for item in getBOW.crawl_onions(list(enumerate(urls)), None, **options)]
+
+
+def closed_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def test_pages_arrive_as_they_finish():
+    delays = [0.6, 0.0, 0.3, 0.1]
+
+    async def scenario(server):
+        urls = [server.url('/page/{}?delay={}'.format(i, d)) for (i, d) in enumerate(delays)]
+        s = time.time()
+        results = []
+        async for (i, url, page, elapsed, probe_failed) in getBOW.crawl_onions(list(enumerate(urls)), None, concurrency=8, per_host=8):
+            results.append((i, page.body, time.time() - s))
+        return results
+
+    results = run(scenario)
+    # Fastest first, each yielded without waiting for the slow ones.
+    assert [i for (i, body, t) in results] == [1, 3, 2, 0]
+    assert [body for (i, body, t) in results] == [('page {}'.format(i)).encode() for i in (1, 3, 2, 0)]
+    assert results[0][2] < 0.3
+
+
+def test_per_host_limit():
+    async def scenario(server):
+        urls = [server.url('/page/{}?delay=0.1'.format(i)) for i in range(8)]
+        results = await crawl(urls, concurrency=8, per_host=2)
+        return (results, server.max_in_flight)
+
+    (results, max_in_flight) = run(scenario)
+    assert all(page is not None for (i, url, page, elapsed, probe_failed) in results)
+    assert max_in_flight == 2
+
+
+def test_global_limit():
+    async def scenario(server):
+        urls = [server.url('/page/{}?delay=0.1'.format(i)) for i in range(8)]
+        results = await crawl(urls, concurrency=3, per_host=8)
+        return (results, server.max_in_flight)
+
+    (results, max_in_flight) = run(scenario)
+    assert len(results) == 8
+    assert max_in_flight == 3
+
+
+def test_timeout_is_retried_then_given_up():
+    async def scenario(server):
+        s = time.time()
+        results = await crawl([server.url('/page/slow?delay=1')], timeout=0.2, retries=1)
+        return (results, time.time() - s, server.requests.get('/page/slow'))
+
+    (results, elapsed, num_requests) = run(scenario)
+    [(i, url, page, page_elapsed, probe_failed)] = results
+    assert page is None
+    assert not probe_failed
+    assert num_requests == 2
+    assert elapsed < 1
+
+
+def test_server_errors_are_retried_with_backoff():
+    async def scenario(server):
+        s = time.time()
+        results = await crawl([server.url('/flaky/a?fail=2')], retries=2, backoff=0.2)
+        return (results, time.time() - s, server.requests['/flaky/a'])
+
+    (results, elapsed, num_requests) = run(scenario)
+    [(i, url, page, page_elapsed, probe_failed)] = results
+    assert page.status == 200
+    assert page.body == b'page a'
+    assert num_requests == 3
+    # Waits of backoff, then 2 * backoff.
+    assert elapsed >= 0.6
+
+
+def test_last_server_error_is_kept():
+    async def scenario(server):
+        results = await crawl([server.url('/flaky/b?fail=5')], retries=1)
+        return (results, server.requests['/flaky/b'])
+
+    (results, num_requests) = run(scenario)
+    [(i, url, page, page_elapsed, probe_failed)] = results
+    assert page.status == 503
+    assert num_requests == 2
+
+
+def test_connection_errors_give_no_page():
+    async def scenario(server):
+        return await crawl(['http://127.0.0.1:{}/'.format(closed_port())], retries=1)
+
+    [(i, url, page, elapsed, probe_failed)] = run(scenario)
+    assert page is None
+    assert not probe_failed
+
+
+def test_body_is_capped():
+    async def scenario(server):
+        return await crawl([server.url('/big')], max_bytes=100000)
+
+    [(i, url, page, elapsed, probe_failed)] = run(scenario)
+    assert len(page.body) == 100000
+
+
+def test_probe():
+    async def scenario(server):
+        alive = server.url('/page/alive')
+        dead = 'http://127.0.0.1:{}/'.format(closed_port())
+        results = await crawl([alive, dead], probe={alive, dead}, retries=0)
+        return (sorted(results), server.requests['/page/alive'])
+
+    (results, num_requests) = run(scenario)
+    [(i0, url0, page0, elapsed0, probe_failed0), (i1, url1, page1, elapsed1, probe_failed1)] = results
+    assert page0.body == b'page alive' and not probe_failed0
+    assert page1 is None and probe_failed1
+    # The HEAD probe, then the page.
+    assert num_requests == 2
+
+
+def test_crawl_writes_word_groups(tmp_path):
+    async def scenario(server):
+        url_csv = str(tmp_path / 'urls.csv')
+        with open(url_csv, 'w') as f:
+            f.write(server.url('/page/one') + '\n' + server.url('/page/two?delay=0.1') + '\n')
+        await getBOW.get_wordgrp_async(url_csv, str(tmp_path / 'wg'), None, concurrency=4, per_host=2,
+                                       timeout=5, retries=0, backoff=0.01)
+
+    run(scenario)
+    wrdgrp_dir = str(tmp_path / 'wg')
+    names = sorted(name for name in os.listdir(wrdgrp_dir) if name.endswith('.onion'))
+    assert names == sorted(os.path.basename(getBOW.wordgrp_path(wrdgrp_dir, i)) for i in (0, 1))
+    with open(getBOW.wordgrp_path(wrdgrp_dir, 1)) as f:
+        assert 'two,1,0,0' in f.read().split('\n')
+
+
+# Without a parse pool, pages are parsed off the event loop: a slow
+# parse must not hold up the fetches in flight.
+def test_parsing_does_not_block_fetching(tmp_path, monkeypatch):
+    page_to_wordgrp = getBOW.page_to_wordgrp
+
+    def slow_page_to_wordgrp(body, content_type):
+        time.sleep(0.6)
+        return page_to_wordgrp(body, content_type)
+
+    monkeypatch.setattr(getBOW, 'page_to_wordgrp', slow_page_to_wordgrp)
+
+    async def scenario(server):
+        url_csv = str(tmp_path / 'urls.csv')
+        with open(url_csv, 'w') as f:
+            f.write(server.url('/page/one') + '\n' + server.url('/page/two?delay=0.2') + '\n')
+        await getBOW.get_wordgrp_async(url_csv, str(tmp_path / 'wg'), None, concurrency=4, per_host=2,
+                                       timeout=5, retries=0, backoff=0.01)
+
+    run(scenario)
+    with open(str(tmp_path / 'wg' / getBOW.JOURNAL_FILE)) as f:
+        elapsed = dict((record['url'].split('/')[-1], record['elapsed']) for record in map(json.loads, f))
+    # two arrives while one is still being parsed.
+    assert elapsed['two?delay=0.2'] < 0.5
+
+
+# Last journal status of every url of wrdgrp_dir, by url path.
+def statuses(wrdgrp_dir):
+    with open(os.path.join(wrdgrp_dir, getBOW.JOURNAL_FILE)) as f:
+        return dict((record['url'].split('/', 3)[3], record['status']) for record in map(json.loads, f))
+
+
+def write_urls(path, urls):
+    with open(path, 'w') as f:
+        f.write('\n'.join(urls) + '\n')
+
+
+# --resume skips the onions done in the interrupted crawl and fetches
+# the failed ones again.
+def test_resume_retries_only_failed(tmp_path):
+    wrdgrp_dir = str(tmp_path / 'wg')
+
+    async def scenario(server):
+        url_csv = str(tmp_path / 'urls.csv')
+        write_urls(url_csv, [server.url('/page/one'), server.url('/page/slow?delay=0.5')])
+        await getBOW.get_wordgrp_async(url_csv, wrdgrp_dir, None, timeout=0.2, retries=0)
+        first = (statuses(wrdgrp_dir), dict(server.requests))
+        await getBOW.get_wordgrp_async(url_csv, wrdgrp_dir, None, resume=True, timeout=5, retries=0)
+        return (first, statuses(wrdgrp_dir), server.requests)
+
+    ((first_statuses, first_requests), last_statuses, requests) = run(scenario)
+    assert first_statuses == {'page/one': 'ok', 'page/slow?delay=0.5': 'failed'}
+    assert last_statuses == {'page/one': 'ok', 'page/slow?delay=0.5': 'ok'}
+    assert first_requests == {'/page/one': 1, '/page/slow': 1}
+    assert requests == {'/page/one': 1, '/page/slow': 2}
+    names = sorted(name for name in os.listdir(wrdgrp_dir) if name.endswith('.onion'))
+    assert names == sorted(os.path.basename(getBOW.wordgrp_path(wrdgrp_dir, i)) for i in (0, 1))
+
+
+# With --cache, a recrawl reuses the word groups of the last crawl
+# without parsing: for a page answered 304 (it sends an ETag), and for
+# one sent again with the same content (same sha1).
+def test_cache_reuses_word_groups_without_parsing(tmp_path, monkeypatch, capsys):
+    parsed = []
+    page_to_wordgrp = getBOW.page_to_wordgrp
+
+    def counting_page_to_wordgrp(body, content_type):
+        parsed.append(body)
+        return page_to_wordgrp(body, content_type)
+
+    monkeypatch.setattr(getBOW, 'page_to_wordgrp', counting_page_to_wordgrp)
+    wrdgrp_dir = str(tmp_path / 'wg')
+    cache_dir = str(tmp_path / 'cache')
+
+    def wordgrps():
+        contents = []
+        for i in (0, 1):
+            with open(getBOW.wordgrp_path(wrdgrp_dir, i)) as f:
+                contents.append(f.read())
+        return contents
+
+    async def scenario(server):
+        url_csv = str(tmp_path / 'urls.csv')
+        write_urls(url_csv, [server.url('/etag/one'), server.url('/page/two')])
+        await getBOW.get_wordgrp_async(url_csv, wrdgrp_dir, None, cache_dir=cache_dir, retries=0)
+        first = (len(parsed), wordgrps(), server.not_modified)
+        await getBOW.get_wordgrp_async(url_csv, wrdgrp_dir, None, cache_dir=cache_dir, retries=0)
+        return (first, len(parsed), wordgrps(), server.not_modified, dict(server.requests))
+
+    ((first_parsed, first_wordgrps, first_not_modified), num_parsed, contents, not_modified, requests) = run(scenario)
+    assert (first_parsed, first_not_modified) == (2, 0)
+    assert 'one,1,0,0' in first_wordgrps[0].split('\n')
+    assert num_parsed == 2
+    assert not_modified == 1
+    assert requests == {'/etag/one': 2, '/page/two': 2}
+    assert contents == first_wordgrps
+    assert 'Crawl cache: 1 pages not modified, 1 unchanged, 0 parsed.' in capsys.readouterr().out
+
+
+# With --dead-hosts, an onion that failed is skipped while its wait
+# runs, and probed with HEAD before the fetch once it is over. Two
+# failed urls of one host count one failure.
+def test_dead_hosts_are_skipped_then_probed(tmp_path, capsys):
+    wrdgrp_dir = str(tmp_path / 'wg')
+    dead_hosts_file = str(tmp_path / 'dead.json')
+    dead = '127.0.0.1:{}'.format(closed_port())
+
+    def set_retry_after(host, retry_after):
+        with open(dead_hosts_file) as f:
+            hosts = json.load(f)
+        hosts[host] = {'failures': 3, 'retry_after': retry_after, 'cost': 10.0}
+        with open(dead_hosts_file, 'w') as f:
+            json.dump(hosts, f)
+
+    async def scenario(server):
+        alive = server.url('/page/a')
+        url_csv = str(tmp_path / 'urls.csv')
+        write_urls(url_csv, [alive, 'http://{}/x'.format(dead), 'http://{}/y'.format(dead)])
+        with open(dead_hosts_file, 'w') as f:
+            json.dump({}, f)
+        # alive is in its wait, the dead host is not known yet.
+        host = getBOW.onion_host(alive)
+        set_retry_after(host, time.time() + 3600)
+        await getBOW.get_wordgrp_async(url_csv, wrdgrp_dir, None, dead_hosts_file=dead_hosts_file, retries=0)
+        first = (statuses(wrdgrp_dir), list(server.log))
+        with open(dead_hosts_file) as f:
+            first_hosts = json.load(f)
+        # alive's wait is over.
+        set_retry_after(host, time.time() - 1)
+        await getBOW.get_wordgrp_async(url_csv, wrdgrp_dir, None, dead_hosts_file=dead_hosts_file, retries=0)
+        with open(dead_hosts_file) as f:
+            hosts = json.load(f)
+        return (first, first_hosts, statuses(wrdgrp_dir), server.log, hosts, host)
+
+    ((first_statuses, first_log), first_hosts, last_statuses, log, hosts, host) = run(scenario)
+    assert first_statuses == {'page/a': 'dead', 'x': 'failed', 'y': 'failed'}
+    assert first_log == []
+    assert first_hosts[dead]['failures'] == 1
+    assert first_hosts[dead]['retry_after'] > time.time() + getBOW.DEAD_FIRST_TTL - 60
+
+    assert last_statuses == {'page/a': 'ok', 'x': 'dead', 'y': 'dead'}
+    assert log == [('HEAD', '/page/a'), ('GET', '/page/a')]
+    # alive answered, the dead host is still in its first wait.
+    assert sorted(hosts) == [dead]
+    assert hosts[dead]['failures'] == 1
+    out = capsys.readouterr().out
+    assert 'Dead onions: 2 skipped, 1 probed (0 still dead)' in out
@@ -0,0 +1,304 @@
+# Tests of myATOL.py.
+#
+# Run with: python -m pytest -q
+
+import glob
+import math
+import os
+import re
+import shutil
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+import bench_atol
+import myATOL
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+INPUTS = ('parameters/train.txt', 'wrdgroups', 'parameters/keywords.txt', 'parameters/title.txt',
+          'parameters/test.txt', 'parameters/stopwords.txt', 'parameters/empty.txt')
+
+
+# The single-pass loader (CreateHashes) must build the same data, M and
+# Mt as the two passes it replaced: ProcessFilesInDir for data, then
+# ProcessFilesInCategory for M and Mt. Copies of the two old functions
+# are kept here as the reference, reading files in sorted order as the
+# loaders do now.
+
+# The first pass as it was: data[onion][word] += count.
+def OldProcessFilesInDir(directory, data):
+    path = os.getcwd() + '/' + directory + '/*'
+    filenames = sorted(glob.glob(path))
+    for filename in filenames:
+        onion = filename[filename.rfind('/')+1:filename.find('.')]
+        f = open(filename, 'r')
+        lines = f.readlines()
+        f.close()
+        for line in lines:
+            if line.startswith('#'):
+                continue
+            stripped_line = line.rstrip('\n')
+            tokens = stripped_line.split(',')
+            if '' in tokens:
+                continue
+            word = tokens[0]
+            count = int(tokens[1]) + myATOL.kPageMultiplier * math.sqrt(int(tokens[2]))
+            data[onion][word] += count
+    return data
+
+
+# The second pass as it was: M[cat][word] and Mt[word][cat] += count.
+def OldProcessFilesInCategory(directory, L, T, K, M, Mt, S, H, test):
+    path = os.getcwd() + '/' + directory + '/*'
+    filenames = sorted(glob.glob(path))
+    for filename in filenames:
+        onion = filename[filename.rfind('/')+1:filename.rfind('.')]
+        cat_list = []
+        cat_from_raters = False
+        if onion not in L:
+            if onion in H:
+                cat_list = H[onion]
+        else:
+            if onion in test:
+                continue
+            cat_list = L[onion]
+            cat_from_raters = True
+
+        f = open(filename, 'r')
+        lines = f.readlines()
+        f.close()
+        if len(lines) < myATOL.kMinDocSize:
+            continue
+        for line in lines:
+            if line.startswith('#'):
+                continue
+            stripped_line = line.rstrip('\n')
+            tokens = stripped_line.split(',')
+            if '' in tokens:
+                continue
+            word = tokens[0]
+            if word in S:
+                continue
+            count = int(tokens[1])
+            if len(cat_list) > 0:
+                count = float(count) / len(cat_list)
+            for cat in cat_list:
+                if cat in K and word in K[cat]:
+                    count *= myATOL.kKeywordMultiplier
+                if cat_from_raters:
+                    count *= myATOL.kRatersMultiplier
+                M[cat][word] += count
+                Mt[word][cat] += count
+
+        if onion not in T:
+            continue
+        for title_word in T[onion]:
+            for cat in cat_list:
+                M[cat][title_word] += myATOL.kTitleMultiplier
+                Mt[title_word][cat] += myATOL.kTitleMultiplier
+    return (M, Mt)
+
+
+def OldHashes():
+    (train_label_file, wordgrp_dir, keywords_file, index_file, test_label_file, stopwords_file, baseline_label_file) = INPUTS
+    L = myATOL.CreateL(train_label_file)
+    test = myATOL.CreateL(test_label_file)
+    K = myATOL.CreateK(keywords_file, L)
+    S = myATOL.CreateS(stopwords_file)
+    T = myATOL.CreateT(index_file, S)
+    H = myATOL.CreateH(index_file)
+    data = OldProcessFilesInDir(wordgrp_dir, defaultdict(lambda: defaultdict(int)))
+    (M, Mt) = OldProcessFilesInCategory(wordgrp_dir, L, T, K, defaultdict(lambda: defaultdict(int)),
+                                        defaultdict(lambda: defaultdict(int)), S, H, test)
+    return (data, M, Mt)
+
+
+# The shipped corpus in a temporary directory, so the word group cache
+# is written there.
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    shutil.copytree(os.path.join(HERE, 'wrdgroups'), str(tmp_path / 'wrdgroups'),
+                    ignore=shutil.ignore_patterns('.wordgrp.*'))
+    shutil.copytree(os.path.join(HERE, 'parameters'), str(tmp_path / 'parameters'))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+# Keys, and every row's words and values, in order.
+def Rows(hsh):
+    return [(key, list(hsh[key].items())) for key in hsh.keys()]
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_single_pass_matches_two_passes(corpus, capsys, use_cache):
+    (old_data, old_M, old_Mt) = OldHashes()
+    runs = 2 if use_cache else 1
+    for run in range(runs):
+        # With the cache, the second run reads the rows from it.
+        (L, K, T, M, Mt, data, test, H, B, lexicon) = myATOL.CreateHashes(*INPUTS, use_cache=use_cache)
+    capsys.readouterr()
+
+    assert Rows(data) == Rows(old_data)
+    assert Rows(M) == Rows(old_M)
+    # Mt is a view of M, so it iterates in vocabulary order: compare
+    # its content.
+    assert sorted(Mt.keys()) == sorted(old_Mt.keys())
+    for word in old_Mt:
+        assert Mt[word] == dict(old_Mt[word])
+
+
+# Incremental training after word group files were added, changed and
+# removed must give the M and keywords of a full retrain, reading only
+# the files that changed.
+def test_incremental_matches_full_train(tmp_path, monkeypatch, capsys):
+    bench_atol.MakeCorpus(str(tmp_path), 200, 0)
+    monkeypatch.chdir(tmp_path)
+    inputs = ('train.txt', 'wg', 'keywords.txt', 'title.txt', 'test.txt', 'stopwords.txt')
+    (L, test, K, S, T, H) = myATOL.CreateTrainingInputs(inputs)
+    categories = sorted(set(cat for cats in L.values() for cat in cats))
+    labeled = sorted((onion for onion in L if onion not in test), key=int)
+    (added, changed, removed) = [os.path.join('wg', onion + '.onion') for onion in labeled[:3]]
+    os.rename(added, 'added.onion')
+    myATOL.TrainIncremental('atol.state', 'wg', L, T, K, S, H, test, categories)
+    capsys.readouterr()
+
+    os.rename('added.onion', added)
+    with open(changed) as f:
+        content = f.read()
+    with open(changed, 'w') as f:
+        f.write('incremental,7,2,0\n' + content)
+    os.remove(removed)
+    (M, keywords) = myATOL.TrainIncremental('atol.state', 'wg', L, T, K, S, H, test, categories)
+    assert 'Incremental training: 2 files read, 1 removed.' in capsys.readouterr().out
+
+    (full_M, full_Mt) = myATOL.CreateM('wg', L, T, K, S, H, test, use_cache=False)
+    full_keywords = myATOL.ComputeTFICF(full_M, full_Mt, K, categories, myATOL.Lexicon(full_M.vocab, K, S))
+    capsys.readouterr()
+    assert Rows(M) == Rows(full_M)
+    assert keywords == full_keywords
+
+
+# Sharded training must give the M of a single process, bit for bit,
+# for any number of shards. Onions with 5 or 7 labels add count / 5 and
+# count / 7, which are not exact in binary, so M depends on the order
+# of the additions.
+@pytest.mark.parametrize('num_shards', [1, 2, 3, 7])
+def test_shards_match_single_process(tmp_path, monkeypatch, capsys, num_shards):
+    bench_atol.MakeCorpus(str(tmp_path), 200, 0)
+    monkeypatch.chdir(tmp_path)
+    with open('train.txt') as f:
+        labels = [line.rstrip('\n').split(',') for line in f]
+    with open('train.txt', 'a') as f:
+        for (i, (onion, cat)) in enumerate(labels[:40]):
+            others = [c for c in bench_atol.kCategories if c != cat]
+            for c in others[:4 if i % 2 else 6]:
+                f.write('{},{}\n'.format(onion, c))
+    inputs = ('train.txt', 'wg', 'keywords.txt', 'title.txt', 'test.txt', 'stopwords.txt')
+    (L, test, K, S, T, H) = myATOL.CreateTrainingInputs(inputs)
+    assert sorted(set(len(cats) for cats in L.values())) == [1, 5, 7]
+
+    (M, Mt) = myATOL.CreateM('wg', L, T, K, S, H, test)
+    myATOL.RunShards(inputs, num_shards, 'shards')
+    reduced = myATOL.ReduceShards('shards', num_shards, myATOL.ShardSettings(L, test, K, S, T, H))
+    capsys.readouterr()
+    assert Rows(reduced) == Rows(M)
+
+
+# Onions of identical word groups, in data order, as a SparseHash.
+def Data(onions, words=('alpha', 'bravo', 'charlie', 'delta')):
+    return myATOL.SparseHash.FromHash(dict((onion, dict((word, 1) for word in words)) for onion in onions),
+                                      myATOL.Vocabulary())
+
+
+# Data and test must keep the same onion of a cluster, or the test onion
+# kept would be scored without words.
+def test_dedup_keeps_the_same_onion_in_data_and_test():
+    data = Data(['a', 'b'])
+    test = {'b': ['DRUGS'], 'a': ['DRUGS']}
+    clusters = myATOL.FindDuplicates(data, 0.8)
+    assert clusters == [['a', 'b']]
+    survivors = myATOL.DedupSurvivors(data, clusters, test)
+    assert survivors == ['b']
+    assert myATOL.DedupData(data, clusters, survivors).keys() == ['b']
+    assert list(myATOL.DedupTest(test, clusters, survivors).keys()) == ['b']
+
+
+# Word sets at a known Jaccard similarity: a copy of an onion's n words
+# with k of them replaced has similarity (n - k) / (n + k).
+def test_minhash_finds_planted_near_duplicates():
+    rng = np.random.RandomState(0)
+    pool = rng.permutation(100000)
+    hsh = {}
+    expected = []
+    for g in range(10):
+        words = ['w{}'.format(i) for i in pool[g * 1000:g * 1000 + 300]]
+        (base, near, far) = ('base{}'.format(g), 'near{}'.format(g), 'far{}'.format(g))
+        hsh[base] = dict((word, 1) for word in words[:200])
+        # 195 / 205 = 0.95 and 150 / 250 = 0.6.
+        hsh[near] = dict((word, 1) for word in words[5:205])
+        hsh[far] = dict((word, 1) for word in words[50:250])
+        expected.append([base, near])
+    data = myATOL.SparseHash.FromHash(hsh, myATOL.Vocabulary())
+
+    assert myATOL.FindDuplicates(data, 0.8) == expected
+    # The signatures estimate the similarities.
+    onions = data.keys()
+    sig = myATOL.MinHashSignatures(data, onions)
+    for g in range(10):
+        (base, near, far) = (sig[3 * g], sig[3 * g + 1], sig[3 * g + 2])
+        assert abs((base == near).mean() - 0.95) < 0.1
+        assert abs((base == far).mean() - 0.6) < 0.1
+
+
+# With -u, M is the M of the corpus without the dropped onions' files.
+def test_dedup_leaves_dropped_onions_out_of_m(tmp_path, monkeypatch, capsys):
+    bench_atol.MakeCorpus(str(tmp_path), 300, 0)
+    monkeypatch.chdir(tmp_path)
+    inputs = ['train.txt', 'wg', 'keywords.txt', 'title.txt', 'test.txt', 'stopwords.txt', 'baseline.txt']
+    (L, K, T, M, Mt, data, test, H, B, lexicon) = myATOL.CreateHashes(*inputs, dedup=True)
+    onions = [name[:-len('.onion')] for name in os.listdir('wg') if name.endswith('.onion')]
+    dropped = [onion for onion in onions if onion not in data]
+    # Some of them are labeled, so M changes.
+    assert any(onion in L for onion in dropped)
+
+    shutil.copytree('wg', 'wg_dedup', ignore=shutil.ignore_patterns('.wordgrp.*'))
+    for onion in dropped:
+        os.remove(os.path.join('wg_dedup', onion + '.onion'))
+    inputs[1] = 'wg_dedup'
+    (L2, K2, T2, M2, Mt2, data2, test2, H2, B2, lexicon2) = myATOL.CreateHashes(*inputs)
+    capsys.readouterr()
+    assert Rows(M) == Rows(M2)
+    assert data.keys() == data2.keys()
+
+
+# Output of myATOL.main(argv), without the timings.
+def Main(argv, capsys):
+    myATOL.main(argv)
+    out = capsys.readouterr().out
+    return [line for line in out.split('\n') if not re.search(r'[0-9.]+s\.$', line)]
+
+
+# --stream scores the onions chunk by chunk through KeywordReader, from
+# the word group cache (read a few bytes of its word list at a time
+# here) or, with --no-cache, from the files: the output and the results
+# must be those of the run that loads all onions.
+@pytest.mark.parametrize('mode', ['discovery', 'practical'])
+def test_stream_matches_loading(tmp_path, monkeypatch, capsys, mode):
+    bench_atol.MakeCorpus(str(tmp_path), 300, 0)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(myATOL, 'kCacheBlock', 16)
+    argv = ['-l', 'train.txt', '-d', 'wg', '-k', 'keywords.txt', '-i', 'title.txt', '-t', 'test.txt',
+            '-s', 'stopwords.txt', '-b', 'baseline.txt', '-p', 'wg', '-m', mode]
+    # Also writes the cache.
+    expected = Main(argv + ['--results', 'full.jsonl'], capsys)
+    with open('full.jsonl') as f:
+        expected_results = f.read()
+    assert expected_results.count('\n') > 40
+
+    for (chunk_size, options) in ((1, []), (7, []), (64, ['--no-cache'])):
+        output = Main(argv + ['--results', 'stream.jsonl', '--stream', '--chunk-size', str(chunk_size)] + options, capsys)
+        assert output == expected
+        with open('stream.jsonl') as f:
+            assert f.read() == expected_results
@@ -0,0 +1,47 @@
+# Tests of results.py: what ColumnarWriter writes, read_columnar reads
+# back.
+#
+# Run with: python -m pytest -q
+
+import numpy as np
+
+import results
+
+COLUMNS = (('name', 'str'), ('count', 'int'), ('probability', 'float'), ('extra', 'json'))
+
+
+def make_rows(n):
+    rng = np.random.RandomState(0)
+    return {'name': ['', 'onion', 'ünïcödé, "quoted"\nline'] * (n // 3) + ['x'] * (n % 3),
+            'count': rng.randint(-2 ** 62, 2 ** 62, size=n),
+            'probability': np.concatenate(([1.0 / 3, -0.0, 1e300, 5e-324], rng.random_sample(n - 4))),
+            'extra': [[i, {'cats': ['DRUGS'] * (i % 3), 'p': i / 7.0}, None] if i % 2 else 'plain' for i in range(n)]}
+
+
+def test_columnar_round_trip(tmp_path):
+    path = str(tmp_path / 'results.bin')
+    rows = make_rows(50)
+    # Writes of uneven sizes, and a batch_size smaller than the rows.
+    with results.ColumnarWriter(path, COLUMNS, batch_size=8) as writer:
+        start = 0
+        for size in (5, 1, 0, 17, 27):
+            writer.write(dict((name, values[start:start + size]) for (name, values) in rows.items()))
+            start += size
+    assert writer.rows_written == 50
+
+    batches = list(results.read_columnar(path))
+    assert len(batches) > 1
+    assert sum(len(batch['name']) for batch in batches) == 50
+    assert [value for batch in batches for value in batch['name']] == rows['name']
+    assert [value for batch in batches for value in batch['extra']] == rows['extra']
+    count = np.concatenate([batch['count'] for batch in batches])
+    assert count.dtype.kind == 'i' and np.array_equal(count, rows['count'])
+    probability = np.concatenate([batch['probability'] for batch in batches])
+    # Bit for bit, -0.0 included.
+    assert probability.tobytes() == np.asarray(rows['probability'], dtype='<f8').tobytes()
+
+
+def test_columnar_without_rows(tmp_path):
+    path = str(tmp_path / 'results.bin')
+    results.ColumnarWriter(path, COLUMNS, batch_size=8).close()
+    assert list(results.read_columnar(path)) == []
@@ -0,0 +1,44 @@
+# Golden-output test of wordgrp.py: regenerating the shipped word groups
+# in wrdgroups/ from their pages in data/tr_* must give the same bytes
+# (the files were made by java GenerateWordGrp, see preprocess.py).
+#
+# Run with: python -m pytest -q
+
+import glob
+import os
+
+import pytest
+
+from wordgrp import generate_wordgrp_file, write_wordgrp_file
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# (word group file, page) of every shipped word group with a page.
+# 11.onion has none.
+def shipped_wordgrps():
+    pairs = []
+    for path in sorted(glob.glob(os.path.join(HERE, 'wrdgroups', '*.onion'))):
+        name = os.path.basename(path)[:-len('.onion')]
+        sources = glob.glob(os.path.join(HERE, 'data', 'tr_*', name))
+        if sources:
+            pairs.append((path, sources[0]))
+    return pairs
+
+
+def test_every_shipped_wordgrp_but_one_has_a_page():
+    assert len(shipped_wordgrps()) == len(glob.glob(os.path.join(HERE, 'wrdgroups', '*.onion'))) - 1
+
+
+@pytest.mark.parametrize('wordgrp_path,page_path', shipped_wordgrps(),
+                         ids=lambda p: os.path.basename(p))
+def test_wordgrp_matches_shipped(tmp_path, wordgrp_path, page_path):
+    out = str(tmp_path / os.path.basename(wordgrp_path))
+    # As preprocess.make_wordgrp writes it: with the java tool's
+    # trailing blank line.
+    write_wordgrp_file(out, generate_wordgrp_file(page_path) + [''])
+    with open(out, 'rb') as f:
+        generated = f.read()
+    with open(wordgrp_path, 'rb') as f:
+        shipped = f.read()
+    assert generated == shipped
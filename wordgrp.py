@@ -0,0 +1,95 @@
+# In-process replacement for GenerateWordGrp.class.
+#
+# Turns the text of an onion page into its word group: one line per
+# distinct word, in the format myATOL.py reads:
+# Word,Count,NumPages,Ratio
+#
+# The output is the same, line for line and in the same order, as
+# `java GenerateWordGrp <file>`, so existing word group directories
+# stay comparable with new ones.
+#
+# Usage: python3 wordgrp.py file
+
+import os
+import re
+import sys
+
+# Same tokenizing rules as the java tool: split on these delimiters,
+# lower-case, and keep words longer than 2 characters that start with
+# a letter a-z.
+DELIMITERS = " \t\n\r\f,.:;?![]'"
+token_re = re.compile('[^{}]+'.format(re.escape(DELIMITERS)))
+kMinWordLength = 3
+
+
+def count_words(text):
+    counts = {}
+    for word in token_re.findall(text):
+        word = word.lower()
+        if not 'a' <= word[0] <= 'z':
+            continue
+        # java counts string length in UTF-16 code units.
+        if len(word) < kMinWordLength and len(word.encode('utf-16-le')) < 2 * kMinWordLength:
+            continue
+        counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+def java_string_hash(s):
+    h = 0
+    b = s.encode('utf-16-le')
+    for i in range(0, len(b), 2):
+        h = (31 * h + (b[i] | b[i + 1] << 8)) & 0xFFFFFFFF
+    return h & 0x7FFFFFFF
+
+
+# Order in which java.util.Hashtable.keys() returns keys inserted in
+# this order. The table starts with 11 buckets and grows to 2n+1 once
+# it holds 3/4 of that; new entries go to the head of their bucket and
+# keys() walks buckets from the last one down. Each bucket list here
+# keeps its head at the end.
+def java_hashtable_order(keys):
+    capacity = 11
+    threshold = int(capacity * 0.75)
+    table = [[] for _ in range(capacity)]
+    count = 0
+    for key, h in ((key, java_string_hash(key)) for key in keys):
+        if count >= threshold:
+            new_capacity = capacity * 2 + 1
+            new_table = [[] for _ in range(new_capacity)]
+            for i in range(capacity - 1, -1, -1):
+                for entry in reversed(table[i]):
+                    new_table[entry[1] % new_capacity].append(entry)
+            capacity = new_capacity
+            threshold = int(capacity * 0.75)
+            table = new_table
+        table[h % capacity].append((key, h))
+        count += 1
+    return [key for i in range(capacity - 1, -1, -1) for (key, h) in reversed(table[i])]
+
+
+def generate_wordgrp(text):
+    counts = count_words(text)
+    return ['{},{},0,0'.format(word, counts[word]) for word in java_hashtable_order(counts)]
+
+
+def generate_wordgrp_file(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return generate_wordgrp(f.read())
+
+
+# Write a word group file so that readers never see it half written:
+# write a hidden temp file next to it (glob('*') skips dot files) and
+# rename it into place.
+def write_wordgrp_file(path, lines):
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, '.{}.tmp'.format(name))
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write('{}\n'.format(line))
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    for line in generate_wordgrp_file(sys.argv[1]):
+        print(line)